@@ -85,8 +85,116 @@ DRY_RUN = False
 # How often to re-check and replace orders.
 # Generally, it's safe to make this short because we're fetching from websockets. But if too many
 # order amend/replaces are done, you may hit a ratelimit. If so, email BitMEX if you feel you need a higher limit.
+# The loop also wakes as soon as the quote, our orders or our position change, so this is the longest it idles.
 LOOP_INTERVAL = 5
 
+# Maintain a local L2 order book from the websocket. Set to "orderBookL2_25" (top 25 levels) or "orderBookL2"
+# (full depth) to subscribe; the ticker then reads best bid/ask from the book instead of the throttled
+# instrument bidPrice/askPrice. None leaves it unsubscribed.
+ORDERBOOK_TABLE = None
+
+# Trade, quote and execution history is kept in fixed-size ring buffers on the websocket.
+# Number of rows to keep per table; tables not listed keep 200.
+HISTORY_TABLE_LEN = {'trade': 200, 'quote': 200, 'execution': 200}
+
+# Also keep that history as array-backed timestamp/price/size columns, readable with
+# BitMEXWebsocket.get_columns(table), so strategy code can slice it without building dicts.
+COLUMNAR_HISTORY = False
+
+# If the websocket drops, reconnect in place with exponential backoff (WS_RECONNECT_DELAY doubling up to
+# WS_RECONNECT_MAX_DELAY seconds), resubscribe and swap in fresh data, rather than restarting the bot.
+# After WS_RECONNECT_ATTEMPTS failed attempts in a row, we give up and restart as before.
+WS_RECONNECT = True
+WS_RECONNECT_DELAY = 0.5
+WS_RECONNECT_MAX_DELAY = 30
+WS_RECONNECT_ATTEMPTS = 10
+# While reconnecting we can't see the book, so once the websocket has been down for WS_RESYNC_CANCEL_SECONDS
+# our orders are canceled over HTTP, and placed again after the resync. None leaves them resting throughout.
+WS_RESYNC_CANCEL_SECONDS = 5
+
+# Send a websocket ping every WS_PING_INTERVAL seconds. If no pong comes back within WS_PING_TIMEOUT,
+# the connection is treated as dead and reconnected.
+WS_PING_INTERVAL = 15
+WS_PING_TIMEOUT = 10
+
+# Market data staleness. If no quote has arrived for QUOTE_STALE_SECONDS, or the median lag between exchange
+# timestamps and local receive time over the last few quotes exceeds MAX_FEED_LAG_SECONDS, we pull our quotes
+# and stop quoting until the feed recovers. Lag is measured from the smallest seen since the websocket
+# (re)connected, so a steady offset between our clock and the exchange's isn't mistaken for lag. If no message
+# at all has arrived for WS_STALE_RECONNECT_SECONDS, the websocket is reconnected. Set any of these to None to
+# disable that check.
+QUOTE_STALE_SECONDS = 60
+MAX_FEED_LAG_SECONDS = 5
+WS_STALE_RECONNECT_SECONDS = 30
+# How many recent lag samples to keep per table, for BitMEXWebsocket.feed_lag().
+FEED_LAG_WINDOW = 1000
+
+# Frames read off the websocket are queued and applied to the local tables by a separate thread, so slow
+# handling doesn't back up the socket. Up to WS_APPLY_BATCH queued frames are applied at a time, with
+# consecutive quote inserts and instrument updates merged into one apply. If WS_QUEUE_SIZE frames are waiting,
+# the reader blocks until there's room. Set WS_APPLY_QUEUE = False to apply frames on the reader thread.
+WS_APPLY_QUEUE = True
+WS_QUEUE_SIZE = 10000
+WS_APPLY_BATCH = 500
+
+# Track our position, entry price and PnL locally from execution fills, marked against the live quote,
+# instead of waiting for the exchange's throttled position updates. Used by the take-profit and stop-loss checks.
+LOCAL_POSITION_ACCOUNTING = True
+
+# Record every raw websocket frame, with its local receive time, to compressed files in this directory.
+# Files are rotated after WS_RECORD_MAX_BYTES of frames. Read them back with market_maker.ws.recorder.readFrames().
+WS_RECORD_DIR = None
+WS_RECORD_MAX_BYTES = 100 * 1024 * 1024
+
+# Replay a capture written with WS_RECORD_DIR instead of connecting to BitMEX, to reproduce a session offline.
+# Implies DRY_RUN. WS_REPLAY_SPEED is a multiple of real time; None replays as fast as possible.
+# `python -m market_maker.ws.replay <capture>` benchmarks the message handling path on a capture.
+WS_REPLAY_PATH = None
+WS_REPLAY_SPEED = None
+
+# create_orders / amend_orders send their orders concurrently over up to this many connections,
+# innermost price levels first.
+ORDER_WORKERS = 8
+
+# Orders our creates, amends and cancels return are applied to our view of open orders straight away, so each
+# loop requotes against the book we asked for rather than whatever the websocket has reported so far. If the
+# websocket hasn't confirmed one after PENDING_ORDER_SECONDS, we go back to what the websocket says.
+PENDING_ORDER_SECONDS = 10
+
+# REST requests are paced against BitMEX's rate limit on our side (see market_maker.utils.ratelimit), cancels
+# first and leverage/informational calls last. An amend that would wait more than AMEND_MAX_WAIT seconds for
+# budget is dropped; the next loop requotes from fresh prices instead. While less than REQUOTE_MIN_BUDGET of
+# the limit is left, the bot skips requoting so cancels always have room.
+AMEND_MAX_WAIT = 1
+REQUOTE_MIN_BUDGET = 0.2
+
+# Failed REST requests (timeouts, connection errors, 503s, 429s) are retried with exponential backoff from
+# REST_RETRY_BASE seconds, capped at REST_RETRY_CAP and randomly jittered. Only idempotent requests are retried
+# (GET/DELETE and leverage changes), at most REST_MAX_RETRIES times, and a request gives up once
+# REST_RETRY_DEADLINE seconds have passed since it was first sent.
+REST_MAX_RETRIES = 3
+REST_RETRY_BASE = 0.25
+REST_RETRY_CAP = 5
+REST_RETRY_DEADLINE = 30
+
+# Every REST request's DNS, connect, TLS, time-to-first-byte and total time are kept per endpoint for the last
+# REST_STATS_WINDOW requests. Requests slower than REST_SLOW_REQUEST_SECONDS in total are logged with that
+# breakdown (None disables this). Send the bot SIGUSR1 to log percentiles per endpoint and, if REST_STATS_FILE
+# is set, write every phase's percentiles there as JSON.
+REST_STATS_WINDOW = 1000
+REST_SLOW_REQUEST_SECONDS = 1
+REST_STATS_FILE = None
+
+# Dead man's switch: keep the exchange's cancelAllAfter timer armed with a CANCEL_ALL_AFTER millisecond timeout,
+# re-arming it every CANCEL_ALL_AFTER_INTERVAL seconds. If the bot crashes or its loop hangs for that long,
+# BitMEX cancels all our orders. Must be well above LOOP_INTERVAL. None disables it.
+CANCEL_ALL_AFTER = None
+CANCEL_ALL_AFTER_INTERVAL = 15
+
+# When pulling quotes (on reset, exit or a stale feed), cancel every open order on the symbol in one request
+# rather than only the orders carrying our ORDERID_PREFIX. This also cancels manual orders and other bots' orders.
+CANCEL_ALL_SYMBOL_WIDE = False
+
 # Wait times between orders / errors
 API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
@@ -116,4 +224,5 @@ WATCHED_FILES = [join('market_maker', 'market_maker.py'), join('market_maker', '
 ########################################################################################################################
 
 # Specify the contracts that you hold. These will be used in portfolio calculations.
+# Their quotes, trades and orders are subscribed on the same websocket connection as SYMBOL.
 CONTRACTS = ['XBTUSD']
@@ -1,4 +1,5 @@
 from requests.auth import AuthBase
+from market_maker.auth.RequestSigner import RequestSigner
 import time
 import hashlib
 import hmac
@@ -16,14 +17,12 @@ class APIKeyAuth(AuthBase):
         """Init with Key & Secret."""
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        self.signer = RequestSigner(apiKey, apiSecret)
 
     def __call__(self, r):
         """Called when forming a request - generates api key headers."""
         # modify and return the request
-        nonce = generate_expires()
-        r.headers['api-expires'] = str(nonce)
-        r.headers['api-key'] = self.apiKey
-        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, nonce, r.body or '')
+        r.headers.update(self.signer.headers(r.method, r.path_url, r.body or '', generate_expires()))
 
         return r
 
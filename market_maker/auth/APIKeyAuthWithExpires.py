@@ -1,6 +1,5 @@
 from requests.auth import AuthBase
-import time
-from market_maker.auth.APIKeyAuth import generate_signature
+from market_maker.auth.RequestSigner import RequestSigner
 
 
 class APIKeyAuthWithExpires(AuthBase):
@@ -11,6 +10,7 @@ class APIKeyAuthWithExpires(AuthBase):
         """Init with Key & Secret."""
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        self.signer = RequestSigner(apiKey, apiSecret)
 
     def __call__(self, r):
         """
@@ -19,10 +19,7 @@ class APIKeyAuthWithExpires(AuthBase):
         This way it will not collide with other processes using the same API Key if requests arrive out of order.
         For more details, see https://www.bitmex.com/app/apiKeys
         """
-        # modify and return the request
-        expires = int(round(time.time()) + 5)  # 5s grace period in case of clock skew
-        r.headers['api-expires'] = str(expires)
-        r.headers['api-key'] = self.apiKey
-        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, expires, r.body or '')
+        # modify and return the request. The signer's default expiry is 5s out, a grace period in case of clock skew.
+        r.headers.update(self.signer.headers(r.method, r.path_url, r.body or ''))
 
         return r
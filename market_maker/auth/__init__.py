@@ -1,3 +1,4 @@
 from market_maker.auth.AccessTokenAuth import *
 from market_maker.auth.APIKeyAuth import *
 from market_maker.auth.APIKeyAuthWithExpires import *
+from market_maker.auth.RequestSigner import *
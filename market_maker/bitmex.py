@@ -7,9 +7,22 @@ import json
 import base64
 import uuid
 import logging
-from market_maker.auth import APIKeyAuthWithExpires
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from market_maker.auth import RequestSigner
 from market_maker.utils import constants, errors
+from market_maker.utils.ratelimit import RateLimiter, requestPriority, AMEND
+from market_maker.utils.reststats import RequestTimer, RestStats, TimedHTTPAdapter
+from market_maker.utils.retry import RetryPolicy
+from market_maker.ws.orderstate import OrderState
 from market_maker.ws.ws_thread import BitMEXWebsocket
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from urllib.parse import urlencode, urlparse
+
+
+# Workers for calls run in the background with BitMEX.submit()
+BACKGROUND_WORKERS = 2
 
 
 # https://www.bitmex.com/api/explorer/
@@ -18,8 +31,25 @@ class BitMEX(object):
     """BitMEX API Connector."""
 
     def __init__(self, base_url=None, base_ws_url=None, symbol=None, apiKey=None, apiSecret=None,
-                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7):
-        """Init connector."""
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, orderBookTable=None,
+                 symbols=None, orderWorkers=8, amendMaxWait=None, retryPolicy=None,
+                 restStats=None, pendingOrderSeconds=10):
+        """Init connector.
+
+        `symbol` is the one we trade. Any other `symbols` are subscribed on the same websocket so their
+        tickers, positions, orders and trades can be read too. create_orders and amend_orders send up to
+        `orderWorkers` orders at once.
+
+        Requests are paced by a client-side RateLimiter (self.rateLimiter). An amend that would have to
+        wait more than `amendMaxWait` seconds for rate limit budget is dropped with a RateLimitError.
+
+        Failed requests are retried according to `retryPolicy` (a RetryPolicy), backing off between
+        attempts on the calling thread. Use submit() to keep a slow or retrying call off the caller's thread,
+        as OrderManager.check_resync does with the cancel it sends while the websocket is down.
+        Every attempt's timings are recorded in `restStats` (a RestStats); see rest_stats().
+
+        Orders returned by create, amend and cancel calls show in open_orders() straight away, until the
+        websocket confirms them or `pendingOrderSeconds` pass; see OrderState."""
         self.logger = logging.getLogger('root')
         self.base_url = base_url
         self.symbol = symbol
@@ -30,10 +60,21 @@ class BitMEX(object):
                             )
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        # One signer for the life of the client; requests are signed against basePath + path + query.
+        self.signer = RequestSigner(apiKey, apiSecret)
+        self.basePath = urlparse(base_url).path
         if len(orderIDPrefix) > 13:
             raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
         self.orderIDPrefix = orderIDPrefix
-        self.retries = 0  # initialize counter
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.restStats = restStats or RestStats()
+        self.rateLimiter = RateLimiter()
+        self.amendMaxWait = amendMaxWait
+        self.heartbeat = None  # (thread, stop event) keeping cancelAllAfter armed
+        # When the last 429 pulled our orders: the concurrent requests that get 429s with it mustn't too.
+        self.rateLimitCancelUntil = 0
+        self.rateLimitCancelLock = threading.Lock()
+        self.lastAlive = None
 
         # Prepare HTTPS session
         self.session = requests.Session()
@@ -41,10 +82,21 @@ class BitMEX(object):
         self.session.headers.update({'user-agent': 'liquidbot-' + constants.VERSION})
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
+        # Batch order calls run on a bounded pool of workers sharing the session's keep-alive connections,
+        # so give the pool a connection per worker.
+        self.orderWorkers = max(1, orderWorkers)
+        self.orderPool = ThreadPoolExecutor(max_workers=self.orderWorkers)
+        self.backgroundPool = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=self.orderWorkers + BACKGROUND_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
         # Create websocket for streaming data
         self.ws = BitMEXWebsocket()
-        self.ws.connect(base_ws_url, symbol, shouldAuth=shouldWSAuth)
+        wsSymbols = [symbol] + [s for s in (symbols or []) if s != symbol]
+        self.ws.connect(base_ws_url, wsSymbols, shouldAuth=shouldWSAuth, orderBookTable=orderBookTable)
+        self.orderState = OrderState(pendingOrderSeconds)
+        self.ws.on('order', self.orderState.on_ws)
 
         self.timeout = timeout
 
@@ -52,7 +104,10 @@ class BitMEX(object):
         self.exit()
 
     def exit(self):
+        self.stop_dead_mans_switch()
         self.ws.exit()
+        self.orderPool.shutdown(wait=False)
+        self.backgroundPool.shutdown(wait=False)
 
     #
     # Public methods
@@ -73,12 +128,12 @@ class BitMEX(object):
             query['filter'] = json.dumps(filter)
         return self._curl_bitmex(path='instrument', query=query, verb='GET')
 
-    def market_depth(self, symbol):
+    def market_depth(self, symbol, depth=25):
         """Get market depth / orderbook."""
-        return self.ws.market_depth(symbol)
+        return self.ws.market_depth(symbol, depth)
 
-    def recent_trades(self):
-        """Get recent trades.
+    def recent_trades(self, n=None, symbol=None):
+        """Get recent trades, oldest first. With n, only the newest n; with symbol, only that symbol's.
 
         Returns
         -------
@@ -89,7 +144,7 @@ class BitMEX(object):
                u'tid': u'93842'},
 
         """
-        return self.ws.recent_trades()
+        return self.ws.recent_trades(n, symbol)
 
     #
     # Authentication required methods
@@ -197,24 +252,53 @@ class BitMEX(object):
 
     @authentication_required
     def amend_orders(self, orders):
-        """Amend multiple orders."""
-        for order in orders:
-            self._curl_bitmex(path='order', postdict=order, verb='PUT', rethrow_errors=True)
+        """Amend multiple orders.
+
+        The amends are sent concurrently, innermost price levels first. Returns a list matching `orders`:
+        the amended order for each one that succeeded, or the exception its request raised."""
+        return self.__send_orders('PUT', orders)
 
     @authentication_required
     def create_orders(self, orders):
-        """Create multiple orders."""
+        """Create multiple orders.
+
+        The orders are sent concurrently, innermost price levels first. Returns a list matching `orders`:
+        the new order for each one that succeeded, or the exception its request raised."""
         for order in orders:
             order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
             order['symbol'] = self.symbol
             if self.postOnly:
                 order['execInst'] = 'ParticipateDoNotInitiate'
-            self._curl_bitmex(path='order', postdict=order, verb='POST', rethrow_errors=True)
+        return self.__send_orders('POST', orders)
+
+    def __send_orders(self, verb, orders):
+        """Send one order request per order on the worker pool and collect the per-order outcomes."""
+        # Innermost first: the highest bids and lowest offers are the ones most likely to trade while we requote.
+        # Sides alternate so neither side waits for the other's whole ladder.
+        ranks = {}
+        for side in ('Buy', 'Sell'):
+            sideOrders = sorted((i for i, o in enumerate(orders) if o.get('side') == side),
+                                key=lambda i: orders[i]['price'], reverse=(side == 'Buy'))
+            ranks.update((i, rank) for rank, i in enumerate(sideOrders))
+        sequence = sorted(range(len(orders)), key=lambda i: ranks.get(i, 0))
+
+        futures = dict((i, self.orderPool.submit(self._curl_bitmex, path='order', postdict=orders[i], verb=verb,
+                                                 rethrow_errors=True)) for i in sequence)
+        results = []
+        for i in range(len(orders)):
+            try:
+                results.append(futures[i].result())
+            except Exception as e:
+                results.append(e)
+        self.orderState.acked(results)
+        return results
 
     @authentication_required
     def open_orders(self):
-        """Get open orders."""
-        return self.ws.open_orders(self.orderIDPrefix)
+        """Get open orders, as of our own latest creates, amends and cancels even if the websocket hasn't
+        caught up with them yet. Buys come first, then sells, each side from the outermost price in."""
+        return self.orderState.open_orders(self.ws.open_orders(self.orderIDPrefix, self.symbol),
+                                           self.orderIDPrefix, self.symbol)
 
     @authentication_required
     def http_open_orders(self):
@@ -233,12 +317,92 @@ class BitMEX(object):
 
     @authentication_required
     def cancel(self, orderID):
-        """Cancel an existing order."""
+        """Cancel an existing order, or a list of them, in one request. Returns the canceled orders."""
+        if isinstance(orderID, (list, tuple)) and not orderID:
+            return []
         path = "order"
         postdict = {
             'orderID': orderID,
         }
-        return self._curl_bitmex(path=path, postdict=postdict, verb="DELETE")
+        canceled = self._curl_bitmex(path=path, postdict=postdict, verb="DELETE")
+        self.orderState.acked(canceled or [])
+        return canceled
+
+    @authentication_required
+    def cancel_all(self, symbol=None, text=None):
+        """Cancel all our open orders on `symbol` (on every symbol if None) in one request.
+        Returns the canceled orders."""
+        postdict = {}
+        if symbol is not None:
+            postdict['symbol'] = symbol
+        if text is not None:
+            postdict['text'] = text
+        canceled = self._curl_bitmex(path="order/all", postdict=postdict or None, verb="DELETE")
+        self.orderState.acked(canceled or [])
+        return canceled
+
+    @authentication_required
+    def cancel_all_after(self, timeout):
+        """Arm the exchange's dead man's switch: unless this is called again within `timeout` milliseconds,
+        all our orders are canceled. A timeout of 0 disarms it."""
+        return self._curl_bitmex(path="order/cancelAllAfter", postdict={'timeout': timeout}, verb="POST",
+                                 rethrow_errors=True)
+
+    def start_dead_mans_switch(self, timeout, interval):
+        """Keep cancel_all_after(timeout) armed from a background thread, re-arming every `interval` seconds.
+
+        The trading loop must call mark_alive() more often than every `timeout` milliseconds. If this
+        process dies, or the loop hangs and stops checking in, the heartbeat stops and the exchange pulls
+        our quotes when the timer runs out. Stopping the heartbeat leaves the last timer armed."""
+        self.stop_dead_mans_switch()
+        stopped = threading.Event()
+        self.mark_alive()
+
+        def heartbeat():
+            stalled = False
+            while not stopped.is_set():
+                idle = time.time() - self.lastAlive
+                if idle < timeout / 1000.0:
+                    stalled = False
+                    try:
+                        self.cancel_all_after(timeout)
+                    except Exception as e:
+                        # The switch stays armed from the last beat; try again next interval.
+                        self.logger.warning("Unable to re-arm cancelAllAfter: %s" % e)
+                elif not stalled:
+                    stalled = True
+                    self.logger.error("Trading loop hasn't checked in for %.1fs; letting cancelAllAfter fire." % idle)
+                stopped.wait(interval)
+
+        self.heartbeat = (threading.Thread(target=heartbeat), stopped)
+        self.heartbeat[0].daemon = True
+        self.heartbeat[0].start()
+
+    def mark_alive(self):
+        """Tell the dead man's switch heartbeat that the trading loop is still making progress."""
+        self.lastAlive = time.time()
+
+    def stop_dead_mans_switch(self):
+        if self.heartbeat is not None:
+            self.heartbeat[1].set()
+            self.heartbeat = None
+
+    def rate_limit_budget(self):
+        """The client-side view of our rate limit budget; see RateLimiter.budget()."""
+        return self.rateLimiter.budget()
+
+    def retry_metrics(self):
+        """Retries, give-ups and seconds spent backing off, per endpoint; see RetryPolicy.metrics()."""
+        return self.retryPolicy.metrics()
+
+    def rest_stats(self, verb=None, path=None):
+        """REST latency histograms and counts per endpoint and verb; see RestStats.summary()."""
+        return self.restStats.summary(verb, path)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run one of this client's calls, e.g. submit(self.http_open_orders), on a background worker and
+        return its Future, so its retries and backoff don't hold up the calling thread."""
+        return self.backgroundPool.submit(fn, *args, **kwargs)
 
     @authentication_required
     def withdraw(self, amount, fee, address):
@@ -251,9 +415,21 @@ class BitMEX(object):
         }
         return self._curl_bitmex(path=path, postdict=postdict, verb="POST", max_retries=0)
 
+    def __claim_rate_limit_cancel(self, reset, retryAfter=None):
+        """Whether a 429 should cancel our orders: only if no other 429 has since the rate limit last reset."""
+        until = max(reset, time.time() + float(retryAfter or 0))
+        with self.rateLimitCancelLock:
+            if time.time() < self.rateLimitCancelUntil:
+                return False
+            self.rateLimitCancelUntil = until
+            return True
+
     def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
-                     max_retries=None):
-        """Send a request to BitMEX Servers."""
+                     max_retries=None, retryState=None):
+        """Send a request to BitMEX Servers.
+
+        `max_retries` overrides the retry policy's default for this verb and path. `retryState` carries a
+        request's retries across attempts; callers leave it out."""
         # Handle URL
         url = self.base_url + path
 
@@ -264,15 +440,12 @@ class BitMEX(object):
         if not verb:
             verb = 'POST' if postdict else 'GET'
 
-        # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
-        if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
-
-        # Auth: API Key/Secret
-        auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
+        # By default only idempotent requests are retried (GET/DELETE, and POSTs that set rather than
+        # create, like leverage). In the future we could allow retrying PUT, so long as 'leavesQty' is not
+        # used (not idempotent), or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"})
+        # so that an amend can't erroneously be applied twice.
+        if retryState is None:
+            retryState = self.retryPolicy.start(verb, path, max_retries)
 
         def exit_or_throw(e):
             if rethrow_errors:
@@ -281,18 +454,46 @@ class BitMEX(object):
                 exit(1)
 
         def retry():
-            self.retries += 1
-            if self.retries > max_retries:
-                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries)
+            delay = retryState.next_delay()
+            if delay is None:
+                raise Exception("Max retries on %s (%s) hit after %d retries in %.1fs, raising." % (
+                    path, json.dumps(postdict or ''), retryState.retries, time.time() - retryState.started))
+            time.sleep(delay)
+            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries, retryState)
+
+        # Wait our turn for rate limit budget: cancels first, informational calls last.
+        timer = RequestTimer()
+        priority = requestPriority(verb, path)
+        if not self.rateLimiter.acquire(priority, self.amendMaxWait if priority == AMEND else None):
+            raise errors.RateLimitError("Rate limit budget too low, dropped %s %s" % (verb, path))
+        timer.acquired()
 
         # Make the request
         response = None
         try:
-            self.logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
-            req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
-            prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
+            status = 'error'
+            body = ''
+            try:
+                self.logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
+                # Build the query string and body ourselves so the signer gets the exact path and data we send.
+                qs = '?' + urlencode(query, doseq=True) if query else ''
+                body = json.dumps(postdict) if postdict is not None else ''
+                headers = self.signer.headers(verb, self.basePath + path + qs, body)
+                req = requests.Request(verb, url + qs, data=body or None, headers=headers)
+                prepped = self.session.prepare_request(req)
+                timer.sending()
+                response = self.session.send(prepped, timeout=timeout)
+                status = response.status_code
+            except requests.exceptions.Timeout:
+                status = 'timeout'
+                raise
+            finally:
+                # Hand back our in-flight slot however the attempt ended, even if it never went out.
+                self.rateLimiter.complete(response.headers if response is not None else None)
+                if timer.sendAt is not None:
+                    headersAfter = response.elapsed.total_seconds() if response is not None else None
+                    self.restStats.record(verb, path, timer.phases(headersAfter), status, retryState.retries,
+                                          len(body), len(response.content) if response is not None else 0)
             # Make non-200s throw
             response.raise_for_status()
 
@@ -324,17 +525,18 @@ class BitMEX(object):
                                   "order pairs or contact support@bitmex.com to raise your limits. " +
                                   "Request: %s \n %s" % (url, json.dumps(postdict)))
 
-                # Figure out how long we need to wait.
+                # The rate limiter holds every request back until the exchange will take one again.
                 ratelimit_reset = response.headers['X-RateLimit-Reset']
-                to_sleep = int(ratelimit_reset) - int(time.time())
                 reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
+                self.rateLimiter.exhausted(response.headers.get('Retry-After'))
 
-                # We're ratelimited, and we may be waiting for a long time. Cancel orders.
-                self.logger.warning("Canceling all known orders in the meantime.")
-                self.cancel([o['orderID'] for o in self.open_orders()])
+                # We're ratelimited, and we may be waiting for a long time. Cancel orders; the cancel
+                # goes ahead of everything else waiting. Only the first of a burst of 429s does this.
+                if self.__claim_rate_limit_cancel(int(ratelimit_reset), response.headers.get('Retry-After')):
+                    self.logger.warning("Canceling all known orders in the meantime.")
+                    self.cancel([o['orderID'] for o in self.open_orders()])
 
-                self.logger.error("Your ratelimit will reset at %s. Sleeping for %d seconds." % (reset_str, to_sleep))
-                time.sleep(to_sleep)
+                self.logger.error("Your ratelimit will reset at %s." % reset_str)
 
                 # Retry the request.
                 return retry()
@@ -343,7 +545,6 @@ class BitMEX(object):
             elif response.status_code == 503:
                 self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
                                     "Request: %s \n %s" % (url, json.dumps(postdict)))
-                time.sleep(3)
                 return retry()
 
             elif response.status_code == 400:
@@ -383,15 +584,11 @@ class BitMEX(object):
         except requests.exceptions.Timeout as e:
             # Timeout, re-run this request
             self.logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
-            time.sleep(1)
             return retry()
 
         except requests.exceptions.ConnectionError as e:
             self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. " +
                                 "Request: %s %s \n %s" % (e, url, json.dumps(postdict)))
-            time.sleep(1)
             return retry()
 
-        # Reset retry counter on success
-        self.retries = 0
         return response.json()
@@ -0,0 +1,388 @@
+"""asyncio BitMEX API Connector."""
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import time
+import uuid
+
+import aiohttp
+from yarl import URL
+
+from market_maker.auth import RequestSigner
+from market_maker.utils import constants, errors
+from market_maker.utils.reststats import RequestTimer, RestStats, aiohttpTraceConfig
+from market_maker.utils.retry import RetryPolicy
+from market_maker.ws.ws_async import AsyncBitMEXWebsocket
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from urllib.parse import urlencode, urlparse
+
+
+class AsyncBitMEX(object):
+
+    """asyncio BitMEX API Connector.
+
+    The same surface as BitMEX, on one event loop: REST calls are coroutines sharing one aiohttp
+    connection pool, so independent requests can be in flight at once (create_orders and
+    amend_orders send their orders concurrently), and the websocket is read on the loop rather
+    than a thread. Methods served from the websocket (ticker_data, position, open_orders, ...)
+    are plain calls. Requires aiohttp.
+
+        bitmex = AsyncBitMEX(base_url=..., symbol='XBTUSD', apiKey=..., apiSecret=...)
+        await bitmex.connect()
+        ...
+        await bitmex.exit()
+    """
+
+    def __init__(self, base_url=None, base_ws_url=None, symbol=None, apiKey=None, apiSecret=None,
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, orderBookTable=None,
+                 symbols=None, retryPolicy=None, restStats=None):
+        """Init connector. Nothing connects until connect() is awaited. Failed requests are retried
+        according to `retryPolicy` (a RetryPolicy), and every attempt's timings recorded in `restStats`."""
+        self.logger = logging.getLogger('root')
+        self.base_url = base_url
+        self.base_ws_url = base_ws_url
+        self.symbol = symbol
+        self.symbols = symbols
+        self.postOnly = postOnly
+        if (apiKey is None):
+            raise Exception("Please set an API key and Secret to get started. See " +
+                            "https://github.com/BitMEX/sample-market-maker/#getting-started for more information."
+                            )
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+        # One signer for the life of the client; requests are signed against basePath + path + query.
+        self.signer = RequestSigner(apiKey, apiSecret)
+        self.basePath = urlparse(base_url).path
+        if len(orderIDPrefix) > 13:
+            raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
+        self.orderIDPrefix = orderIDPrefix
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.restStats = restStats or RestStats()
+        self.shouldWSAuth = shouldWSAuth
+        self.orderBookTable = orderBookTable
+        self.timeout = timeout
+        self.session = None
+        self.ws = AsyncBitMEXWebsocket()
+
+    async def connect(self):
+        """Open the HTTP session and connect the websocket, returning once all its data is in."""
+        # These headers are always sent
+        self.session = aiohttp.ClientSession(headers={
+            'user-agent': 'liquidbot-' + constants.VERSION,
+            'content-type': 'application/json',
+            'accept': 'application/json',
+        }, trace_configs=[aiohttpTraceConfig()])
+        wsSymbols = [self.symbol] + [s for s in (self.symbols or []) if s != self.symbol]
+        await self.ws.connect(self.base_ws_url, wsSymbols, shouldAuth=self.shouldWSAuth,
+                              orderBookTable=self.orderBookTable, session=self.session)
+
+    async def exit(self):
+        await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    #
+    # Public methods
+    #
+    def ticker_data(self, symbol=None):
+        """Get ticker data."""
+        if symbol is None:
+            symbol = self.symbol
+        return self.ws.get_ticker(symbol)
+
+    def instrument(self, symbol):
+        """Get an instrument's details."""
+        return self.ws.get_instrument(symbol)
+
+    async def instruments(self, filter=None):
+        query = {}
+        if filter is not None:
+            query['filter'] = json.dumps(filter)
+        return await self._curl_bitmex(path='instrument', query=query, verb='GET')
+
+    def market_depth(self, symbol, depth=25):
+        """Get market depth / orderbook."""
+        return self.ws.market_depth(symbol, depth)
+
+    def recent_trades(self, n=None, symbol=None):
+        """Get recent trades, oldest first. With n, only the newest n; with symbol, only that symbol's."""
+        return self.ws.recent_trades(n, symbol)
+
+    #
+    # Authentication required methods
+    #
+    def authentication_required(fn):
+        """Annotation for methods that require auth."""
+        def wrapped(self, *args, **kwargs):
+            if not (self.apiKey):
+                msg = "You must be authenticated to use this method"
+                raise errors.AuthenticationError(msg)
+            else:
+                return fn(self, *args, **kwargs)
+        return wrapped
+
+    @authentication_required
+    def funds(self):
+        """Get your current balance."""
+        return self.ws.funds()
+
+    @authentication_required
+    def position(self, symbol):
+        """Get your open position."""
+        return self.ws.position(symbol)
+
+    @authentication_required
+    async def isolate_margin(self, symbol, leverage, rethrow_errors=False):
+        """Set the leverage on an isolated margin position"""
+        postdict = {
+            'symbol': symbol,
+            'leverage': leverage
+        }
+        return await self._curl_bitmex(path="position/leverage", postdict=postdict, verb="POST",
+                                       rethrow_errors=rethrow_errors)
+
+    @authentication_required
+    async def buy(self, quantity, price):
+        """Place a buy order.
+
+        Returns order object. ID: orderID
+        """
+        return await self.place_order(quantity, price)
+
+    @authentication_required
+    async def sell(self, quantity, price):
+        """Place a sell order.
+
+        Returns order object. ID: orderID
+        """
+        return await self.place_order(-quantity, price)
+
+    @authentication_required
+    async def place_order(self, quantity, price):
+        """Place an order."""
+        if price < 0:
+            raise Exception("Price must be positive.")
+
+        postdict = {
+            'symbol': self.symbol,
+            'orderQty': quantity,
+            'price': price,
+            'clOrdID': self.__new_clOrdID()
+        }
+        return await self._curl_bitmex(path="order", postdict=postdict, verb="POST")
+
+    @authentication_required
+    async def amend_orders(self, orders):
+        """Amend multiple orders, all in flight at once. Returns a list matching `orders`, as BitMEX.amend_orders
+        does: the amended order for each one that succeeded, or the exception its request raised."""
+        return await asyncio.gather(*[self._curl_bitmex(path='order', postdict=order, verb='PUT', rethrow_errors=True)
+                                      for order in orders], return_exceptions=True)
+
+    @authentication_required
+    async def create_orders(self, orders):
+        """Create multiple orders, all in flight at once. Returns a list matching `orders`, as BitMEX.create_orders
+        does: the new order for each one that succeeded, or the exception its request raised."""
+        for order in orders:
+            order['clOrdID'] = self.__new_clOrdID()
+            order['symbol'] = self.symbol
+            if self.postOnly:
+                order['execInst'] = 'ParticipateDoNotInitiate'
+        return await asyncio.gather(*[self._curl_bitmex(path='order', postdict=order, verb='POST', rethrow_errors=True)
+                                      for order in orders], return_exceptions=True)
+
+    @authentication_required
+    def open_orders(self):
+        """Get open orders."""
+        return self.ws.open_orders(self.orderIDPrefix, self.symbol)
+
+    @authentication_required
+    async def http_open_orders(self):
+        """Get open orders via HTTP. Used on close to ensure we catch them all."""
+        orders = await self._curl_bitmex(
+            path="order",
+            query={
+                'filter': json.dumps({'ordStatus.isTerminated': False, 'symbol': self.symbol}),
+                'count': 500
+            },
+            verb="GET"
+        )
+        # Only return orders that start with our clOrdID prefix.
+        return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix)]
+
+    @authentication_required
+    async def cancel(self, orderID):
+        """Cancel an existing order, or a list of them, in one request."""
+        if isinstance(orderID, (list, tuple)) and not orderID:
+            return []
+        postdict = {
+            'orderID': orderID,
+        }
+        return await self._curl_bitmex(path="order", postdict=postdict, verb="DELETE")
+
+    @authentication_required
+    async def cancel_all(self, symbol=None, text=None):
+        """Cancel all our open orders on `symbol` (on every symbol if None) in one request."""
+        postdict = {}
+        if symbol is not None:
+            postdict['symbol'] = symbol
+        if text is not None:
+            postdict['text'] = text
+        return await self._curl_bitmex(path="order/all", postdict=postdict or None, verb="DELETE")
+
+    @authentication_required
+    async def cancel_all_after(self, timeout):
+        """Arm (or with 0, disarm) the exchange's dead man's switch; see BitMEX.cancel_all_after()."""
+        return await self._curl_bitmex(path="order/cancelAllAfter", postdict={'timeout': timeout}, verb="POST",
+                                       rethrow_errors=True)
+
+    def retry_metrics(self):
+        """Retries, give-ups and seconds spent backing off, per endpoint; see RetryPolicy.metrics()."""
+        return self.retryPolicy.metrics()
+
+    def rest_stats(self, verb=None, path=None):
+        """REST latency histograms and counts per endpoint and verb; see RestStats.summary()."""
+        return self.restStats.summary(verb, path)
+
+    def __new_clOrdID(self):
+        # A unique clOrdID with our prefix so we can identify it.
+        return self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+
+    async def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
+                           max_retries=None, retryState=None):
+        """Send a request to BitMEX Servers. Handles errors as BitMEX._curl_bitmex does; retries are
+        counted per request, and waiting out a 503 or a rate limit only holds up this request."""
+        qs = '?' + urlencode(query, doseq=True) if query else ''
+        url = self.base_url + path + qs
+
+        if timeout is None:
+            timeout = self.timeout
+
+        # Default to POST if data is attached, GET otherwise
+        if not verb:
+            verb = 'POST' if postdict else 'GET'
+
+        # By default only idempotent requests are retried; see market_maker.utils.retry.
+        if retryState is None:
+            retryState = self.retryPolicy.start(verb, path, max_retries)
+
+        # Auth: API Key/Secret, signed over exactly the path and body we send.
+        body = json.dumps(postdict) if postdict is not None else ''
+        headers = self.signer.headers(verb, self.basePath + path + qs, body)
+
+        def exit_or_throw(e):
+            if rethrow_errors:
+                raise e
+            else:
+                exit(1)
+
+        async def retry(minDelay=0):
+            delay = retryState.next_delay(minDelay)
+            if delay is None:
+                raise Exception("Max retries on %s (%s) hit after %d retries in %.1fs, raising." % (
+                    path, json.dumps(postdict or ''), retryState.retries, time.time() - retryState.started))
+            await asyncio.sleep(delay)
+            return await self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries,
+                                           retryState)
+
+        timer = RequestTimer()
+        timer.acquired()  # No client-side rate limiter here
+        trace = {}
+        status = 'error'
+        text = ''
+        try:
+            self.logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
+            timer.sending()
+            try:
+                async with self.session.request(verb, URL(url, encoded=True), data=body or None, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=timeout),
+                                                trace_request_ctx=trace) as response:
+                    status = response.status
+                    text = await response.text()
+                    responseHeaders = response.headers
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                raise
+            finally:
+                self.restStats.record(verb, path, timer.phases(trace.get('headersAfter'), trace), status,
+                                      retryState.retries, len(body), len(text))
+        except asyncio.TimeoutError:
+            # Timeout, re-run this request
+            self.logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
+            return await retry()
+        except aiohttp.ClientConnectionError as e:
+            self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. "
+                                "Request: %s %s" % (e, url, json.dumps(postdict)))
+            return await retry()
+
+        if status < 400:
+            return json.loads(text)
+
+        e = Exception("%d Error: %s for url: %s" % (status, text, url))
+
+        # 401 - Auth error. This is fatal.
+        if status == 401:
+            self.logger.error("API Key or Secret incorrect, please check and restart.")
+            self.logger.error("Error: " + text)
+            if postdict:
+                self.logger.error(postdict)
+            # Always exit, even if rethrow_errors, because this is fatal
+            exit(1)
+
+        # 404, can be thrown if order canceled or does not exist.
+        elif status == 404:
+            if verb == 'DELETE':
+                self.logger.error("Order not found: %s" % postdict['orderID'])
+                return
+            self.logger.error("Unable to contact the BitMEX API (404). " +
+                              "Request: %s \n %s" % (url, json.dumps(postdict)))
+            exit_or_throw(e)
+
+        # 429, ratelimit; wait until X-RateLimit-Reset. Other requests carry on meanwhile.
+        elif status == 429:
+            self.logger.error("Ratelimited on current request. Sleeping, then trying again. Try fewer " +
+                              "order pairs or contact support@bitmex.com to raise your limits. " +
+                              "Request: %s \n %s" % (url, json.dumps(postdict)))
+            ratelimit_reset = responseHeaders['X-RateLimit-Reset']
+            to_sleep = max(int(ratelimit_reset) - int(time.time()), 0)
+            reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
+            self.logger.error("Your ratelimit will reset at %s. Sleeping for %d seconds." % (reset_str, to_sleep))
+            return await retry(to_sleep)
+
+        # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
+        elif status == 503:
+            self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
+                                "Request: %s \n %s" % (url, json.dumps(postdict)))
+            return await retry()
+
+        elif status == 400:
+            error = json.loads(text)['error']
+            message = error['message'].lower() if error else ''
+
+            # Duplicate clOrdID: that's fine, probably a deploy, go get the order and return it
+            if 'duplicate clordid' in message:
+                IDs = json.dumps({'clOrdID': postdict['clOrdID']})
+                orderResults = await self._curl_bitmex('order', query={'filter': IDs}, verb='GET')
+                for order in orderResults:
+                    if (
+                            order['orderQty'] != abs(postdict['orderQty']) or
+                            order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
+                            order['price'] != postdict['price'] or
+                            order['symbol'] != postdict['symbol']):
+                        raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
+                                        'did not match POST.\nPOST data: %s\nReturned order: %s' % (
+                                            json.dumps(postdict), json.dumps(order)))
+                # All good
+                return orderResults[0] if orderResults else None
+
+            elif 'insufficient available balance' in message:
+                self.logger.error('Account out of funds. The message: %s' % error['message'])
+                exit_or_throw(Exception('Insufficient Funds'))
+
+        # If we haven't returned or re-raised yet, we get here.
+        self.logger.error("Unhandled Error: %s: %s" % (e, text))
+        self.logger.error("Endpoint was: %s %s: %s" % (verb, path, json.dumps(postdict)))
+        exit_or_throw(e)
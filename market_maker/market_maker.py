@@ -4,18 +4,22 @@ import sys
 from datetime import datetime
 from os.path import getmtime
 import random
-import requests
 import atexit
 import signal
 
 from market_maker import bitmex
 from market_maker.settings import settings
 from market_maker.utils import log, constants, errors, math
+from market_maker.utils.reststats import RestStats
+from market_maker.utils.retry import RetryPolicy
 
 # Used for reloading the bot - saves modified times of key files
 import os
 watched_files_mtimes = [(f, getmtime(f)) for f in settings.WATCHED_FILES]
 
+# Position fields taken from local accounting of our fills (see ExchangeInterface.get_position_pnl).
+LOCAL_PNL_FIELDS = ('unrealisedPnl', 'unrealisedPnlPcnt', 'unrealisedRoePcnt', 'markPrice')
+
 
 #
 # Helpers
@@ -31,7 +35,8 @@ trand_type = ''
 
 class OrderManager:      
     def __init__(self):
-        self.exchange = ExchangeInterface(settings.DRY_RUN)
+        # Never send orders based on a replayed feed.
+        self.exchange = ExchangeInterface(settings.DRY_RUN or bool(settings.WS_REPLAY_PATH))
         self.leverage = settings.LEVERAGE
         self.max_profit = settings.TARGET_TO_PROFIT
         self.take_profit_trigger = settings.TAKE_PROFIT_TRIGGER
@@ -39,14 +44,21 @@ class OrderManager:
         self.auto_deleverage = False
         self.stop_placed = False
         self.position_start_entry_qty = float(settings.POSITION_START_ENTRY_QTY)
+        self.feed_ok = True
+        self.pulling = None  # Future for check_resync's background cancel
+        self.rest_stats_requested = False
         # Once exchange is created, register exit handler that will always cancel orders
         # on any error.
         atexit.register(self.exit)
         signal.signal(signal.SIGTERM, self.exit)
+        if hasattr(signal, 'SIGUSR1'):  # Not on Windows
+            signal.signal(signal.SIGUSR1, self.request_rest_stats)
 
         logger.info("Using symbol %s." % self.exchange.symbol)
 
-        if settings.DRY_RUN:
+        if settings.WS_REPLAY_PATH:
+            logger.info("Replaying %s as a dry run." % settings.WS_REPLAY_PATH)
+        elif settings.DRY_RUN:
             logger.info("Initializing dry run. Orders printed below represent what would be posted to BitMEX.")
         else:
             logger.info("Order Manager initializing, connecting to BitMEX. Live run: executing real trades.")
@@ -55,6 +67,7 @@ class OrderManager:
         self.instrument = self.exchange.get_instrument()
         self.starting_qty = self.exchange.get_delta()
         self.running_qty = self.starting_qty
+        self.exchange.start_dead_mans_switch()
         self.reset()
 
     def reset(self):
@@ -163,7 +176,7 @@ class OrderManager:
     # Close position when price approaches top values
     def verify_stop_loss(self):        
         # Get current position and price data
-        position = self.exchange.get_position()
+        position = self.exchange.get_position_pnl()
         ticker = self.exchange.get_ticker()
         current_price = ticker['last']
         current_qty = position['currentQty']
@@ -187,7 +200,8 @@ class OrderManager:
 
         """Verify profit and Close Position at market Price"""        
 
-        position = self.exchange.get_position()
+        # Marked against the live quote rather than the exchange's last (throttled) position push.
+        position = self.exchange.get_position_pnl()
         ticker = self.exchange.get_ticker()
         tickLog = self.exchange.get_instrument()['tickLog']
         # entry_price = position["avgEntryPrice"]
@@ -492,8 +506,9 @@ class OrderManager:
         liqPrice = position['liquidationPrice'] if 'liquidationPrice' in position and position['liquidationPrice'] is not None else None
         currentQty = position['currentQty'] if position['currentQty'] != 0 else None
 
-        # Check all existing orders and match them up with what we want to place.
-        # If there's an open one, we might be able to amend it to fit what we want.
+        # Check all existing orders and match them up with what we want to place. get_orders() lists each side
+        # outermost first, like the desired ladders. If there's an open one, we might be able to amend it to fit
+        # what we want.
         for order in existing_orders:
             try:
                 if order['side'] == 'Buy':
@@ -539,21 +554,21 @@ class OrderManager:
                     (amended_order['orderQty'] - reference_order['cumQty']), tickLog, amended_order['price'],
                     tickLog, (amended_order['price'] - reference_order['price'])
                 ))
-            # This can fail if an order has closed in the time we were processing.
+            # An amend can fail if its order has closed in the time we were processing.
             # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
-            # made it not amendable.
-            # If that happens, we need to catch it and re-tick.
-            try:
-                self.exchange.amend_orders(to_amend,liqPrice, currentQty)
-            except requests.exceptions.HTTPError as e:
-                errorObj = e.response.json()
-                if errorObj['error']['message'] == 'Invalid ordStatus':
-                    logger.warn("Amending failed. Waiting for order data to converge and retrying.")
-                    sleep(0.5)
-                    return self.place_orders()
+            # made it not amendable. The other amends still went through; the next loop sees the order gone
+            # and replaces it.
+            results = self.exchange.amend_orders(to_amend, liqPrice, currentQty)
+            for amended_order, result in zip(to_amend, results):
+                if not isinstance(result, Exception):
+                    continue
+                if orderErrorMessage(result) == 'Invalid ordStatus':
+                    logger.warning("Amending %s failed: it has already closed. Will replace it next loop." %
+                                   amended_order['orderID'])
+                elif isinstance(result, errors.RateLimitError):
+                    logger.warning("Amend of %s deferred to the next loop: %s" % (amended_order['orderID'], result))
                 else:
-                    logger.error("Unknown error on amend: %s. Exiting" % errorObj)
-                    # sys.exit(1)
+                    logger.error("Unknown error on amend of %s: %s" % (amended_order['orderID'], result))
 
         if len(to_create) > 0:
             logger.info("Creating %d orders:" % (len(to_create)))
@@ -561,7 +576,12 @@ class OrderManager:
                 logger.info("%4s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))            
             
             self.exchange.isolate_margin(self.exchange.symbol, settings.LEVERAGE ,True)
-            self.exchange.create_orders(to_create, liqPrice, currentQty)
+            results = self.exchange.create_orders(to_create, liqPrice, currentQty)
+            for order, result in zip(to_create, results):
+                # The rest were placed; a failed level is retried on the next loop.
+                if isinstance(result, Exception):
+                    logger.error("Unable to create %s %d @ %.*f: %s" % (
+                        order['side'], order['orderQty'], tickLog, order['price'], orderErrorMessage(result)))
 
         # Could happen if we exceed a delta limit
         if len(to_cancel) > 0:
@@ -638,7 +658,58 @@ class OrderManager:
         """Ensure the WS connections are still open."""
         return self.exchange.is_open()
 
-    def exit(self):
+    def check_feed(self):
+        """Pull our quotes if market data is stale or lagging. Returns True if it's safe to quote."""
+        if self.pulling is not None:
+            # Don't requote until check_resync's cancel is done with it, or it could cancel the new quotes too.
+            if not self.pulling.done():
+                return False
+            if self.pulling.exception() is not None:
+                logger.warning("Unable to pull quotes: %s" % self.pulling.exception())
+            self.pulling = None
+
+        problem = self.exchange.feed_problem()
+        if problem is None:
+            if not self.feed_ok:
+                logger.info("Market data feed recovered, quoting again.")
+            self.feed_ok = True
+            return True
+
+        if self.feed_ok:
+            logger.warning("%s Pulling quotes." % problem)
+            self.exchange.cancel_all_orders()
+        self.feed_ok = False
+        return False
+
+    def check_resync(self):
+        """Pull our quotes, over HTTP, once the websocket has been resyncing for WS_RESYNC_CANCEL_SECONDS. We
+        can't see the book they're resting on. check_feed puts them back once it's synced again.
+
+        The cancel runs on a background worker: listing our orders over HTTP is retried with backoff, which
+        mustn't hold up the loop (or its cancelAllAfter heartbeat) while the websocket is down."""
+        age = self.exchange.resync_age()
+        if settings.WS_RESYNC_CANCEL_SECONDS is None or age is None or age < settings.WS_RESYNC_CANCEL_SECONDS:
+            return
+        if self.feed_ok:
+            logger.warning("Realtime data has been down for %.1fs. Pulling quotes." % age)
+            self.pulling = self.exchange.bitmex.submit(self.exchange.cancel_all_orders)
+        self.feed_ok = False
+
+    def request_rest_stats(self, *args):
+        """SIGUSR1 handler: have run_loop call dump_rest_stats. The signal can arrive while this thread holds
+        the lock REST stats are recorded under, so the handler itself mustn't touch them."""
+        self.rest_stats_requested = True
+
+    def dump_rest_stats(self):
+        """Log REST latencies per endpoint, and write them all to settings.REST_STATS_FILE if it's set.
+        Sending the bot SIGUSR1 has run_loop call this."""
+        logger.info("REST request latencies:\n" + self.exchange.rest_stats_report())
+        if settings.REST_STATS_FILE:
+            self.exchange.dump_rest_stats(settings.REST_STATS_FILE)
+            logger.info("Wrote REST request stats to %s." % settings.REST_STATS_FILE)
+
+    def exit(self, status=1):
+        """Cancel our orders and exit with `status`: 1 on an error, 0 when a replay reaches its end."""
         logger.info("Shutting down. All open orders will be cancelled.")
         try:
             self.exchange.cancel_all_orders()
@@ -648,7 +719,7 @@ class OrderManager:
         except Exception as e:
             logger.info("Unable to cancel orders: %s" % e)
 
-        sys.exit(1)
+        sys.exit(status)
 
     def run_loop(self):
         while True:
@@ -656,23 +727,55 @@ class OrderManager:
             sys.stdout.flush()
 
             self.check_file_change()
-            sleep(settings.LOOP_INTERVAL)
+            self.exchange.mark_alive()
+            # Wake as soon as the market, our orders or our position move. LOOP_INTERVAL is only
+            # the longest we'll sit idle.
+            self.exchange.wait_for_update(settings.LOOP_INTERVAL)
+
+            if self.rest_stats_requested:
+                self.rest_stats_requested = False
+                self.dump_rest_stats()
 
             # This will restart on very short downtime, but if it's longer,
             # the MM will crash entirely as it is unable to connect to the WS on boot.
             if not self.check_connection():
+                if settings.WS_REPLAY_PATH:
+                    logger.info("Replay finished.")
+                    self.exit(0)
                 logger.error("Realtime data connection unexpectedly closed, restarting.")
                 self.restart()
 
+            # The websocket is reconnecting in place. Don't act on stale data; the resync wakes us.
+            if not self.exchange.is_synced():
+                logger.warning("Realtime data connection dropped, waiting for it to resync.")
+                self.check_resync()
+                continue
+
+            # Read orders, position, margin and instruments from one coherent snapshot this iteration.
+            self.exchange.pin_view()
+
+            # Don't quote against a stale or lagging feed.
+            if not self.check_feed():
+                continue
+
             self.sanity_check()  # Ensures health of mm - several cut-out points here
             self.print_status()  # Print skew, delta, etc            
-            self.place_orders()  # Creates desired orders and converges to existing orders         
+            if self.check_rate_limit():
+                self.place_orders()  # Creates desired orders and converges to existing orders         
             #self.initialize_position() #Initialize a position   
             self.verify_leverage() #Set the correct leverage value avoiding Bitmex auto set on order execution and liquidations
             self.verify_orders_and_leverage() #Verify number of order of the same side and adjust leverage to avoid liquidations
             self.verify_profit() # Realize if are profitble
             self.verify_stop_loss() # Verify Stop Loss and close position
 
+    def check_rate_limit(self):
+        """Requote only while there's rate limit budget to spare, so cancels never have to wait for it."""
+        budget = self.exchange.rate_limit_budget()
+        if budget['fraction'] >= settings.REQUOTE_MIN_BUDGET:
+            return True
+        logger.warning("Rate limit budget low (%d of %d left), skipping requote." % (budget['remaining'], budget['limit']))
+        return False
+
     def restart(self):
         logger.info("Restarting the market maker...")
         os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -687,9 +790,16 @@ class ExchangeInterface:
         self.bitmex = bitmex.BitMEX(base_url=settings.BASE_URL, base_ws_url=settings.BASE_WS_URL, symbol=self.symbol,
                                     apiKey=settings.API_KEY, apiSecret=settings.API_SECRET,
                                     orderIDPrefix=settings.ORDERID_PREFIX, postOnly=settings.POST_ONLY,
-                                    timeout=settings.TIMEOUT)
+                                    timeout=settings.TIMEOUT, orderBookTable=settings.ORDERBOOK_TABLE,
+                                    symbols=settings.CONTRACTS, orderWorkers=settings.ORDER_WORKERS,
+                                    amendMaxWait=settings.AMEND_MAX_WAIT,
+                                    retryPolicy=RetryPolicy(settings.REST_MAX_RETRIES, settings.REST_RETRY_BASE,
+                                                            settings.REST_RETRY_CAP, settings.REST_RETRY_DEADLINE),
+                                    restStats=RestStats(settings.REST_STATS_WINDOW, settings.REST_SLOW_REQUEST_SECONDS),
+                                    pendingOrderSeconds=settings.PENDING_ORDER_SECONDS)
 
         self.leverage = settings.LEVERAGE
+        self.view = None
 
     def cancel_order(self, order):
         tickLog = self.get_instrument()['tickLog']
@@ -711,17 +821,21 @@ class ExchangeInterface:
         logger.info("Resetting current position. Canceling all existing orders.")
         tickLog = self.get_instrument()['tickLog']
 
-        # In certain cases, a WS update might not make it through before we call this.
-        # For that reason, we grab via HTTP to ensure we grab them all.
-        orders = self.bitmex.http_open_orders()
+        if settings.CANCEL_ALL_SYMBOL_WIDE:
+            # One request cancels everything on the symbol on the exchange's side, manual orders and other
+            # bots' orders included.
+            orders = self.bitmex.cancel_all(self.symbol) or []
+        else:
+            # Only our own orders (see ORDERID_PREFIX), by ID in one request. Our open orders include creates
+            # whose WS update hasn't reached us yet; if the WS is reconnecting or closed, ask over HTTP instead.
+            if self.is_open() and self.is_synced():
+                orders = self.bitmex.open_orders()
+            else:
+                orders = self.bitmex.http_open_orders()
+            orders = self.bitmex.cancel([order['orderID'] for order in orders]) or []
 
         for order in orders:
-            logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
-
-        if len(orders):
-            self.bitmex.cancel([order['orderID'] for order in orders])
-
-        sleep(settings.API_REST_INTERVAL)
+            logger.info("Canceled: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
 
     def get_portfolio(self):
         contracts = settings.CONTRACTS
@@ -730,24 +844,11 @@ class ExchangeInterface:
             position = self.bitmex.position(symbol=symbol)
             instrument = self.bitmex.instrument(symbol=symbol)
 
-            if instrument['isQuanto']:
-                future_type = "Quanto"
-            elif instrument['isInverse']:
-                future_type = "Inverse"
-            elif not instrument['isQuanto'] and not instrument['isInverse']:
-                future_type = "Linear"
-            else:
-                raise NotImplementedError("Unknown future type; not quanto or inverse: %s" % instrument['symbol'])
-
-            if instrument['underlyingToSettleMultiplier'] is None:
-                multiplier = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
-            else:
-                multiplier = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
-
+            # futureType and contractMultiplier are derived once per instrument by the websocket.
             portfolio[symbol] = {
                 "currentQty": float(position['currentQty']),
-                "futureType": future_type,
-                "multiplier": multiplier,
+                "futureType": instrument['futureType'],
+                "multiplier": instrument['contractMultiplier'],
                 "markPrice": float(instrument['markPrice']),
                 "spot": float(instrument['indicativeSettlePrice'])
             }
@@ -817,6 +918,20 @@ class ExchangeInterface:
             symbol = self.symbol
         return self.bitmex.position(symbol)
 
+    def get_position_pnl(self, symbol=None):
+        """Our position with PnL from local accounting of our fills, marked against the current quote.
+        Quantity and entry price stay the exchange's: orders are sized from them, and the ledger isn't
+        reconciled with the exchange between reseeds. Just the exchange's position if that's switched off."""
+        if symbol is None:
+            symbol = self.symbol
+        position = self.get_position(symbol)
+        local = self.bitmex.ws.position_pnl(symbol) if settings.LOCAL_POSITION_ACCOUNTING else None
+        if local is None:
+            return position
+        position = dict(position)
+        position.update((field, local[field]) for field in LOCAL_PNL_FIELDS)
+        return position
+
     def close_position(self, quantity, symbol=None):
         if self.dry_run:
             return
@@ -836,6 +951,81 @@ class ExchangeInterface:
         """Check that websockets are still open."""
         return not self.bitmex.ws.exited
 
+    def pin_view(self):
+        """Pin the latest websocket snapshot for all reads until the next call.
+        Returns the set of tables that changed since the previously pinned one."""
+        snapshot = self.bitmex.ws.snapshot()
+        changed = snapshot.changed_since(self.view)
+        self.view = snapshot
+        self.bitmex.ws.pin(snapshot)
+        return changed
+
+    def feed_problem(self):
+        """Check market data freshness against the staleness settings.
+        Returns a description of the problem, or None if the feed is healthy."""
+        ws = self.bitmex.ws
+        age = ws.data_age()
+        if settings.WS_STALE_RECONNECT_SECONDS and age is not None and age > settings.WS_STALE_RECONNECT_SECONDS:
+            if ws.resyncing:
+                # Already reconnecting; closing again would cut its handshake or backoff short.
+                return "No websocket data for %.1fs, waiting for the reconnect." % age
+            ws.reconnect()
+            return "No websocket data for %.1fs, reconnecting." % age
+
+        quote_age = ws.data_age('quote')
+        if settings.QUOTE_STALE_SECONDS and quote_age is not None and quote_age > settings.QUOTE_STALE_SECONDS:
+            return "No quote for %.1fs." % quote_age
+
+        # Relative to the fastest quote since connecting, so skew between our clock and BitMEX's doesn't count.
+        lag = ws.feed_lag('quote', last=20, relative=True)['p50']
+        if settings.MAX_FEED_LAG_SECONDS and lag is not None and lag > settings.MAX_FEED_LAG_SECONDS:
+            return "Quotes are arriving %.1fs further behind the exchange than on connecting." % lag
+        return None
+
+    def start_dead_mans_switch(self):
+        """Have the exchange cancel our orders if we stop checking in (settings.CANCEL_ALL_AFTER)."""
+        if self.dry_run or not settings.CANCEL_ALL_AFTER:
+            return
+        logger.info("Arming cancelAllAfter: orders are pulled %dms after the bot stops checking in." %
+                    settings.CANCEL_ALL_AFTER)
+        self.bitmex.start_dead_mans_switch(settings.CANCEL_ALL_AFTER, settings.CANCEL_ALL_AFTER_INTERVAL)
+
+    def mark_alive(self):
+        self.bitmex.mark_alive()
+
+    def rate_limit_budget(self):
+        """How much of the REST rate limit is left: {'remaining', 'limit', 'fraction', 'reset', 'waiting'}."""
+        return self.bitmex.rate_limit_budget()
+
+    def retry_metrics(self):
+        """REST retries per endpoint: {'VERB path': {'requests', 'retries', 'giveUps', 'backoffSeconds'}}."""
+        return self.bitmex.retry_metrics()
+
+    def rest_stats(self, verb=None, path=None):
+        """REST latency percentiles per phase, status counts and payload sizes, per endpoint and verb."""
+        return self.bitmex.rest_stats(verb, path)
+
+    def rest_stats_report(self):
+        return self.bitmex.restStats.report()
+
+    def dump_rest_stats(self, fileName):
+        self.bitmex.restStats.dump(fileName)
+
+    def is_synced(self):
+        """Check that websocket data is current, i.e. we're not in the middle of a reconnect."""
+        return not self.bitmex.ws.resyncing
+
+    def resync_age(self):
+        """Seconds the websocket has been reconnecting for, or None if it's synced."""
+        return self.bitmex.ws.resync_age()
+
+    def wait_for_update(self, timeout):
+        """Block until the quote, book, our orders, fills or position change, or until timeout seconds pass."""
+        tables = ['quote', 'order', 'position', 'execution']
+        if settings.ORDERBOOK_TABLE:
+            tables.append(settings.ORDERBOOK_TABLE)
+        return self.bitmex.ws.wait_for_update(tables, timeout)
+
     def check_market_open(self):
         instrument = self.get_instrument()
         if instrument["state"] != "Open" and instrument["state"] != "Closed":
@@ -1003,6 +1193,15 @@ def margin(instrument, quantity, price):
     return cost(instrument, quantity, price) * instrument["initMargin"]
 
 
+def orderErrorMessage(e):
+    """The API's error message for a failed order request, or the exception itself if it has none."""
+    response = getattr(e, 'response', None)
+    try:
+        return response.json()['error']['message']
+    except Exception:
+        return str(e)
+
+
 def run():
     logger.info('BitMEX Market Maker Version: %s\n' % constants.VERSION)
 
@@ -0,0 +1,735 @@
+import bisect
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+
+from market_maker.ws.accounting import PositionLedger
+
+XBT_CURRENCY = 'XBt'
+
+
+def timestamp():
+    '''Current time in BitMEX's timestamp format.'''
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def makeInstrument(symbol, price, tickSize=0.5, inverse=True, quanto=False, multiplier=None, lotSize=1):
+    '''Build an instrument row with the fields the connector uses. Everything settles in XBt; inverse
+    contracts are valued like XBTUSD, quanto and linear ones at multiplier * price.'''
+    if multiplier is None:
+        multiplier = -100000000 if inverse else 100
+    return {
+        'symbol': symbol,
+        'rootSymbol': symbol[:3],
+        'state': 'Open',
+        'typ': 'FFWCSX',
+        'settlCurrency': XBT_CURRENCY,
+        'tickSize': tickSize,
+        'lotSize': lotSize,
+        'multiplier': multiplier,
+        'isInverse': inverse,
+        'isQuanto': quanto,
+        'underlyingToSettleMultiplier': -100000000 if inverse else None,
+        'quoteToSettleMultiplier': None if inverse else 100000000,
+        'initMargin': 0.01,
+        'maintMargin': 0.005,
+        'makerFee': -0.00025,
+        'takerFee': 0.00075,
+        'fundingRate': 0.0001,
+        'markPrice': price,
+        'indicativeSettlePrice': price,
+        'lastPrice': price,
+        'bidPrice': None,
+        'askPrice': None,
+        'midPrice': None,
+        'timestamp': timestamp(),
+    }
+
+
+class SimError(Exception):
+    '''A request the exchange refuses, with the HTTP status and error message BitMEX would send.'''
+
+    def __init__(self, status, message, name='HTTPError'):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+        self.name = name
+
+
+class Account(object):
+    def __init__(self, accountID, apiKey, apiSecret, balance):
+        self.id = accountID
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+        self.walletBalance = balance
+        self.positions = {}  # symbol -> Position
+        self.cancelTimer = None  # Armed by cancel_all_after()
+
+
+class Position(object):
+    def __init__(self, account, instrument):
+        self.account = account
+        self.ledger = PositionLedger(instrument)
+        self.leverage = 10
+        self.row = {}
+
+
+class Exchange(object):
+    '''Matching engine and account state for the stand-in BitMEX server.
+
+    Each instrument has a book of resting limit orders, matched in price-time priority, behind an
+    "outside market" quote of unlimited size that stands in for everyone else. Orders that cross the
+    book trade against it first and then against the outside quote; resting orders fill when the
+    outside quote moves through them. Fills update orders, positions (via PositionLedger) and
+    margin, and every change is published to listeners as a BitMEX websocket table action.
+
+    All state is guarded by one lock, so REST handlers and price moves on other threads are applied
+    one at a time and listeners see changes in the order they happened.
+    '''
+
+    PRIVATE_TABLES = ('order', 'execution', 'position', 'margin')
+    KEYS = {
+        'instrument': ['symbol'],
+        'quote': [],
+        'trade': [],
+        'order': ['orderID'],
+        'execution': ['execID'],
+        'position': ['account', 'symbol', 'currency'],
+        'margin': ['account', 'currency'],
+        'orderBookL2': ['symbol', 'id', 'side'],
+        'orderBookL2_25': ['symbol', 'id', 'side'],
+    }
+
+    def __init__(self, instruments=None, outsideSize=100000, spreadTicks=2):
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.accounts = {}  # apiKey -> Account
+        self.accountsByID = {}
+        self.outsideSize = outsideSize
+        self.instruments = {}
+        self.outside = {}  # symbol -> [bid, ask]
+        self.books = {}  # symbol -> {'Buy': {price: deque(orders)}, 'Sell': ...}
+        self.prices = {}  # symbol -> {'Buy': ascending prices, 'Sell': ascending prices}
+        self.stops = {}  # symbol -> untriggered stop orders
+        self.orders = {}  # orderID -> order
+        self.clOrdIDs = {}  # (account id, clOrdID) -> order
+        self.trades = {}  # symbol -> recent trades
+        self.quotes = {}  # symbol -> last quote row
+        self.levels = {}  # (table, symbol) -> {(side, price): size} last published
+        for instrument in (instruments or [makeInstrument('XBTUSD', 10000.0)]):
+            self.add_instrument(instrument, spreadTicks)
+
+    #
+    # Setup
+    #
+    def add_instrument(self, instrument, spreadTicks=2):
+        with self.lock:
+            symbol = instrument['symbol']
+            self.instruments[symbol] = dict(instrument)
+            self.books[symbol] = {'Buy': {}, 'Sell': {}}
+            self.prices[symbol] = {'Buy': [], 'Sell': []}
+            self.stops[symbol] = []
+            self.trades[symbol] = deque(maxlen=100)
+            mid = instrument['markPrice']
+            half = instrument['tickSize'] * spreadTicks / 2.0
+            self.set_outside_quote(symbol, mid - half, mid + half)
+
+    def add_account(self, apiKey, apiSecret, balance=100000000):
+        with self.lock:
+            account = Account(len(self.accounts) + 1, apiKey, apiSecret, balance)
+            self.accounts[apiKey] = self.accountsByID[account.id] = account
+            return account
+
+    def subscribe(self, listener):
+        '''Register listener(table, action, rows, symbol, account) for every change. account is None for public data.'''
+        self.listeners.append(listener)
+
+    #
+    # Market
+    #
+    def set_outside_quote(self, symbol, bid, ask):
+        '''Move the outside market. Resting orders it moves through are filled at their own price.'''
+        with self.lock:
+            if bid >= ask:
+                raise SimError(400, 'Outside bid must be below ask', 'ValidationError')
+            self.outside[symbol] = [bid, ask]
+            # Buys at or above the new ask and sells at or below the new bid get lifted.
+            for side, crossed in (('Buy', lambda p: p >= ask), ('Sell', lambda p: p <= bid)):
+                for price in [p for p in self.prices[symbol][side] if crossed(p)]:
+                    for order in list(self.books[symbol][side].get(price, ())):
+                        self.__fill(order, order['leavesQty'], price, 'AddedLiquidity')
+            self.__update_instrument(symbol, {'markPrice': (bid + ask) / 2.0, 'indicativeSettlePrice': (bid + ask) / 2.0})
+            self.__publish_market(symbol)
+
+    def walk(self, symbol, ticks):
+        '''Shift the outside quote by a number of ticks, e.g. from a random walk.'''
+        with self.lock:
+            bid, ask = self.outside[symbol]
+            move = ticks * self.instruments[symbol]['tickSize']
+            self.set_outside_quote(symbol, bid + move, ask + move)
+
+    #
+    # Orders
+    #
+    def place_order(self, account, params):
+        with self.lock:
+            symbol = params.get('symbol')
+            instrument = self.instruments.get(symbol)
+            if instrument is None:
+                raise SimError(400, 'Invalid symbol', 'ValidationError')
+            clOrdID = params.get('clOrdID') or ''
+            if clOrdID and (account.id, clOrdID) in self.clOrdIDs:
+                raise SimError(400, 'Duplicate clOrdID', 'ValidationError')
+
+            execInst = params.get('execInst') or params.get('execInsts') or ''
+            ordType = params.get('ordType') or ('Limit' if params.get('price') is not None else 'Market')
+            qty = params.get('orderQty')
+            side = params.get('side')
+            position = self.__position(account, symbol)
+            if qty is None and 'Close' in execInst:
+                qty = -position.ledger.currentQty
+            if qty is None:
+                raise SimError(400, 'orderQty is required', 'ValidationError')
+            if side is None:
+                side = 'Buy' if qty > 0 else 'Sell'
+            qty = abs(qty)
+            if 'Close' in execInst:
+                closable = -position.ledger.currentQty if side == 'Buy' else position.ledger.currentQty
+                if closable <= 0:
+                    raise SimError(400, 'Executing at order price would lead to immediate liquidation or ' +
+                                   'position increase: Close order has no position to close', 'ValidationError')
+                qty = min(qty, closable)
+            if qty <= 0 or qty % instrument['lotSize']:
+                raise SimError(400, 'Invalid orderQty', 'ValidationError')
+            price = params.get('price')
+            if ordType in ('Limit', 'StopLimit') and (price is None or price <= 0):
+                raise SimError(400, 'Invalid price', 'ValidationError')
+            if price is not None and abs(round(price / instrument['tickSize']) * instrument['tickSize'] - price) > 1e-9:
+                raise SimError(400, 'Invalid price tickSize', 'ValidationError')
+
+            now = timestamp()
+            order = {
+                'orderID': str(uuid.uuid4()),
+                'clOrdID': clOrdID,
+                'account': account.id,
+                'symbol': symbol,
+                'side': side,
+                'orderQty': qty,
+                'price': price,
+                'stopPx': params.get('stopPx'),
+                'ordType': ordType,
+                'execInst': execInst,
+                'ordStatus': 'New',
+                'triggered': '',
+                'workingIndicator': False,
+                'leavesQty': qty,
+                'cumQty': 0,
+                'avgPx': None,
+                'text': params.get('text') or 'Submitted via API.',
+                'transactTime': now,
+                'timestamp': now,
+            }
+            self.orders[order['orderID']] = order
+            if clOrdID:
+                self.clOrdIDs[(account.id, clOrdID)] = order
+            self.__emit('order', 'insert', [dict(order)], symbol, account)
+            self.__execution(order, 'New')
+
+            if ordType in ('Stop', 'StopLimit'):
+                self.stops[symbol].append(order)
+            else:
+                self.__work(order)
+            self.__publish_market(symbol)
+            return dict(order)
+
+    def amend_order(self, account, params):
+        with self.lock:
+            order = self.__find_order(account, params.get('orderID'), params.get('origClOrdID'))
+            if order['ordStatus'] not in ('New', 'PartiallyFilled'):
+                raise SimError(400, 'Invalid ordStatus', 'ValidationError')
+            before = dict(order)
+            instrument = self.instruments[order['symbol']]
+            if 'leavesQty' in params:
+                leaves = params['leavesQty']
+            elif 'orderQty' in params:
+                leaves = abs(params['orderQty']) - order['cumQty']
+            else:
+                leaves = order['leavesQty']
+            if leaves <= 0:
+                raise SimError(400, 'Invalid leavesQty', 'ValidationError')
+            price = params.get('price', order['price'])
+            if price is not None and abs(round(price / instrument['tickSize']) * instrument['tickSize'] - price) > 1e-9:
+                raise SimError(400, 'Invalid price tickSize', 'ValidationError')
+
+            resting = order['workingIndicator']
+            if resting:
+                self.__unrest(order)
+            order['price'] = price
+            order['leavesQty'] = leaves
+            order['orderQty'] = order['cumQty'] + leaves
+            if params.get('clOrdID'):
+                order['clOrdID'] = params['clOrdID']
+                self.clOrdIDs[(account.id, params['clOrdID'])] = order
+            if params.get('stopPx') is not None:
+                order['stopPx'] = params['stopPx']
+            order['text'] = 'Amended via API.'
+            order['transactTime'] = order['timestamp'] = timestamp()
+            self.__emit_order_update(before, order)
+            self.__execution(order, 'Replaced')
+            if resting:
+                # A price change loses queue priority; it may also cross the book now.
+                self.__work(order)
+            self.__publish_market(order['symbol'])
+            return dict(order)
+
+    def cancel_orders(self, account, orderIDs=None, clOrdIDs=None, text=None):
+        with self.lock:
+            orders = []
+            for orderID in _as_list(orderIDs):
+                orders.append(self.__find_order(account, orderID, None))
+            for clOrdID in _as_list(clOrdIDs):
+                orders.append(self.__find_order(account, None, clOrdID))
+            canceled = [self.__cancel(order, text or 'Canceled via API.') for order in orders]
+            for symbol in set(o['symbol'] for o in orders):
+                self.__publish_market(symbol)
+            return canceled
+
+    def cancel_all(self, account, symbol=None, filter=None, text=None):
+        '''Cancel all of an account's open orders, or only those on `symbol` / matching `filter`.'''
+        with self.lock:
+            filter = dict(filter or {})
+            if symbol:
+                filter['symbol'] = symbol
+            orders = [o for o in self.orders.values() if o['account'] == account.id and
+                      o['ordStatus'] in ('New', 'PartiallyFilled') and _matches(o, filter)]
+            canceled = [self.__cancel(order, text or 'Canceled via API.') for order in orders]
+            for s in set(o['symbol'] for o in orders):
+                self.__publish_market(s)
+            return canceled
+
+    def cancel_all_after(self, account, timeout):
+        '''Arm (or with timeout 0, disarm) the account's dead man's switch: unless this is called again
+        within `timeout` milliseconds, all its orders are canceled.'''
+        with self.lock:
+            if account.cancelTimer is not None:
+                account.cancelTimer.cancel()
+                account.cancelTimer = None
+            now = datetime.utcnow()
+            if not timeout:
+                return {'now': timestamp(), 'cancelTime': None}
+            account.cancelTimer = threading.Timer(timeout / 1000.0, self.cancel_all, (account,),
+                                                  {'text': 'Canceled: Cancel all after timer expired.'})
+            account.cancelTimer.daemon = True
+            account.cancelTimer.start()
+            cancelTime = now + timedelta(milliseconds=timeout)
+            return {'now': timestamp(), 'cancelTime': cancelTime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}
+
+    def get_orders(self, account, filter=None, symbol=None, count=100, reverse=False):
+        with self.lock:
+            filter = dict(filter or {})
+            if symbol:
+                filter['symbol'] = symbol
+            orders = [o for o in self.orders.values() if o['account'] == account.id and _matches(o, filter)]
+            orders.sort(key=lambda o: o['transactTime'], reverse=bool(reverse))
+            return [dict(o) for o in orders[:count]]
+
+    def set_leverage(self, account, symbol, leverage):
+        with self.lock:
+            if symbol not in self.instruments:
+                raise SimError(400, 'Invalid symbol', 'ValidationError')
+            if not 0 <= leverage <= 100:
+                raise SimError(400, 'Invalid leverage', 'ValidationError')
+            position = self.__position(account, symbol)
+            position.leverage = leverage
+            self.__publish_position(account, symbol)
+            return dict(position.row)
+
+    def get_instruments(self, filter=None, symbol=None):
+        with self.lock:
+            filter = dict(filter or {})
+            if symbol:
+                filter['symbol'] = symbol
+            return [dict(i) for i in self.instruments.values() if _matches(i, filter)]
+
+    #
+    # Websocket images
+    #
+    def image(self, table, symbol=None, account=None):
+        '''Rows for a partial of `table`, filtered to a symbol and/or account like a subscription is.'''
+        with self.lock:
+            symbols = [symbol] if symbol else list(self.instruments)
+            if table == 'instrument':
+                rows = [self.instruments[s] for s in symbols]
+            elif table == 'quote':
+                rows = [self.quotes[s] for s in symbols if s in self.quotes]
+            elif table == 'trade':
+                rows = [t for s in symbols for t in self.trades[s]]
+            elif table in ('orderBookL2', 'orderBookL2_25'):
+                rows = [self.__level_row(s, side, price, size)
+                        for s in symbols for (side, price), size in self.__levels(table, s).items()]
+            elif table == 'order':
+                rows = [o for o in self.orders.values() if o['account'] == account.id and o['symbol'] in symbols and
+                        o['leavesQty'] > 0 and o['ordStatus'] in ('New', 'PartiallyFilled')]
+            elif table == 'execution':
+                rows = []
+            elif table == 'position':
+                rows = [self.__position(account, s).row for s in symbols]
+            elif table == 'margin':
+                rows = [self.__margin_row(account)]
+            else:
+                raise SimError(400, 'Unknown table: %s' % table)
+            return [dict(r) for r in rows]
+
+    #
+    # Private methods
+    #
+    def __emit(self, table, action, rows, symbol=None, account=None):
+        for listener in self.listeners:
+            listener(table, action, rows, symbol, account)
+
+    def __find_order(self, account, orderID, clOrdID):
+        order = self.orders.get(orderID) if orderID else self.clOrdIDs.get((account.id, clOrdID))
+        if order is None or order['account'] != account.id:
+            raise SimError(404, 'Not Found')
+        return order
+
+    def __position(self, account, symbol):
+        position = account.positions.get(symbol)
+        if position is None:
+            position = account.positions[symbol] = Position(account, self.instruments[symbol])
+            position.row = self.__position_row(position)
+        return position
+
+    def __work(self, order):
+        '''Match an order against the book and the outside quote, then rest what's left if it's a limit order.'''
+        symbol, side = order['symbol'], order['side']
+        opposite = 'Sell' if side == 'Buy' else 'Buy'
+        limit = order['price'] if order['ordType'] in ('Limit', 'StopLimit') else None
+
+        if 'ParticipateDoNotInitiate' in order['execInst'] and self.__crosses(symbol, side, limit):
+            self.__cancel(order, 'Canceled: Order had execInst of ParticipateDoNotInitiate')
+            return
+
+        while order['leavesQty'] > 0:
+            restingPrice = self.__best(symbol, opposite)
+            outsidePrice = self.outside[symbol][1 if side == 'Buy' else 0]
+            better = (lambda a, b: a <= b) if side == 'Buy' else (lambda a, b: a >= b)
+            if restingPrice is not None and better(restingPrice, outsidePrice):
+                if limit is not None and not better(restingPrice, limit):
+                    break
+                resting = self.books[symbol][opposite][restingPrice][0]
+                qty = min(order['leavesQty'], resting['leavesQty'])
+                self.__fill(resting, qty, restingPrice, 'AddedLiquidity', printTrade=False)
+                self.__fill(order, qty, restingPrice, 'RemovedLiquidity')
+            else:
+                if limit is not None and not better(outsidePrice, limit):
+                    break
+                self.__fill(order, order['leavesQty'], outsidePrice, 'RemovedLiquidity')
+
+        if order['leavesQty'] > 0:
+            if limit is None:
+                self.__cancel(order, 'Canceled: Market order had no liquidity left')
+            else:
+                self.__rest(order)
+
+    def __crosses(self, symbol, side, price):
+        if price is None:
+            return True
+        if side == 'Buy':
+            best = self.__best(symbol, 'Sell')
+            return price >= self.outside[symbol][1] or (best is not None and price >= best)
+        best = self.__best(symbol, 'Buy')
+        return price <= self.outside[symbol][0] or (best is not None and price <= best)
+
+    def __best(self, symbol, side):
+        prices = self.prices[symbol][side]
+        if not prices:
+            return None
+        return prices[-1] if side == 'Buy' else prices[0]
+
+    def __rest(self, order):
+        symbol, side, price = order['symbol'], order['side'], order['price']
+        level = self.books[symbol][side].get(price)
+        if level is None:
+            level = self.books[symbol][side][price] = deque()
+            bisect.insort(self.prices[symbol][side], price)
+        level.append(order)
+        if not order['workingIndicator']:
+            before = dict(order)
+            order['workingIndicator'] = True
+            self.__emit_order_update(before, order)
+
+    def __unrest(self, order):
+        symbol, side, price = order['symbol'], order['side'], order['price']
+        level = self.books[symbol][side].get(price)
+        if level is None or order not in level:
+            return
+        level.remove(order)
+        if not level:
+            del self.books[symbol][side][price]
+            prices = self.prices[symbol][side]
+            del prices[bisect.bisect_left(prices, price)]
+
+    def __cancel(self, order, text):
+        if order['ordStatus'] not in ('New', 'PartiallyFilled'):
+            return dict(order)
+        before = dict(order)
+        self.__unrest(order)
+        if order in self.stops[order['symbol']]:
+            self.stops[order['symbol']].remove(order)
+        order['ordStatus'] = 'Canceled'
+        order['leavesQty'] = 0
+        order['workingIndicator'] = False
+        order['text'] = text
+        order['transactTime'] = order['timestamp'] = timestamp()
+        self.__emit_order_update(before, order)
+        self.__execution(order, 'Canceled')
+        return dict(order)
+
+    def __fill(self, order, qty, price, liquidity, printTrade=True):
+        '''Fill an order. One public trade is printed per match, so the resting side of a match
+        between two orders passes printTrade=False and the taker's fill prints it.'''
+        symbol = order['symbol']
+        account = self.accountsByID[order['account']]
+        instrument = self.instruments[symbol]
+        before = dict(order)
+        position = self.__position(account, symbol)
+
+        order['avgPx'] = ((order['avgPx'] or 0) * order['cumQty'] + price * qty) / (order['cumQty'] + qty)
+        order['cumQty'] += qty
+        order['leavesQty'] -= qty
+        order['ordStatus'] = 'Filled' if order['leavesQty'] == 0 else 'PartiallyFilled'
+        order['transactTime'] = order['timestamp'] = timestamp()
+        if order['leavesQty'] == 0:
+            self.__unrest(order)
+            order['workingIndicator'] = False
+
+        feeRate = instrument['makerFee'] if liquidity == 'AddedLiquidity' else instrument['takerFee']
+        commission = abs(qty * position.ledger.value(price)) * feeRate
+        realisedBefore = position.ledger.realisedPnl
+        position.ledger.fill(order['side'], qty, price, commission)
+        account.walletBalance += position.ledger.realisedPnl - realisedBefore - commission
+
+        self.__emit_order_update(before, order)
+        self.__execution(order, 'Trade', lastQty=qty, lastPx=price, liquidity=liquidity, commission=commission,
+                         feeRate=feeRate)
+        self.__publish_position(account, symbol)
+        self.__publish_margin(account)
+
+        if printTrade:
+            trade = {'timestamp': order['timestamp'], 'symbol': symbol, 'side': order['side'], 'size': qty,
+                     'price': price, 'trdMatchID': str(uuid.uuid4()),
+                     'grossValue': abs(qty * position.ledger.value(price)),
+                     'homeNotional': abs(qty * position.ledger.value(price)) / 1e8, 'foreignNotional': qty}
+            self.trades[symbol].append(trade)
+            self.__emit('trade', 'insert', [dict(trade)], symbol)
+            self.__update_instrument(symbol, {'lastPrice': price})
+            self.__trigger_stops(symbol, price)
+
+    def __trigger_stops(self, symbol, lastPrice):
+        for order in list(self.stops[symbol]):
+            stopPx = order['stopPx']
+            if stopPx is None:
+                continue
+            if (order['side'] == 'Buy' and lastPrice >= stopPx) or (order['side'] == 'Sell' and lastPrice <= stopPx):
+                self.stops[symbol].remove(order)
+                before = dict(order)
+                order['triggered'] = 'StopOrderTriggered'
+                self.__emit_order_update(before, order)
+                self.__work(order)
+
+    def __execution(self, order, execType, lastQty=0, lastPx=None, liquidity='', commission=0, feeRate=None):
+        row = {
+            'execID': str(uuid.uuid4()),
+            'orderID': order['orderID'],
+            'clOrdID': order['clOrdID'],
+            'account': order['account'],
+            'symbol': order['symbol'],
+            'side': order['side'],
+            'lastQty': lastQty,
+            'lastPx': lastPx,
+            'lastLiquidityInd': liquidity,
+            'orderQty': order['orderQty'],
+            'price': order['price'],
+            'ordType': order['ordType'],
+            'ordStatus': order['ordStatus'],
+            'execType': execType,
+            'leavesQty': order['leavesQty'],
+            'cumQty': order['cumQty'],
+            'avgPx': order['avgPx'],
+            'commission': feeRate,
+            'execComm': commission,
+            'text': order['text'],
+            'transactTime': order['transactTime'],
+            'timestamp': order['timestamp'],
+        }
+        self.__emit('execution', 'insert', [row], order['symbol'], self.accountsByID[order['account']])
+
+    def __emit_order_update(self, before, order):
+        changed = _changed(before, order, self.KEYS['order'])
+        if changed is not None:
+            self.__emit('order', 'update', [changed], order['symbol'], self.accountsByID[order['account']])
+
+    def __position_row(self, position):
+        instrument = self.instruments[position.ledger.symbol]
+        outsideBid, outsideAsk = self.outside.get(position.ledger.symbol, (None, None))
+        marked = position.ledger.mark(outsideBid, outsideAsk, position.leverage)
+        qty = marked['currentQty']
+        entry = marked['avgEntryPrice']
+        liquidation = None
+        if qty and entry and position.leverage:
+            distance = 1.0 / position.leverage - instrument['maintMargin']
+            liquidation = entry * (1 - distance) if qty > 0 else entry * (1 + distance)
+        return {
+            'account': position.account.id,
+            'symbol': position.ledger.symbol,
+            'currency': XBT_CURRENCY,
+            'currentQty': qty,
+            'avgEntryPrice': entry,
+            'avgCostPrice': entry,
+            'markPrice': instrument['markPrice'],
+            'liquidationPrice': liquidation,
+            'leverage': position.leverage,
+            'crossMargin': position.leverage == 0,
+            'isOpen': qty != 0,
+            'homeNotional': abs(qty * position.ledger.value(entry)) / 1e8 if qty and entry else 0,
+            'realisedPnl': marked['realisedPnl'],
+            'unrealisedPnl': marked['unrealisedPnl'],
+            'unrealisedPnlPcnt': round(marked['unrealisedPnlPcnt'], 4),
+            'unrealisedRoePcnt': round(marked['unrealisedRoePcnt'], 4),
+            'timestamp': timestamp(),
+        }
+
+    def __publish_position(self, account, symbol):
+        position = self.__position(account, symbol)
+        before = position.row
+        position.row = self.__position_row(position)
+        changed = _changed(before, position.row, self.KEYS['position'], ignore=('timestamp',))
+        if changed is not None:
+            self.__emit('position', 'update', [changed], symbol, account)
+
+    def __margin_row(self, account):
+        unrealised = sum(p.row.get('unrealisedPnl', 0) for p in account.positions.values())
+        positionMargin = sum(abs(p.row['currentQty'] * p.ledger.value(p.row['avgEntryPrice'])) / (p.leverage or 1)
+                             for p in account.positions.values() if p.row.get('currentQty') and p.row['avgEntryPrice'])
+        marginBalance = account.walletBalance + unrealised
+        return {
+            'account': account.id,
+            'currency': XBT_CURRENCY,
+            'amount': account.walletBalance,
+            'walletBalance': account.walletBalance,
+            'unrealisedPnl': unrealised,
+            'marginBalance': marginBalance,
+            'availableFunds': marginBalance - positionMargin,
+            'timestamp': timestamp(),
+        }
+
+    def __publish_margin(self, account):
+        row = self.__margin_row(account)
+        self.__emit('margin', 'update', [row], None, account)
+
+    def __update_instrument(self, symbol, fields):
+        instrument = self.instruments[symbol]
+        changed = dict((k, v) for k, v in fields.items() if instrument.get(k) != v)
+        if not changed:
+            return
+        changed['timestamp'] = timestamp()
+        instrument.update(changed)
+        changed['symbol'] = symbol
+        self.__emit('instrument', 'update', [changed], symbol)
+
+    def __publish_market(self, symbol):
+        '''Publish the top of book (quote, instrument bid/ask) and L2 level changes after anything moved them.'''
+        bid, ask = self.__top(symbol)
+        quote = {'timestamp': timestamp(), 'symbol': symbol,
+                 'bidSize': self.__size_at(symbol, 'Buy', bid), 'bidPrice': bid,
+                 'askPrice': ask, 'askSize': self.__size_at(symbol, 'Sell', ask)}
+        previous = self.quotes.get(symbol)
+        if previous is None or [previous[k] for k in ('bidPrice', 'bidSize', 'askPrice', 'askSize')] != \
+                [quote[k] for k in ('bidPrice', 'bidSize', 'askPrice', 'askSize')]:
+            self.quotes[symbol] = quote
+            self.__emit('quote', 'insert', [dict(quote)], symbol)
+            self.__update_instrument(symbol, {'bidPrice': bid, 'askPrice': ask, 'midPrice': (bid + ask) / 2.0})
+
+        for table in ('orderBookL2', 'orderBookL2_25'):
+            levels = self.__levels(table, symbol)
+            previous = self.levels.get((table, symbol), {})
+            deleted = [k for k in previous if k not in levels]
+            inserted = [k for k in levels if k not in previous]
+            updated = [k for k in levels if k in previous and previous[k] != levels[k]]
+            if deleted:
+                self.__emit(table, 'delete', [self.__level_key(symbol, side, price) for side, price in deleted], symbol)
+            if inserted:
+                self.__emit(table, 'insert', [self.__level_row(symbol, side, price, levels[(side, price)])
+                                              for side, price in inserted], symbol)
+            if updated:
+                self.__emit(table, 'update', [self.__level_row(symbol, side, price, levels[(side, price)])
+                                              for side, price in updated], symbol)
+            self.levels[(table, symbol)] = levels
+
+    def __top(self, symbol):
+        bid, ask = self.outside[symbol]
+        bestBid, bestAsk = self.__best(symbol, 'Buy'), self.__best(symbol, 'Sell')
+        return max(bid, bestBid) if bestBid is not None else bid, min(ask, bestAsk) if bestAsk is not None else ask
+
+    def __size_at(self, symbol, side, price):
+        size = sum(o['leavesQty'] for o in self.books[symbol][side].get(price, ()))
+        outside = self.outside[symbol][0 if side == 'Buy' else 1]
+        return size + (self.outsideSize if price == outside else 0)
+
+    def __levels(self, table, symbol):
+        levels = {}
+        for side in ('Buy', 'Sell'):
+            prices = list(self.books[symbol][side]) + [self.outside[symbol][0 if side == 'Buy' else 1]]
+            prices = sorted(set(prices), reverse=side == 'Buy')
+            if table == 'orderBookL2_25':
+                prices = prices[:25]
+            for price in prices:
+                levels[(side, price)] = self.__size_at(symbol, side, price)
+        return levels
+
+    def __level_key(self, symbol, side, price):
+        return {'symbol': symbol, 'id': int(round(price * 100)), 'side': side}
+
+    def __level_row(self, symbol, side, price, size):
+        row = self.__level_key(symbol, side, price)
+        row.update({'size': size, 'price': price})
+        return row
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _matches(row, filter):
+    '''Apply a BitMEX REST `filter`: field equality (a list matches any of its values), plus ordStatus.isTerminated
+    and open.'''
+    for key, wanted in filter.items():
+        if key == 'ordStatus.isTerminated':
+            terminated = row.get('ordStatus') in ('Filled', 'Canceled', 'Rejected')
+            if terminated != bool(wanted):
+                return False
+        elif key == 'open':
+            if wanted and row.get('ordStatus') not in ('New', 'PartiallyFilled'):
+                return False
+        elif isinstance(wanted, list):
+            if row.get(key) not in wanted:
+                return False
+        elif row.get(key) != wanted:
+            return False
+    return True
+
+
+def _changed(before, after, keys, ignore=()):
+    '''The fields of `after` that differ from `before`, plus the keys, as a websocket update row.
+    Fields in `ignore` don't count as a change but are sent along with one. None if nothing changed.'''
+    changed = dict((k, v) for k, v in after.items() if k not in ignore and before.get(k) != v)
+    if not changed:
+        return None
+    for k in tuple(keys) + tuple(ignore):
+        if k in after:
+            changed[k] = after[k]
+    return changed
@@ -0,0 +1,523 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import math
+import queue
+import random
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import sleep, time
+from urllib.parse import urlparse, parse_qs
+
+from market_maker.auth.APIKeyAuth import generate_signature
+from market_maker.sim.exchange import Exchange, SimError, makeInstrument
+
+API_PREFIX = '/api/v1/'
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class Faults(object):
+    '''Failures injected by the stand-in server. Fields can be changed while it runs.
+
+    latency (+ up to jitter) seconds is added to every REST request, and wsLatency to every websocket
+    message. rate429 and rate503 are the fraction of REST requests refused with that status;
+    fail_next() queues specific failures. rateLimit is the size of each API key's request bucket, which
+    refills over a minute, as BitMEX enforces with 429s.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, rate429=0.0, rate503=0.0, wsLatency=0.0, rateLimit=120):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate429 = rate429
+        self.rate503 = rate503
+        self.wsLatency = wsLatency
+        self.rateLimit = rateLimit
+        self._next = []
+        self._lock = threading.Lock()
+
+    def fail_next(self, status, count=1):
+        '''Refuse the next `count` REST requests with `status`.'''
+        with self._lock:
+            self._next += [status] * count
+
+    def update(self, fields):
+        for k, v in fields.items():
+            if not hasattr(self, k) or k.startswith('_'):
+                raise SimError(400, 'Unknown fault: %s' % k, 'ValidationError')
+            setattr(self, k, v)
+
+    def rest_delay(self):
+        return self.latency + (random.random() * self.jitter if self.jitter else 0)
+
+    def rest_failure(self):
+        with self._lock:
+            if self._next:
+                return self._next.pop(0)
+        r = random.random()
+        if r < self.rate429:
+            return 429
+        if r < self.rate429 + self.rate503:
+            return 503
+        return None
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    '''A local stand-in for the BitMEX API, for integration and load tests of the bot.
+
+    Serves the REST endpoints the connector uses under /api/v1/ (order GET/POST/PUT/DELETE, order/all,
+    order/cancelAllAfter, position/leverage, instrument), checking API key signatures the way BitMEX does, and the
+    /realtime websocket with partial/insert/update/delete table semantics, backed by an Exchange.
+    Faults (latency, 429/503s, rate limits) are injected from `faults`, and disconnect() drops every
+    websocket. The same controls are exposed over HTTP under /sim/ for tests in another process.
+
+    Point BASE_URL at `server.url` to run the bot against it.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, exchange=None, host='127.0.0.1', port=0, faults=None):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.exchange = exchange or Exchange()
+        self.faults = faults or Faults()
+        self.logger = logging.getLogger('root')
+        self.sessions = set()
+        self.sessionsLock = threading.Lock()
+        self.buckets = {}  # apiKey -> [tokens, time last refilled]
+        self.bucketsLock = threading.Lock()
+        self.exchange.subscribe(self.__publish)
+        self.__thread = None
+        self.__walker = None
+        self.__walking = False
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], API_PREFIX)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__walking = False
+        self.disconnect()
+        self.shutdown()
+        self.server_close()
+
+    def random_walk(self, interval=1.0, maxTicks=2):
+        '''Move every instrument's outside quote by up to maxTicks ticks every interval seconds.'''
+        def walk():
+            while self.__walking:
+                sleep(interval)
+                for symbol in list(self.exchange.instruments):
+                    self.exchange.walk(symbol, random.randint(-maxTicks, maxTicks))
+        self.__walking = True
+        self.__walker = threading.Thread(target=walk)
+        self.__walker.daemon = True
+        self.__walker.start()
+
+    def disconnect(self):
+        '''Drop every websocket connection, as a network blip or exchange restart would.'''
+        with self.sessionsLock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+
+    def account_for(self, apiKey, verb, path, expires, signature, body):
+        '''Authenticate a request like BitMEX: a known key, an unexpired `expires` and a matching signature.'''
+        account = self.exchange.accounts.get(apiKey)
+        if account is None:
+            raise SimError(401, 'Invalid API Key.')
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            raise SimError(401, 'Missing api-expires.')
+        if expires < time():
+            raise SimError(401, 'This request has expired - `expires` is in the past.')
+        expected = generate_signature(account.apiSecret, verb, path, expires, body)
+        if not hmac.compare_digest(expected, signature or ''):
+            raise SimError(401, 'Signature not valid.')
+        return account
+
+    def check_rate_limit(self, apiKey):
+        '''Take a request from the key's bucket. Returns (allowed, remaining, seconds until full, seconds until
+        the next request is allowed).'''
+        limit = self.faults.rateLimit
+        rate = limit / 60.0
+        with self.bucketsLock:
+            now = time()
+            bucket = self.buckets.setdefault(apiKey, [float(limit), now])
+            bucket[0] = min(float(limit), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+            tokens = bucket[0]
+        return allowed, int(tokens), (limit - tokens) / rate, max(1 - tokens, 0) / rate
+
+    def __publish(self, table, action, rows, symbol, account):
+        with self.sessionsLock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.publish(table, action, rows, symbol, account)
+
+
+class _Session(object):
+    '''One /realtime websocket connection: its subscriptions, and a writer thread so a slow client never
+    holds up the exchange.'''
+
+    def __init__(self, server, sock, account):
+        self.server = server
+        self.sock = sock
+        self.account = account
+        self.subscriptions = set()  # (table, symbol or None)
+        self.outbox = queue.Queue()
+        self.closed = False
+        self.writer = threading.Thread(target=self.__write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def send(self, message, opcode=0x1):
+        self.outbox.put((opcode, message if isinstance(message, bytes) else json.dumps(message).encode('utf-8')))
+
+    def publish(self, table, action, rows, symbol, account):
+        if account is not None and account is not self.account:
+            return
+        if (table, symbol) not in self.subscriptions and (table, None) not in self.subscriptions:
+            return
+        self.send({'table': table, 'action': action, 'data': rows})
+
+    def subscribe(self, arg):
+        table, _, symbol = arg.partition(':')
+        symbol = symbol or None
+        exchange = self.server.exchange
+        if table not in exchange.KEYS:
+            return self.send({'success': False, 'error': 'Unknown table: %s' % table, 'subscribe': arg,
+                              'request': {'op': 'subscribe', 'args': [arg]}})
+        if table in exchange.PRIVATE_TABLES and self.account is None:
+            return self.send({'success': False, 'error': 'You are not authorized to subscribe to %s.' % table,
+                              'subscribe': arg, 'request': {'op': 'subscribe', 'args': [arg]}})
+        # Take the image and subscribe under the exchange lock, so no change falls between the two.
+        with exchange.lock:
+            rows = exchange.image(table, symbol, self.account)
+            self.subscriptions.add((table, symbol))
+            self.send({'success': True, 'subscribe': arg, 'request': {'op': 'subscribe', 'args': [arg]}})
+            filter = {}
+            if self.account is not None and table in exchange.PRIVATE_TABLES:
+                filter['account'] = self.account.id
+            if symbol:
+                filter['symbol'] = symbol
+            partial = {'table': table, 'action': 'partial', 'keys': exchange.KEYS[table], 'data': rows}
+            if filter:
+                partial['filter'] = filter
+            self.send(partial)
+
+    def run(self, rfile, subscriptions):
+        self.send({'info': 'Welcome to the BitMEX stand-in Realtime API.', 'timestamp': None})
+        for arg in subscriptions:
+            self.subscribe(arg)
+        try:
+            while not self.closed:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == 0x8:  # Close
+                    self.send(payload, 0x8)
+                    break
+                elif opcode == 0x9:  # Ping
+                    self.send(payload, 0xA)
+                elif opcode == 0x1:
+                    self.__command(payload.decode('utf-8'))
+        except (socket.error, ValueError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.outbox.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def __command(self, text):
+        if text == 'ping':
+            return self.send(b'pong')
+        try:
+            command = json.loads(text)
+        except ValueError:
+            return self.send({'status': 400, 'error': 'Unable to parse request.'})
+        if command.get('op') == 'subscribe':
+            for arg in command.get('args') or []:
+                self.subscribe(arg)
+        elif command.get('op') == 'authKeyExpires':
+            try:
+                apiKey, expires, signature = command['args']
+                self.account = self.server.account_for(apiKey, 'GET', '/realtime', expires, signature, '')
+                self.send({'success': True, 'request': command})
+            except (SimError, ValueError) as e:
+                self.send({'status': 401, 'error': str(e), 'request': command})
+        else:
+            self.send({'status': 400, 'error': 'Unknown or missing op.', 'request': command})
+
+    def __write(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                break
+            if self.server.faults.wsLatency:
+                sleep(self.server.faults.wsLatency)
+            try:
+                self.sock.sendall(_frame(*item))
+            except socket.error:
+                self.close()
+                break
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes; don't hold the body back
+
+    def log_message(self, format, *args):
+        self.server.logger.debug('stand-in: ' + format, *args)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/realtime':
+            return self.__realtime()
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+    #
+    # REST
+    #
+    def __handle(self, verb):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        url = urlparse(self.path)
+        headers = {}
+        try:
+            if url.path.startswith('/sim/'):
+                return self.__respond(200, self.__control(url.path[len('/sim/'):], _json(body)))
+            if not url.path.startswith(API_PREFIX):
+                raise SimError(404, 'Not Found')
+
+            faults = self.server.faults
+            delay = faults.rest_delay()
+            if delay:
+                sleep(delay)
+
+            apiKey = self.headers.get('api-key')
+            account = None
+            if apiKey is not None:
+                account = self.server.account_for(apiKey, verb, self.path, self.headers.get('api-expires'),
+                                                  self.headers.get('api-signature'), body)
+                allowed, remaining, untilFull, untilNext = self.server.check_rate_limit(apiKey)
+                headers = {'X-RateLimit-Limit': faults.rateLimit, 'X-RateLimit-Remaining': remaining,
+                           'X-RateLimit-Reset': int(math.ceil(time() + untilFull))}
+                if not allowed:
+                    headers['Retry-After'] = int(math.ceil(untilNext))
+                    raise SimError(429, 'Rate limit exceeded, retry in %d seconds.' % headers['Retry-After'])
+
+            failure = faults.rest_failure()
+            if failure == 429:
+                headers.update({'X-RateLimit-Reset': int(time()) + 1, 'Retry-After': 1})
+                raise SimError(429, 'Rate limit exceeded, retry in 1 seconds.')
+            elif failure is not None:
+                raise SimError(failure, 'The system is currently overloaded. Please try again later.')
+
+            query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+            params = _json(body) or {}
+            for k, v in query.items():
+                params.setdefault(k, _json(v) if k == 'filter' else v)
+            result = self.__route(verb, url.path[len(API_PREFIX):].strip('/'), account, params)
+            self.__respond(200, result, headers)
+        except SimError as e:
+            self.__respond(e.status, {'error': {'message': e.message, 'name': e.name}}, headers)
+
+    def __route(self, verb, path, account, params):
+        exchange = self.server.exchange
+        if (verb, path) == ('GET', 'instrument'):
+            return exchange.get_instruments(params.get('filter'), params.get('symbol'))
+        if account is None:
+            raise SimError(401, 'Not authenticated.')
+        if path == 'order':
+            if verb == 'GET':
+                return exchange.get_orders(account, params.get('filter'), params.get('symbol'),
+                                           int(params.get('count') or 100), _bool(params.get('reverse')))
+            if verb == 'POST':
+                return exchange.place_order(account, params)
+            if verb == 'PUT':
+                return exchange.amend_order(account, params)
+            if verb == 'DELETE':
+                return exchange.cancel_orders(account, params.get('orderID'), params.get('clOrdID'), params.get('text'))
+        if (verb, path) == ('DELETE', 'order/all'):
+            return exchange.cancel_all(account, params.get('symbol'), params.get('filter'), params.get('text'))
+        if (verb, path) == ('POST', 'order/cancelAllAfter'):
+            return exchange.cancel_all_after(account, int(params.get('timeout') or 0))
+        if (verb, path) == ('POST', 'position/leverage'):
+            return exchange.set_leverage(account, params.get('symbol'), float(params.get('leverage')))
+        raise SimError(404, 'Not Found')
+
+    def __control(self, command, params):
+        server, exchange = self.server, self.server.exchange
+        params = params or {}
+        if command == 'quote':
+            exchange.set_outside_quote(params['symbol'], float(params['bid']), float(params['ask']))
+        elif command == 'faults':
+            server.faults.update(params)
+        elif command == 'fail':
+            server.faults.fail_next(int(params['status']), int(params.get('count', 1)))
+        elif command == 'disconnect':
+            server.disconnect()
+        else:
+            raise SimError(404, 'Not Found')
+        return {'success': True}
+
+    def __respond(self, status, result, headers=None):
+        payload = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    #
+    # Websocket
+    #
+    def __realtime(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key or 'websocket' not in (self.headers.get('Upgrade') or '').lower():
+            return self.__respond(400, {'error': {'message': 'Expected a websocket upgrade', 'name': 'HTTPError'}})
+        account = None
+        if self.headers.get('api-key'):
+            try:
+                account = self.server.account_for(self.headers['api-key'], 'GET', '/realtime',
+                                                  self.headers.get('api-expires'), self.headers.get('api-signature'), '')
+            except SimError as e:
+                return self.__respond(401, {'error': {'message': e.message, 'name': e.name}})
+
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('utf-8')).digest()).decode('utf-8')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        query = parse_qs(urlparse(self.path).query)
+        subscriptions = [s for arg in query.get('subscribe', []) for s in arg.split(',') if s]
+        session = _Session(self.server, self.connection, account)
+        with self.server.sessionsLock:
+            self.server.sessions.add(session)
+        try:
+            session.run(self.rfile, subscriptions)
+        finally:
+            with self.server.sessionsLock:
+                self.server.sessions.discard(session)
+            self.close_connection = True
+
+
+def _read_frame(rfile):
+    '''Read one client websocket frame. Returns (opcode, payload), with fragments joined, or None on EOF.'''
+    message, messageOpcode = b'', None
+    while True:
+        header = rfile.read(2)
+        if len(header) < 2:
+            return None
+        fin, opcode = header[0] & 0x80, header[0] & 0x0F
+        masked, length = header[1] & 0x80, header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', rfile.read(8))[0]
+        mask = rfile.read(4) if masked else None
+        payload = rfile.read(length)
+        if len(payload) < length:
+            return None
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        if opcode >= 0x8:
+            return opcode, payload  # Control frames are never fragmented
+        if opcode:
+            messageOpcode = opcode
+        message += payload
+        if fin:
+            return messageOpcode, message
+
+
+def _frame(opcode, payload):
+    '''Build an unmasked server websocket frame.'''
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _json(text):
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        raise SimError(400, 'Unable to parse JSON', 'ValidationError')
+
+
+def _bool(value):
+    return value in (True, 'true', 'True', '1')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local stand-in BitMEX server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--symbol', action='append', help='instrument to list (repeatable; default XBTUSD)')
+    parser.add_argument('--price', type=float, default=10000.0, help='starting price')
+    parser.add_argument('--tick-size', type=float, default=0.5)
+    parser.add_argument('--api-key', default='standin-key')
+    parser.add_argument('--api-secret', default='standin-secret')
+    parser.add_argument('--balance', type=int, default=100000000, help='starting wallet balance, in XBt')
+    parser.add_argument('--walk', type=float, default=0, help='random walk the price every WALK seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every REST request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate429', type=float, default=0.0, help='fraction of REST requests refused with 429')
+    parser.add_argument('--rate503', type=float, default=0.0, help='fraction of REST requests refused with 503')
+    parser.add_argument('--rate-limit', type=int, default=120, help='REST requests per minute per key')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    exchange = Exchange([makeInstrument(s, args.price, args.tick_size) for s in (args.symbol or ['XBTUSD'])])
+    exchange.add_account(args.api_key, args.api_secret, args.balance)
+    faults = Faults(args.latency, args.jitter, args.rate429, args.rate503, rateLimit=args.rate_limit)
+    server = StandInServer(exchange, args.host, args.port, faults)
+    if args.walk:
+        server.random_walk(args.walk)
+    print('Stand-in BitMEX listening on %s (API key %s)' % (server.url, args.api_key))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,18 @@
+"""JSON decoding for the websocket hot path.
+
+Uses orjson or ujson if one is installed (both are optional), and falls back to the stdlib json module.
+"""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+    BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        BACKEND = 'ujson'
+    except ImportError:
+        loads = json.loads
+        BACKEND = 'json'
@@ -0,0 +1,131 @@
+import threading
+import time
+
+# Priority lanes, most urgent first.
+CANCEL = 0
+AMEND = 1
+CREATE = 2
+OTHER = 3  # Leverage changes and informational calls
+
+LANE_NAMES = ('cancel', 'amend', 'create', 'other')
+
+
+def requestPriority(verb, path):
+    """The lane a REST request belongs in."""
+    path = path.strip('/')
+    if path == 'order/cancelAllAfter':
+        return CANCEL  # Keeping the dead man's switch armed is as urgent as canceling
+    if path.startswith('order'):
+        if verb == 'DELETE':
+            return CANCEL
+        if verb == 'PUT':
+            return AMEND
+        if verb == 'POST':
+            return CREATE
+    return OTHER
+
+
+class RateLimiter(object):
+    """Client-side token bucket mirroring BitMEX's request rate limit, with priority lanes.
+
+    BitMEX gives each key a bucket of `limit` requests that refills over a minute, and reports it on
+    every response (X-RateLimit-Limit / -Remaining / -Reset). We spend a token per request and refill
+    at the same rate, and resynchronise with the headers whenever a response comes back, so we know
+    the budget before the exchange has to tell us with a 429.
+
+    Requests wait for a token in lanes: cancels before amends before creates before everything else.
+    A lane only takes a token while more than its `reserve` remain, so as the budget runs down the
+    least urgent requests stop first and the last tokens are kept for cancels. A request that would
+    wait longer than its maxWait is refused instead (acquire() returns False), which is how amends
+    are dropped rather than queued behind a stale requote.
+    """
+
+    def __init__(self, limit=120, period=60, reserves=(0, 5, 10, 20)):
+        self.limit = limit
+        self.period = period
+        self.reserves = reserves
+        self.tokens = float(limit)
+        self.stamp = time.time()
+        self.reset = None  # Epoch time the exchange says the bucket will be full again
+        self.waiting = [0] * len(reserves)
+        self.inflight = 0
+        self.metrics = {'acquired': [0] * len(reserves), 'dropped': [0] * len(reserves), 'waitSeconds': 0.0}
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=OTHER, maxWait=None):
+        """Take a token for a request in lane `priority`, waiting for one if need be.
+
+        Returns False, without taking a token, if that would mean waiting more than maxWait seconds.
+        Every acquire() that returns True must be followed by a complete() once the request is done."""
+        start = time.time()
+        deadline = None if maxWait is None else start + maxWait
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self.__refill()
+                    wait = self.__wait_time(priority)
+                    if wait <= 0:
+                        self.tokens -= 1
+                        self.inflight += 1
+                        self.metrics['acquired'][priority] += 1
+                        self.metrics['waitSeconds'] += time.time() - start
+                        return True
+                    if deadline is not None and time.time() + wait > deadline:
+                        self.metrics['dropped'][priority] += 1
+                        return False
+                    self._cond.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def complete(self, headers=None):
+        """A request we acquired a token for has finished. Resynchronise with its response's X-RateLimit-*
+        headers, if it got a response. Requests still in flight are assumed not yet counted by the exchange."""
+        with self._cond:
+            self.inflight -= 1
+            remaining = headers.get('X-RateLimit-Remaining') if headers is not None else None
+            if remaining is None:
+                return
+            limit = headers.get('X-RateLimit-Limit')
+            if limit is not None:
+                self.limit = int(limit)
+            reset = headers.get('X-RateLimit-Reset')
+            self.reset = int(reset) if reset is not None else None
+            self.tokens = float(remaining) - self.inflight
+            self.stamp = time.time()
+            self._cond.notify_all()
+
+    def exhausted(self, retryAfter=None):
+        """We were told 429: no tokens left, and none until Retry-After seconds from now if it was given."""
+        with self._cond:
+            self.__refill()
+            rate = self.limit / float(self.period)
+            self.tokens = min(self.tokens, 0.0, 1 - float(retryAfter) * rate if retryAfter else 0.0)
+
+    def budget(self):
+        """{'remaining', 'limit', 'fraction', 'reset', 'waiting'}: the budget as of now, for adapting how
+        often we requote. waiting counts requests queued in each lane."""
+        with self._cond:
+            self.__refill()
+            remaining = max(self.tokens, 0.0)
+            return {
+                'remaining': remaining,
+                'limit': self.limit,
+                'fraction': remaining / self.limit if self.limit else 0.0,
+                'reset': self.reset,
+                'waiting': dict(zip(LANE_NAMES, self.waiting)),
+            }
+
+    def __refill(self):
+        now = time.time()
+        self.tokens = min(float(self.limit), self.tokens + (now - self.stamp) * self.limit / float(self.period))
+        self.stamp = now
+
+    def __wait_time(self, priority):
+        """Seconds until a request in this lane may go, or 0 if it may go now."""
+        # More urgent requests waiting go first.
+        if any(self.waiting[:priority]):
+            return self.period / float(self.limit)
+        needed = min(self.reserves[priority], self.limit - 1) + 1 - self.tokens
+        return needed * self.period / float(self.limit) if needed > 0 else 0
@@ -0,0 +1,268 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.connection import allowed_gai_family
+
+from market_maker.utils.stats import LatencyWindow
+
+# The phases of a request, in order. wait is time spent waiting for rate limit budget and prepare the time
+# spent signing and building it: our own code. dns, connect and tls are only non-zero when the request had
+# to open a new connection rather than reuse a kept-alive one. ttfb runs from the request being sent to its
+# response headers arriving, so is the exchange plus the network; download is the rest of the response.
+PHASES = ('wait', 'prepare', 'dns', 'connect', 'tls', 'ttfb', 'download', 'total')
+
+# Connection phases of the request being sent on this thread, filled in by the timed connections below.
+_connecting = threading.local()
+
+
+class RequestTimer(object):
+    """Times one attempt at a REST request, phase by phase. Mark each phase boundary as it's reached:
+    acquired() once there's rate limit budget, sending() just before the request goes out, then phases()."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.acquiredAt = None
+        self.sendAt = None
+
+    def acquired(self):
+        self.acquiredAt = time.time()
+
+    def sending(self):
+        self.sendAt = time.time()
+        _connecting.phases = {}
+
+    def phases(self, headersAfter=None, connection=None):
+        """{phase: seconds} now that the attempt is over. `headersAfter` is how long after sending the
+        response headers arrived, if they did; `connection` the dns/connect/tls phases if not timed here."""
+        now = time.time()
+        acquiredAt = self.acquiredAt or now
+        sendAt = self.sendAt or now
+        if connection is None:
+            connection = getattr(_connecting, 'phases', None) or {}
+            _connecting.phases = None
+        dns = connection.get('dns', 0.0)
+        connect = connection.get('connect', 0.0)
+        tls = connection.get('tls', 0.0)
+        if headersAfter is None:
+            headersAfter = now - sendAt
+        return {
+            'wait': acquiredAt - self.start,
+            'prepare': sendAt - acquiredAt,
+            'dns': dns,
+            'connect': connect,
+            'tls': tls,
+            'ttfb': max(headersAfter - dns - connect - tls, 0.0),
+            'download': max(now - sendAt - headersAfter, 0.0),
+            'total': now - self.start,
+        }
+
+
+class _Endpoint(object):
+    """What's been recorded for one verb and path."""
+
+    def __init__(self, size):
+        self.phases = dict((phase, LatencyWindow(size)) for phase in PHASES)
+        self.statuses = {}
+        self.retries = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def summary(self):
+        return {
+            'count': self.phases['total'].count,
+            'statuses': dict(self.statuses),
+            'retries': self.retries,
+            'bytesSent': self.bytesSent,
+            'bytesReceived': self.bytesReceived,
+            'phases': dict((phase, window.summary()) for phase, window in self.phases.items()),
+        }
+
+
+class RestStats(object):
+    """Per-endpoint, per-verb latency histograms for REST requests.
+
+    Every attempt at a request is recorded with its phase timings (see PHASES), status code (or
+    'timeout' / 'error' if there was no response), how many retries preceded it and its payload sizes.
+    Each phase keeps a rolling window of the last `size` attempts for p50/p90/p99/max summaries.
+    Attempts taking longer than `slowThreshold` seconds in total are logged with their breakdown.
+    """
+
+    def __init__(self, size=1000, slowThreshold=None):
+        self.size = size
+        self.slowThreshold = slowThreshold
+        self.endpoints = {}  # (verb, path) -> _Endpoint
+        self.logger = logging.getLogger('root')
+        self._lock = threading.Lock()
+
+    def record(self, verb, path, phases, status, retries=0, bytesSent=0, bytesReceived=0):
+        key = (verb, path.strip('/'))
+        with self._lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = _Endpoint(self.size)
+            for phase, seconds in phases.items():
+                endpoint.phases[phase].add(seconds)
+            endpoint.statuses[status] = endpoint.statuses.get(status, 0) + 1
+            endpoint.retries += 1 if retries else 0
+            endpoint.bytesSent += bytesSent
+            endpoint.bytesReceived += bytesReceived
+
+        if self.slowThreshold is not None and phases['total'] > self.slowThreshold:
+            self.logger.warning("Slow request: %s %s took %.3fs (%s), status %s, retry %d, %dB sent, %dB received." % (
+                verb, key[1], phases['total'],
+                ', '.join('%s %.3f' % (phase, phases[phase]) for phase in PHASES[:-1]),
+                status, retries, bytesSent, bytesReceived))
+
+    def summary(self, verb=None, path=None):
+        """{'VERB path': {'count', 'statuses', 'retries', 'bytesSent', 'bytesReceived', 'phases'}}, where
+        phases maps each of PHASES to {'n', 'p50', 'p90', 'p99', 'max'}. Narrowed to `verb` and/or `path`
+        if given. retries counts attempts that were retries of an earlier one."""
+        with self._lock:
+            return dict(('%s %s' % key, endpoint.summary()) for key, endpoint in self.endpoints.items()
+                        if (verb is None or key[0] == verb) and (path is None or key[1] == path.strip('/')))
+
+    def report(self):
+        """A table of total, ttfb and connection-setup percentiles per endpoint, for logging."""
+        lines = ['%-28s %6s %6s  %-26s %-26s %s' % ('endpoint', 'count', 'retry', 'total p50/p90/p99/max ms',
+                                                     'ttfb p50/p90/p99/max ms', 'wait+prepare p90 ms')]
+        for name, endpoint in sorted(self.summary().items()):
+            phases = endpoint['phases']
+            wait = phases['wait']['p90'] or 0.0
+            prepare = phases['prepare']['p90'] or 0.0
+            lines.append('%-28s %6d %6d  %-26s %-26s %.1f' % (name, endpoint['count'], endpoint['retries'],
+                                                             _millis(phases['total']), _millis(phases['ttfb']),
+                                                             (wait + prepare) * 1000))
+        return '\n'.join(lines)
+
+    def dump(self, fileName):
+        """Write summary() to `fileName` as JSON."""
+        with open(fileName, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True, default=str)
+
+
+def _millis(summary):
+    if not summary['n']:
+        return '-'
+    return '/'.join('%.1f' % (summary[p] * 1000) for p in ('p50', 'p90', 'p99', 'max'))
+
+
+#
+# Connection timing for requests. urllib3 resolves and connects in one call, so the timed connections
+# resolve the host themselves first and connect to the address they got.
+#
+class _TimedConnectionMixin(object):
+
+    def connect(self):
+        start = time.time()
+        super(_TimedConnectionMixin, self).connect()
+        phases = getattr(_connecting, 'phases', None)
+        if phases is not None:
+            phases['tls'] = max(time.time() - start - phases.get('dns', 0.0) - phases.get('connect', 0.0), 0.0)
+
+    def _new_conn(self):
+        phases = getattr(_connecting, 'phases', None)
+        if phases is None:
+            return super(_TimedConnectionMixin, self)._new_conn()
+        host = self._dns_host
+        start = time.time()
+        try:
+            addresses = _resolve(host, self.port) or [host]
+        except socket.gaierror:
+            addresses = [host]  # Let urllib3 fail to resolve it and raise its usual error
+        resolved = time.time()
+        # Try each address in turn, as urllib3 does when it resolves the host itself.
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    conn = super(_TimedConnectionMixin, self)._new_conn()
+                    break
+                except ConnectTimeoutError:  # NewConnectionError too
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+        phases['dns'] = resolved - start
+        phases['connect'] = time.time() - resolved
+        return conn
+
+
+def _resolve(host, port):
+    """Every address `host` resolves to that urllib3 would try, in order."""
+    addresses = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host.strip('[]'), port, allowed_gai_family(), socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter whose new connections record their DNS, connect and TLS times for RequestTimer."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+
+def aiohttpTraceConfig():
+    """An aiohttp TraceConfig that fills in the dns/connect/tls phases and 'headersAfter' of the dict passed
+    as a request's trace_request_ctx, for RequestTimer.phases(). aiohttp can't tell TLS from TCP connect
+    time, so both are counted under connect."""
+    import aiohttp
+
+    def phases(context):
+        return context.trace_request_ctx if context.trace_request_ctx is not None else {}
+
+    async def onRequestStart(session, context, params):
+        phases(context)['sent'] = time.time()
+
+    async def onDnsStart(session, context, params):
+        phases(context)['dnsStart'] = time.time()
+
+    async def onDnsEnd(session, context, params):
+        p = phases(context)
+        p['dns'] = time.time() - p.pop('dnsStart', time.time())
+
+    async def onConnectStart(session, context, params):
+        phases(context)['connectStart'] = time.time()
+
+    async def onConnectEnd(session, context, params):
+        p = phases(context)
+        p['connect'] = max(time.time() - p.pop('connectStart', time.time()) - p.get('dns', 0.0), 0.0)
+
+    async def onRequestEnd(session, context, params):
+        p = phases(context)
+        p['headersAfter'] = time.time() - p.get('sent', time.time())
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(onRequestStart)
+    trace.on_dns_resolvehost_start.append(onDnsStart)
+    trace.on_dns_resolvehost_end.append(onDnsEnd)
+    trace.on_connection_create_start.append(onConnectStart)
+    trace.on_connection_create_end.append(onConnectEnd)
+    trace.on_request_end.append(onRequestEnd)
+    return trace
@@ -0,0 +1,87 @@
+import random
+import threading
+import time
+
+# Verbs that are safe to repeat: sending one twice has the same effect as sending it once.
+IDEMPOTENT_VERBS = ('GET', 'DELETE')
+# POSTs that set state rather than create it, so repeating them is harmless too.
+IDEMPOTENT_POSTS = ('order/cancelAllAfter', 'position/leverage', 'position/isolate')
+
+
+def isIdempotent(verb, path):
+    """Whether a REST request may be retried without risking doing it twice."""
+    if verb in IDEMPOTENT_VERBS:
+        return True
+    return verb == 'POST' and path.strip('/') in IDEMPOTENT_POSTS
+
+
+class RetryPolicy(object):
+    """How failed REST requests are retried, shared by every request a client makes.
+
+    Each request gets its own RetryState from start(), so one request's retries never count against
+    another's. Between attempts a request backs off exponentially from `base` seconds, capped at `cap`,
+    with full jitter so requests that failed together don't retry together. Only idempotent requests
+    are retried by default (see isIdempotent), at most `maxRetries` times, and a request gives up once
+    its next attempt couldn't start within `deadline` seconds of the first.
+
+    Retries, give-ups and time spent backing off are counted per endpoint; see metrics().
+    """
+
+    def __init__(self, maxRetries=3, base=0.25, cap=5.0, deadline=30.0):
+        self.maxRetries = maxRetries
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def start(self, verb, path, maxRetries=None):
+        """A RetryState for a new request. `maxRetries` overrides the default for its verb and path."""
+        if maxRetries is None:
+            maxRetries = self.maxRetries if isIdempotent(verb, path) else 0
+        endpoint = verb + ' ' + path.strip('/')
+        self._record(endpoint, 'requests', 1)
+        return RetryState(self, endpoint, maxRetries)
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number `attempt` (0-based): full jitter over a capped exponential."""
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def metrics(self):
+        """{'VERB path': {'requests', 'retries', 'giveUps', 'backoffSeconds'}} since the client started."""
+        with self._lock:
+            return dict((endpoint, dict(counts)) for endpoint, counts in self._metrics.items())
+
+    def _record(self, endpoint, key, value):
+        with self._lock:
+            counts = self._metrics.get(endpoint)
+            if counts is None:
+                counts = self._metrics[endpoint] = {'requests': 0, 'retries': 0, 'giveUps': 0, 'backoffSeconds': 0.0}
+            counts[key] += value
+
+
+class RetryState(object):
+    """Retry bookkeeping for one request, carried from each attempt to the next."""
+
+    def __init__(self, policy, endpoint, maxRetries):
+        self.policy = policy
+        self.endpoint = endpoint
+        self.maxRetries = maxRetries
+        self.retries = 0
+        self.backedOff = 0.0
+        self.started = time.time()
+        self.deadline = self.started + policy.deadline if policy.deadline else None
+
+    def next_delay(self, minDelay=0):
+        """Seconds to back off before the next attempt, at least `minDelay` (e.g. until a rate limit resets),
+        or None if the request should give up: it is out of retries, or the next attempt would start after
+        its deadline."""
+        delay = max(minDelay, self.policy.backoff(self.retries))
+        if self.retries >= self.maxRetries or (self.deadline is not None and time.time() + delay > self.deadline):
+            self.policy._record(self.endpoint, 'giveUps', 1)
+            return None
+        self.retries += 1
+        self.backedOff += delay
+        self.policy._record(self.endpoint, 'retries', 1)
+        self.policy._record(self.endpoint, 'backoffSeconds', delay)
+        return delay
@@ -0,0 +1,38 @@
+from collections import deque
+
+
+class LatencyWindow(object):
+    """Rolling window of the most recent samples (e.g. latencies in seconds), with percentile summaries."""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self.count = 0  # Samples ever added, including those that have left the window
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def last(self):
+        return self._samples[-1] if self._samples else None
+
+    def summary(self, last=None):
+        """Return {'n', 'p50', 'p90', 'p99', 'max'} over the window, or over only the newest `last` samples."""
+        samples = list(self._samples)
+        if last:
+            samples = samples[-last:]
+        if not samples:
+            return {'n': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+        samples.sort()
+        return {
+            'n': len(samples),
+            'p50': percentile(samples, 50),
+            'p90': percentile(samples, 90),
+            'p99': percentile(samples, 99),
+            'max': samples[-1],
+        }
+
+
+def percentile(sortedSamples, p):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    index = int(round(p / 100.0 * (len(sortedSamples) - 1)))
+    return sortedSamples[min(index, len(sortedSamples) - 1)]
@@ -0,0 +1,7 @@
+import datetime
+
+
+def toEpoch(timestamp):
+    """Convert a BitMEX timestamp (e.g. 2019-01-01T00:00:00.000Z) to epoch seconds."""
+    # fromisoformat is much quicker than strptime, but doesn't accept the trailing Z before Python 3.11.
+    return datetime.datetime.fromisoformat(timestamp.rstrip('Z')).replace(tzinfo=datetime.timezone.utc).timestamp()
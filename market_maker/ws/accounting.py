@@ -0,0 +1,98 @@
+import threading
+
+
+class PositionLedger(object):
+    '''Running position and PnL for one instrument, kept locally from our own execution fills.
+
+    The exchange's position row only carries PnL as of its last (throttled) push. The ledger is
+    updated on every fill and marked against the live quote whenever it's read, so the numbers
+    are as current as the feed. Money amounts are in the instrument's settlement currency
+    (XBt for XBT-settled contracts), like the exchange's own fields.
+    '''
+
+    def __init__(self, instrument):
+        self.symbol = instrument['symbol']
+        self.multiplier = float(instrument['multiplier'])
+        self.inverse = bool(instrument.get('isInverse'))
+        self._lock = threading.Lock()
+        self.realisedPnl = 0.0
+        self.fees = 0.0
+        self.reset()
+
+    def value(self, price):
+        '''Value of one contract at `price`, in settlement currency.'''
+        return self.multiplier / price if self.inverse else self.multiplier * price
+
+    def reset(self, qty=0, avgEntryPrice=None):
+        '''Start from a known position, e.g. the exchange's position row. Realised PnL and fees carry on.'''
+        with self._lock:
+            self.currentQty = qty
+            self.cost = qty * self.value(avgEntryPrice) if qty and avgEntryPrice else 0.0
+
+    def fill(self, side, qty, price, commission=0):
+        '''Apply one of our fills. Reducing the position realises PnL against the average entry.'''
+        signed = qty if side == 'Buy' else -qty
+        with self._lock:
+            position = self.currentQty
+            if position == 0 or (position > 0) == (signed > 0):
+                self.cost += signed * self.value(price)
+                self.currentQty += signed
+            else:
+                closed = min(abs(signed), abs(position)) * (1 if position > 0 else -1)
+                entryValue = self.cost / position
+                self.realisedPnl += closed * (self.value(price) - entryValue)
+                self.cost -= closed * entryValue
+                self.currentQty = position - closed
+                # Whatever is left after going flat opens a position the other way.
+                remaining = signed + closed
+                if remaining:
+                    self.cost = remaining * self.value(price)
+                    self.currentQty = remaining
+            self.fees += commission or 0
+
+    def charge(self, amount):
+        '''Book a cash-only amount against the position, e.g. funding. Positive is paid, like execComm.'''
+        with self._lock:
+            self.fees += amount
+
+    def avg_entry_price(self):
+        with self._lock:
+            return self.__avg_entry_price(self.currentQty, self.cost)
+
+    def mark(self, bid, ask, leverage=None):
+        '''Mark the position to market: a long against the bid, a short against the ask.
+
+        Returns a dict using the exchange's position field names (currentQty, avgEntryPrice,
+        unrealisedPnl, unrealisedPnlPcnt, unrealisedRoePcnt, realisedPnl), plus markPrice and fees.
+        ROE is the PnL percentage times leverage.'''
+        with self._lock:
+            qty, cost = self.currentQty, self.cost
+            realised, fees = self.realisedPnl, self.fees
+
+        markPrice = bid if qty > 0 else ask
+        if qty and markPrice:
+            unrealised = qty * self.value(markPrice) - cost
+            pnlPcnt = unrealised / abs(cost)
+        else:
+            unrealised = pnlPcnt = 0.0
+        return {
+            'symbol': self.symbol,
+            'currentQty': qty,
+            'avgEntryPrice': self.__avg_entry_price(qty, cost),
+            'markPrice': markPrice,
+            'unrealisedPnl': unrealised,
+            'unrealisedPnlPcnt': pnlPcnt,
+            'unrealisedRoePcnt': pnlPcnt * (leverage or 1),
+            'realisedPnl': realised,
+            'fees': fees,
+        }
+
+    def __avg_entry_price(self, qty, cost):
+        if not qty or not cost:
+            return None
+        perContract = cost / qty
+        return self.multiplier / perContract if self.inverse else perContract / self.multiplier
+
+    def __repr__(self):
+        return 'PositionLedger(%s, qty=%s, avgEntryPrice=%s, realisedPnl=%s)' % (
+            self.symbol, self.currentQty, self.avg_entry_price(), self.realisedPnl)
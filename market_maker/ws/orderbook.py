@@ -0,0 +1,122 @@
+import bisect
+from itertools import islice
+
+# Websocket tables that carry full-depth L2 books. Either can be opted into on connect.
+ORDERBOOK_TABLES = ('orderBookL2', 'orderBookL2_25')
+
+
+class OrderBook(object):
+    '''Local L2 order book for one symbol, maintained from orderBookL2 / orderBookL2_25.
+
+    Levels are keyed by their BitMEX level id. Each side keeps its prices in an ascending
+    list, plus a price -> size dict, so partial/insert/update/delete never rebuild the book and
+    best bid/ask is a single index lookup. Size-only updates, the bulk of the feed, are a dict
+    write. Adding or removing a price level finds its place with bisect in O(log n) but the list
+    insert or delete is O(n): a memmove over a few hundred levels, cheaper in practice than a tree.
+    '''
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # Bumped on every change so readers can tell if the book moved since they last looked.
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        self._levels = {}  # id -> (side, price)
+        self._sizes = {'Buy': {}, 'Sell': {}}  # price -> size
+        self._prices = {'Buy': [], 'Sell': []}  # ascending
+
+    #
+    # Websocket actions
+    #
+    def partial(self, rows):
+        self.clear()
+        self.insert(rows)
+
+    def insert(self, rows):
+        for row in rows:
+            self.__add_level(row['id'], row['side'], row['price'], row['size'])
+        self.version += 1
+
+    def update(self, rows):
+        for row in rows:
+            level = self._levels.get(row['id'])
+            if level is None:
+                continue  # Level not in the book. Could happen before partial
+            side, price = level
+            if 'price' in row and row['price'] != price:
+                size = row.get('size', self._sizes[side].get(price, 0))
+                self.__remove_level(row['id'])
+                self.__add_level(row['id'], side, row['price'], size)
+            elif 'size' in row:
+                self._sizes[side][price] = row['size']
+        self.version += 1
+
+    def delete(self, rows):
+        for row in rows:
+            self.__remove_level(row['id'])
+        self.version += 1
+
+    #
+    # Data methods
+    #
+    def best_bid(self):
+        '''Return (price, size) of the best bid, or None if the side is empty.'''
+        return self.__level_at('Buy', -1)
+
+    def best_ask(self):
+        '''Return (price, size) of the best ask, or None if the side is empty.'''
+        return self.__level_at('Sell', 0)
+
+    def depth(self, n=25):
+        '''Return the top n levels of each side, best first, as lists of [price, size].'''
+        return {
+            'symbol': self.symbol,
+            'bids': [[p, self._sizes['Buy'].get(p, 0)] for p in self.__top_prices('Buy', n)],
+            'asks': [[p, self._sizes['Sell'].get(p, 0)] for p in self.__top_prices('Sell', n)],
+        }
+
+    def cumulative_size(self, side, n=None):
+        '''Sum the size of the top n levels on a side ('Buy' or 'Sell'). All levels if n is None.'''
+        sizes = self._sizes[side]
+        if n is None:
+            return sum(sizes.values())
+        return sum(sizes.get(p, 0) for p in self.__top_prices(side, n))
+
+    def __len__(self):
+        return len(self._levels)
+
+    #
+    # Private methods
+    #
+    def __add_level(self, levelID, side, price, size):
+        self._levels[levelID] = (side, price)
+        sizes = self._sizes[side]
+        if price not in sizes:
+            bisect.insort(self._prices[side], price)
+        sizes[price] = size
+
+    def __remove_level(self, levelID):
+        level = self._levels.pop(levelID, None)
+        if level is None:
+            return
+        side, price = level
+        if self._sizes[side].pop(price, None) is not None:
+            prices = self._prices[side]
+            i = bisect.bisect_left(prices, price)
+            if i < len(prices) and prices[i] == price:
+                del prices[i]
+
+    def __top_prices(self, side, n):
+        # Bids are best at the end of the list, asks at the start. Walk without copying the list.
+        prices = self._prices[side]
+        if side == 'Buy':
+            return islice(reversed(prices), n)
+        return islice(prices, n)
+
+    def __level_at(self, side, index):
+        try:
+            price = self._prices[side][index]
+        except IndexError:
+            return None
+        return price, self._sizes[side].get(price, 0)
@@ -0,0 +1,109 @@
+import threading
+import time
+
+
+class OrderState(object):
+    '''Our open orders as we've asked for them to be, not just as the websocket has reported them.
+
+    A REST call that creates, amends or cancels an order returns the order as the exchange left it,
+    but the websocket's order table only catches up when the matching update arrives. In between, a
+    loop reading the table sees the old price and quantity (or a canceled order still open, or a new
+    one missing) and requotes against a book that no longer exists.
+
+    acked() keeps those REST responses as pending rows, and open_orders() lays them over the table.
+    Rows are matched by orderID, and by their exchange `timestamp`: whichever of the acked row and
+    the websocket's row is newer wins. Register on_ws() for the order table and each pending row is
+    dropped as soon as the websocket shows that order at the same or a later timestamp. A pending row
+    the websocket never confirms is dropped after `ttl` seconds, so a lost update can't pin a stale
+    order in place for good.
+    '''
+
+    def __init__(self, ttl=10, clock=time):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.pending = {}  # orderID -> (acked at, row), in the order they were acked
+        self.seen = {}  # orderID -> (seen at, timestamp of the newest websocket row for it)
+        self.metrics = {'acked': 0, 'stale': 0, 'confirmed': 0, 'expired': 0}
+
+    def acked(self, orders):
+        '''Apply orders as a REST call returned them. Anything that isn't an order row, like the
+        exception a failed request in a batch raised, is skipped.'''
+        now = self.clock.time()
+        with self._lock:
+            for order in orders:
+                if not isinstance(order, dict) or 'orderID' not in order:
+                    continue
+                seen = self.seen.get(order['orderID'])
+                if seen is not None and not newer(order, seen[1]):
+                    self.metrics['stale'] += 1  # The websocket already has this or something later
+                    continue
+                self.pending.pop(order['orderID'], None)
+                self.pending[order['orderID']] = (now, order)
+                self.metrics['acked'] += 1
+
+    def on_ws(self, table, action, rows):
+        '''Callback for ws.on('order'): drop pending rows the websocket has caught up with.'''
+        now = self.clock.time()
+        with self._lock:
+            for row in rows:
+                orderID = row.get('orderID')
+                if orderID is None:
+                    continue
+                timestamp = row.get('timestamp')
+                seen = self.seen.get(orderID)
+                if seen is None or timestamp is None or newer(row, seen[1]):
+                    self.seen[orderID] = (now, timestamp)
+                pending = self.pending.get(orderID)
+                if pending is not None and not newer(pending[1], timestamp):
+                    del self.pending[orderID]
+                    self.metrics['confirmed'] += 1
+
+    def open_orders(self, confirmed, clOrdIDPrefix, symbol=None):
+        '''`confirmed`, the open orders in the websocket's table, with pending acks laid over them:
+        amended orders at their new price and quantity, canceled and filled ones gone, and new ones
+        added. Acks land in whatever order their requests finished, so the result is sorted by
+        outermostFirst() rather than kept in table order.'''
+        with self._lock:
+            self.__expire()
+            if not self.pending:
+                return outermostFirst(confirmed)
+            pending = dict((orderID, row) for orderID, (_, row) in self.pending.items())
+
+        orders = []
+        for order in confirmed:
+            ack = pending.pop(order['orderID'], None)
+            if ack is None or not newer(ack, order.get('timestamp')):
+                orders.append(order)
+            elif ack.get('leavesQty', 0) > 0:
+                orders.append(ack)
+        # Whatever's left hasn't appeared on the websocket yet.
+        orders += [o for o in pending.values()
+                   if o.get('leavesQty', 0) > 0 and
+                   str(o.get('clOrdID')).startswith(clOrdIDPrefix) and
+                   (symbol is None or o.get('symbol') == symbol)]
+        return outermostFirst(orders)
+
+    def __expire(self):
+        cutoff = self.clock.time() - self.ttl
+        for orderID, (ackedAt, _) in list(self.pending.items()):
+            if ackedAt < cutoff:
+                del self.pending[orderID]
+                self.metrics['expired'] += 1
+        for orderID, (seenAt, _) in list(self.seen.items()):
+            if seenAt < cutoff:
+                del self.seen[orderID]
+
+
+def newer(order, timestamp):
+    '''Whether `order` is more recent than an exchange `timestamp`. Without both timestamps to compare,
+    the websocket is taken to be right.'''
+    if timestamp is None or order.get('timestamp') is None:
+        return False
+    return order['timestamp'] > timestamp
+
+
+def outermostFirst(orders):
+    '''Buys then sells, each side from the price furthest from the market inwards, the way the market
+    maker lays out its ladders.'''
+    return sorted(orders, key=lambda o: (o['side'] != 'Buy', o['price'] if o['side'] == 'Buy' else -o['price']))
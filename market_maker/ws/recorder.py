@@ -0,0 +1,113 @@
+import glob
+import gzip
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+
+
+class FrameRecorder(object):
+    '''Capture of the raw websocket frame stream, for debugging and backtests.
+
+    Every frame is written exactly as received, with its local receive time, as one line of
+    "<epoch seconds>\\t<frame>" in gzip-compressed, append-only files. A file is closed and a new one
+    started once maxBytes of frames have gone into it. Writing happens on a background thread:
+    record() only queues the frame, and if the writer falls so far behind that the queue is full,
+    frames are dropped (and counted) rather than blocking the socket reader.
+    '''
+
+    def __init__(self, directory, maxBytes=100 * 1024 * 1024, queueSize=100000, prefix='frames'):
+        self.logger = logging.getLogger('root')
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.prefix = prefix
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(queueSize)
+        self._file = None
+        self._fileBytes = 0
+        self._files = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, received, frame):
+        '''Queue a frame for writing. Never blocks.'''
+        try:
+            self._queue.put_nowait((received, frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        '''Write out whatever is queued and close the current file.'''
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    #
+    # Private methods
+    #
+    def __run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                # Idle: push buffered frames to disk so a crash loses as little as possible.
+                if self._file is not None:
+                    self._file.flush()
+                continue
+            if item is None:
+                break
+            try:
+                self.__write(*item)
+            except Exception:
+                self.dropped += 1
+                self.logger.exception("Unable to record websocket frame.")
+        self.__close_file()
+
+    def __write(self, received, frame):
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+        line = ('%.6f\t%s\n' % (received, frame)).encode('utf-8')
+        if self._file is None or self._fileBytes >= self.maxBytes:
+            self.__rotate()
+        self._file.write(line)
+        self._fileBytes += len(line)
+        self.written += 1
+
+    def __rotate(self):
+        self.__close_file()
+        self._files += 1
+        name = '%s-%s-%03d.log.gz' % (self.prefix, datetime.utcnow().strftime('%Y%m%d-%H%M%S'), self._files)
+        path = os.path.join(self.directory, name)
+        self.logger.info("Recording websocket frames to %s", path)
+        self._file = gzip.open(path, 'ab')
+        self._fileBytes = 0
+
+    def __close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def readFrames(path, prefix='frames'):
+    '''Lazily yield (received, frame) pairs from a FrameRecorder capture, in the order they were recorded.
+
+    `path` is a single capture file, or a directory whose capture files are read oldest first.
+    `received` is the local receive time in epoch seconds; `frame` is the raw frame text.'''
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, prefix + '-*.log.gz')))
+    else:
+        paths = [path]
+    for p in paths:
+        with gzip.open(p, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # Partly written last line
+                    received, frame = line.rstrip('\n').split('\t', 1)
+                    yield float(received), frame
+            except EOFError:
+                pass  # The recorder didn't get to close this file, e.g. the bot was killed
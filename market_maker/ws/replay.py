@@ -0,0 +1,106 @@
+import argparse
+import threading
+from time import sleep, time
+
+from market_maker.ws.recorder import readFrames
+
+
+class VirtualClock(object):
+    '''Time as seen by a replayed websocket.
+
+    With no speed, frames are replayed as fast as possible and the clock reads the recorded receive
+    time of the frame being replayed, so a replay is deterministic. With a speed multiple, the clock
+    runs that many times faster than wall time from the first frame, and replay waits for it to
+    reach each frame's receive time.
+    '''
+
+    def __init__(self, speed=None):
+        self.speed = speed
+        self._virtual = None  # Receive time of the last frame replayed
+        self._start = None  # (virtual, wall) time of the first frame
+
+    def now(self):
+        if self._start is None:
+            return time()
+        if not self.speed:
+            return self._virtual
+        virtual, wall = self._start
+        return virtual + (time() - wall) * self.speed
+
+    def advance(self, received):
+        '''Move the clock to a frame's receive time, waiting for it if we're replaying at a speed.'''
+        if self._start is None:
+            self._start = (received, time())
+        elif self.speed:
+            virtual, wall = self._start
+            delay = (received - virtual) / self.speed - (time() - wall)
+            if delay > 0:
+                sleep(delay)
+        self._virtual = received
+
+
+class ReplayApp(object):
+    '''Stands in for websocket.WebSocketApp, feeding the frames of a FrameRecorder capture to the same
+    callbacks instead of reading them off a socket. The capture plays once; then the "socket" closes.'''
+
+    def __init__(self, path, clock, on_message=None, on_open=None, on_close=None, on_error=None):
+        self.path = path
+        self.clock = clock
+        self.on_message = on_message
+        self.on_open = on_open
+        self.on_close = on_close
+        self.on_error = on_error
+        self.sock = None
+        self.frames = 0
+        self._closed = threading.Event()
+
+    def run_forever(self, **kwargs):
+        self.sock = _ReplaySocket()
+        self.on_open()
+        try:
+            for received, frame in readFrames(self.path):
+                if self._closed.is_set():
+                    break
+                self.clock.advance(received)
+                self.on_message(frame)
+                self.frames += 1
+        except Exception as e:
+            self.on_error(e)
+        self.sock.connected = False
+        self.on_close()
+
+    def send(self, data):
+        pass  # Nobody is listening
+
+    def close(self):
+        self._closed.set()
+
+
+class _ReplaySocket(object):
+    connected = True
+
+
+if __name__ == "__main__":
+    # Benchmark the message handling path on recorded traffic.
+    from market_maker.settings import settings
+    from market_maker.ws.ws_thread import BitMEXWebsocket
+
+    parser = argparse.ArgumentParser(description='Replay a websocket capture through BitMEXWebsocket')
+    parser.add_argument('path', help='capture file or directory written by FrameRecorder')
+    parser.add_argument('--speed', type=float, default=None, help='replay speed multiple (default: as fast as possible)')
+    parser.add_argument('--symbol', default=settings.SYMBOL)
+    parser.add_argument('--auth', action='store_true', help='the capture includes account tables')
+    args = parser.parse_args()
+
+    settings.WS_REPLAY_PATH = args.path
+    settings.WS_REPLAY_SPEED = args.speed
+    ws = BitMEXWebsocket()
+    start = time()
+    ws.connect(settings.BASE_URL, args.symbol, shouldAuth=args.auth, orderBookTable=settings.ORDERBOOK_TABLE)
+    while not ws.exited:  # Set once the last frame has been applied
+        ws.wait_for_update(timeout=1)
+    elapsed = time() - start
+    stats = ws.queue_stats()
+    print('%d frames in %.2fs: %.0f frames/sec' % (ws.ws.frames, elapsed, ws.ws.frames / elapsed))
+    print('apply time per batch: %s' % stats['applySeconds'])
+    print('feed lag (quote): %s' % ws.feed_lag('quote'))
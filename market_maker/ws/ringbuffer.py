@@ -0,0 +1,109 @@
+from array import array
+from collections import deque
+from itertools import islice
+from market_maker.utils.timestamps import toEpoch
+
+
+class RingBuffer(object):
+    '''Fixed-capacity history of websocket rows (trades, quotes, executions).
+
+    Backed by a bounded deque, so inserting is O(1) and the oldest rows fall off the far end
+    as new ones arrive, without the periodic slice copies a trimmed list needs. Iteration,
+    indexing and len() behave like the list it replaces.
+    '''
+
+    def __init__(self, capacity, rows=()):
+        self._rows = deque(rows, maxlen=capacity)
+
+    @property
+    def capacity(self):
+        return self._rows.maxlen
+
+    def insert(self, rows):
+        self._rows.extend(rows)
+
+    def last(self, n):
+        '''Return the newest n rows, oldest first.'''
+        if n <= 0:
+            return []
+        newest = list(islice(reversed(self._rows), n))
+        newest.reverse()
+        return newest
+
+    def remove(self, row):
+        try:
+            self._rows.remove(row)
+        except ValueError:
+            pass
+
+    def clear(self):
+        self._rows.clear()
+
+    # The websocket thread appends while the main thread reads, and a deque refuses to be
+    # iterated while it's mutated. Copying it into a list is a single C-level operation.
+    def __iter__(self):
+        return iter(list(self._rows))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._rows)[index]
+        return self._rows[index]
+
+    def __repr__(self):
+        return 'RingBuffer(%d, %r)' % (self.capacity, list(self._rows))
+
+
+class ColumnarRingBuffer(object):
+    '''Fixed-capacity, array-backed history of selected numeric columns.
+
+    Each column is a preallocated array of doubles written in place, so strategy code can pull
+    e.g. the last 100 trade prices as one array slice instead of walking a list of dicts.
+    'timestamp' columns are stored as epoch seconds; missing values are stored as NaN.
+    '''
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = tuple(columns)
+        self._arrays = dict((c, array('d', [0.0]) * capacity) for c in self.columns)
+        self._head = 0  # Next index to write
+        self._count = 0
+
+    def insert(self, rows):
+        for row in rows:
+            i = self._head
+            for c in self.columns:
+                self._arrays[c][i] = _to_float(c, row.get(c))
+            self._head = (i + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def column(self, name, n=None):
+        '''Return the newest n values of a column (all stored values if n is None), oldest first.'''
+        values = self._arrays[name]
+        if n is None or n > self._count:
+            n = self._count
+        if n <= 0:
+            return array('d')
+        start = (self._head - n) % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            return values[start:end]
+        return values[start:] + values[:end - self.capacity]
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+def _to_float(column, value):
+    if value is None:
+        return float('nan')
+    if column == 'timestamp':
+        return toEpoch(value)
+    return float(value)
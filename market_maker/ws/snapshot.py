@@ -0,0 +1,54 @@
+class Snapshot(object):
+    '''An immutable, internally consistent view of the websocket's account and instrument tables.
+
+    A new Snapshot is built when one is asked for and a table has changed since the last, copying
+    only the changed tables and sharing the rest, and published by swapping a single attribute.
+    Readers holding one never see it change or a table half-updated. Published rows are never
+    mutated: the websocket replaces a keyed row on update instead of changing it in place.
+    '''
+
+    __slots__ = ('seq', 'versions', 'tables', 'instruments')
+
+    def __init__(self, seq=0, versions=None, tables=None, instruments=None):
+        self.seq = seq  # Bumped once per published snapshot
+        self.versions = versions or {}  # table -> number of times it has changed
+        self.tables = tables or {}  # table -> tuple of rows
+        self.instruments = instruments or {}  # symbol -> instrument
+
+    def changed_since(self, other):
+        '''Return the set of tables that changed between `other` (an older Snapshot, or None) and this one.'''
+        if other is None:
+            return set(self.versions)
+        return set(t for t, v in self.versions.items() if other.versions.get(t) != v)
+
+    def table(self, name):
+        if name == 'instrument':
+            return tuple(self.instruments.values())
+        return self.tables.get(name, ())
+
+    #
+    # Data methods, matching BitMEXWebsocket's
+    #
+    def get_instrument(self, symbol):
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            raise Exception("Unable to find instrument or index with symbol: " + symbol)
+        return instrument
+
+    def funds(self):
+        return self.tables['margin'][0]
+
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        # Filter orders with safe key access
+        return [o for o in self.tables.get('order', ())
+                if o.get('clOrdID') and
+                str(o.get('clOrdID')).startswith(clOrdIDPrefix) and
+                o.get('leavesQty', 0) > 0 and
+                (symbol is None or o.get('symbol') == symbol)]
+
+    def position(self, symbol):
+        pos = [p for p in self.tables.get('position', ()) if p['symbol'] == symbol]
+        if len(pos) == 0:
+            # No position found; stub it
+            return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
+        return pos[0]
@@ -0,0 +1,63 @@
+class KeyedTable(object):
+    '''A websocket table indexed by the keys sent on its partial.
+
+    Rows are stored in a dict from the tuple of key values to the row itself, so finding,
+    updating and deleting a row is O(1) instead of a scan over the whole table. Dicts keep
+    insertion order, so iterating, indexing and len() still behave like the plain list that
+    readers such as open_orders() and position() expect.
+    '''
+
+    def __init__(self, keys, rows=()):
+        self.keys = list(keys)
+        self._rows = {}
+        self.insert(rows)
+
+    def key_for(self, row):
+        '''Return the index key for a row (or for an update/delete message carrying the keys).'''
+        return tuple(row[k] for k in self.keys)
+
+    def insert(self, rows):
+        for row in rows:
+            self._rows[self.key_for(row)] = row
+
+    def find(self, matchData):
+        '''Return the stored row matching the keys in matchData, or None.'''
+        return self._rows.get(self.key_for(matchData))
+
+    def remove(self, matchData):
+        '''Remove and return the stored row matching the keys in matchData, or None.'''
+        return self._rows.pop(self.key_for(matchData), None)
+
+    def clear(self):
+        self._rows.clear()
+
+    # List-style read access. The websocket thread mutates the table while the main thread
+    # reads it, so iteration works on a copy of the rows: copying dict values into a list is
+    # a single C-level operation and can't be interleaved with a writer.
+    def __iter__(self):
+        return iter(list(self._rows.values()))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        return list(self._rows.values())[index]
+
+    def __repr__(self):
+        return 'KeyedTable(%r, %r)' % (self.keys, list(self._rows.values()))
+
+
+class TableStore(object):
+    '''Everything the websocket builds from table messages: rows, partial keys, L2 books, columnar history
+    and the symbol -> instrument index.
+
+    Kept together so a reconnect can fill a fresh store while readers keep using the old one.'''
+
+    def __init__(self):
+        self.data = {}
+        self.keys = {}
+        self.books = {}
+        self.columns = {}
+        self.instruments = {}
+        # (table, symbol) for every partial received; symbol is None for unfiltered tables.
+        self.partials = set()
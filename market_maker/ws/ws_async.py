@@ -0,0 +1,156 @@
+import asyncio
+from time import time
+
+import aiohttp
+
+from market_maker.settings import settings
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+
+class AsyncBitMEXWebsocket(BitMEXWebsocket):
+    '''BitMEXWebsocket with its socket read on an asyncio event loop instead of a thread.
+
+    Tables, snapshots, tickers, callbacks, reconnect/resync and position accounting are all the
+    threaded client's: only the transport differs. Frames are applied on the event loop as they
+    arrive (there is no applier thread), so one loop can run any number of connections.
+    The data methods (get_ticker, open_orders, position, ...) are plain calls; connect(),
+    wait_for_update() and close() are coroutines.
+
+    Requires aiohttp.
+    '''
+
+    APPLIER_THREAD = False
+
+    def __init__(self):
+        self.ws = _AsyncApp()
+        self.__wakeup = None  # Made in connect(), on the loop that will run us
+        self.__task = None
+        self.__session = None
+        self.__ownSession = False
+        BitMEXWebsocket.__init__(self)
+
+    async def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, orderBookTable=None, session=None):
+        '''Connect and wait for every image, as BitMEXWebsocket.connect() does.
+
+        Pass an aiohttp `session` to share its connection pool; otherwise one is made and closed with us.'''
+        if settings.WS_REPLAY_PATH:
+            raise ValueError("Replaying a capture is only supported by the threaded BitMEXWebsocket.")
+        wsURL = self._prepare(endpoint, symbol, shouldAuth, orderBookTable)
+        self.__wakeup = asyncio.Event()
+        self.__ownSession = session is None
+        self.__session = session or aiohttp.ClientSession()
+        self.logger.info("Connecting to %s" % wsURL)
+        self.__task = asyncio.ensure_future(self.__run(wsURL))
+
+        # The first connection gets the same 5s as the threaded client; then wait for partials.
+        deadline = time() + 5
+        while not self.ws.connected and not self.exited and time() < deadline:
+            await self.__wait(deadline - time())
+        if not self.ws.connected or self._error:
+            self.logger.error("Couldn't connect to WS! Exiting.")
+            await self.close()
+            raise ConnectionError("Couldn't connect to %s" % wsURL)
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+        while not self._images_ready() and not self.exited:
+            await self.__wait()
+        self._ready()
+
+    async def wait_for_update(self, tables=None, timeout=None):
+        '''Wait until one of `tables` changes (any table if None); see BitMEXWebsocket.wait_for_update().'''
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            changed = BitMEXWebsocket.wait_for_update(self, tables, 0)
+            if changed or self.exited:
+                return changed
+            remaining = None if deadline is None else deadline - time()
+            if remaining is not None and remaining <= 0:
+                return changed
+            await self.__wait(remaining)
+
+    def exit(self):
+        BitMEXWebsocket.exit(self)
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    async def close(self):
+        '''Exit and wait for the socket (and our own HTTP session) to close.'''
+        self.exit()
+        if self.__task is not None:
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+        if self.__ownSession and self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    #
+    # Transport
+    #
+    def _on_message(self, message):
+        BitMEXWebsocket._on_message(self, message)
+        self.__wakeup.set()
+
+    def _on_open(self):
+        BitMEXWebsocket._on_open(self)
+        self.__wakeup.set()
+
+    async def __wait(self, timeout=None):
+        self.__wakeup.clear()
+        try:
+            await asyncio.wait_for(self.__wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __run(self, wsURL):
+        '''Read the socket until it closes, then reconnect in place like BitMEXWebsocket.__run.'''
+        while not self.exited:
+            # Fresh headers each time so the auth signature hasn't expired.
+            headers = dict(h.split(':', 1) for h in self._auth_headers())
+            headers = dict((k.strip(), v.strip()) for k, v in headers.items())
+            try:
+                async with self.__session.ws_connect(wsURL, headers=headers,
+                                                     heartbeat=settings.WS_PING_INTERVAL or None) as ws:
+                    self.ws.attach(ws)
+                    self._on_open()
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._on_message(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            raise ws.exception()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._on_error(e)
+            finally:
+                self.ws.attach(None)
+            self._on_close()
+            self.__wakeup.set()
+
+            delay = self._reconnect_delay()
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+
+class _AsyncApp(object):
+    '''What BitMEXWebsocket expects of self.ws (send, close, sock), over an aiohttp websocket.'''
+
+    def __init__(self):
+        self.socket = None
+        self.sock = self
+
+    @property
+    def connected(self):
+        return self.socket is not None and not self.socket.closed
+
+    def attach(self, socket):
+        self.socket = socket
+
+    def send(self, data):
+        if self.connected:
+            asyncio.ensure_future(self.socket.send_str(data))
+
+    def close(self):
+        if self.connected:
+            asyncio.ensure_future(self.socket.close())
@@ -1,16 +1,27 @@
 import sys
 import websocket
+import queue
 import threading
 import traceback
 import ssl
-from time import sleep
+from time import sleep, time
 import json
 import decimal
 import logging
 from market_maker.settings import settings
-from market_maker.auth.APIKeyAuth import generate_expires, generate_signature
+from market_maker.auth import RequestSigner, generate_expires
+from market_maker.utils import fastjson
 from market_maker.utils.log import setup_custom_logger
+from market_maker.utils.stats import LatencyWindow
+from market_maker.utils.timestamps import toEpoch
 from market_maker.utils.math import toNearest
+from market_maker.ws.accounting import PositionLedger
+from market_maker.ws.orderbook import OrderBook, ORDERBOOK_TABLES
+from market_maker.ws.recorder import FrameRecorder
+from market_maker.ws.replay import ReplayApp, VirtualClock
+from market_maker.ws.ringbuffer import RingBuffer, ColumnarRingBuffer
+from market_maker.ws.snapshot import Snapshot
+from market_maker.ws.table import KeyedTable, TableStore
 from future.utils import iteritems
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
@@ -30,26 +41,89 @@ class BitMEXWebsocket():
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
+    # History tables are held in fixed-size ring buffers. Capacity per table comes from
+    # settings.HISTORY_TABLE_LEN, falling back to MAX_TABLE_LEN.
+    # With settings.COLUMNAR_HISTORY, these columns are also kept in arrays (see get_columns()).
+    HISTORY_COLUMNS = {
+        'trade': ('timestamp', 'price', 'size'),
+        'quote': ('timestamp', 'bidPrice', 'bidSize', 'askPrice', 'askSize'),
+        'execution': ('timestamp', 'lastPx', 'lastQty'),
+    }
+
+    # Tables published to readers as immutable Snapshots (see snapshot()).
+    SNAPSHOT_TABLES = ('order', 'position', 'margin', 'instrument')
+
+    # Tables whose exchange timestamps we compare against local receive time (see feed_lag()).
+    LAG_TABLES = ('quote', 'trade')
+
+    # (table, action) pairs whose queued messages are merged into one apply (see coalesceMessages()).
+    COALESCE = frozenset([('quote', 'insert'), ('instrument', 'update')])
+
+    # Whether frames may be handed to an applier thread (settings.WS_APPLY_QUEUE). Transports that
+    # read on an event loop apply frames there instead.
+    APPLIER_THREAD = True
+
     def __init__(self):
         self.logger = logging.getLogger('root')
+        # Message dispatch, built once rather than walking an if/elif chain on every frame.
+        self.__actionHandlers = {
+            'partial': self.__on_partial,
+            'insert': self.__on_insert,
+            'update': self.__on_update,
+            'delete': self.__on_delete,
+        }
+        self.__tableHandlers = dict((t, self.__apply_orderbook) for t in ORDERBOOK_TABLES)
+        # Callbacks registered through on(), keyed by (table, action). An action of None matches all actions.
+        self.__callbacks = {}
         self.__reset()
+        self.on('execution', 'insert', self.__log_executions)
+        # Local position accounting: seeded from the position image, then advanced by our fills.
+        self.on('position', 'partial', self.__seed_ledgers)
+        self.on('execution', 'insert', self.__account_executions)
 
     def __del__(self):
         self.exit()
 
-    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True):
-        '''Connect to the websocket and initialize data stores.'''
+    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, orderBookTable=None):
+        '''Connect to the websocket and initialize data stores.
+
+        symbol may be a single symbol or a list of them, all served from this one connection.
+        The first one is self.symbol.
+        Pass orderBookTable='orderBookL2' or 'orderBookL2_25' to maintain a local L2 book.'''
+        wsURL = self._prepare(endpoint, symbol, shouldAuth, orderBookTable)
+        self.logger.info("Connecting to %s" % wsURL)
+        self.__connect(wsURL)
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+
+        # Connected. Wait for partials
+        self.__wait_for_symbol()
+        if self.shouldAuth:
+            self.__wait_for_account()
+        self._ready()
 
+    #
+    # Transport hooks. connect() and __run drive these for the threaded socket; other transports
+    # (see ws_async) drive the same ones, so the tables behave identically whatever reads the frames.
+    #
+    def _prepare(self, endpoint, symbol, shouldAuth, orderBookTable):
+        '''Set up what we're subscribing to and return the websocket URL to connect to.'''
         self.logger.debug("Connecting WebSocket.")
-        self.symbol = symbol
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        self.symbol = self.symbols[0]
         self.shouldAuth = shouldAuth
+        if self.shouldAuth:
+            # One signer for every (re)connect's auth headers.
+            self.__signer = RequestSigner(settings.API_KEY, settings.API_SECRET)
+        if orderBookTable and orderBookTable not in ORDERBOOK_TABLES:
+            raise ValueError("orderBookTable must be one of %s" % ', '.join(ORDERBOOK_TABLES))
+        self.orderBookTable = orderBookTable
 
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade"]]
+        subscriptions = [sub + ':' + s for s in self.symbols for sub in self.__symbol_tables(["quote", "trade"])]
         subscriptions += ["instrument"]  # We want all of them
         if self.shouldAuth:
-            subscriptions += [sub + ':' + symbol for sub in ["order", "execution"]]
+            subscriptions += [sub + ':' + s for s in self.symbols for sub in ["order", "execution"]]
             subscriptions += ["margin", "position"]
 
         # Get WS URL and connect.
@@ -57,81 +131,159 @@ class BitMEXWebsocket():
         urlParts[0] = urlParts[0].replace('http', 'ws')
         urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
         wsURL = urlunparse(urlParts)
-        self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL)
-        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+        if settings.WS_REPLAY_PATH:
+            # Replay a capture instead of connecting. Receive times and data ages follow the capture's clock.
+            self.replayClock = VirtualClock(settings.WS_REPLAY_SPEED)
+            self.clock = self.replayClock.now
+        elif settings.WS_RECORD_DIR:
+            self.recorder = FrameRecorder(settings.WS_RECORD_DIR, settings.WS_RECORD_MAX_BYTES)
+        return wsURL
 
-        # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
+    def _images_ready(self):
+        '''True once every partial we subscribed to has been applied.'''
+        return self.__has_images(self.__store)
+
+    def _ready(self):
+        '''All images are in: start accounting and allow reconnects.'''
         if self.shouldAuth:
-            self.__wait_for_account()
+            self.__seed_ledgers('position', 'partial', self.data['position'])
+        self.__connectedOnce = True
         self.logger.info('Got all market data. Starting.')
 
+    def _reconnect_delay(self):
+        '''The socket has closed. Returns how many seconds to wait before reconnecting, or None to stop.
+
+        The first drop after a completed resync starts a new one, on the applier, after it has applied
+        the frames still queued from the old socket.'''
+        if not self.__can_reconnect():
+            return None
+        if self.__reconnectAttempts == 0:
+            self.__dropTime = time()
+            self.__submit(self.__begin_resync)
+        elif self.__reconnectAttempts >= settings.WS_RECONNECT_ATTEMPTS:
+            self.error("Unable to reconnect to WS after %d attempts." % self.__reconnectAttempts)
+            return None
+
+        delay = min(settings.WS_RECONNECT_MAX_DELAY, settings.WS_RECONNECT_DELAY * 2 ** self.__reconnectAttempts)
+        self.__reconnectAttempts += 1
+        self.logger.warning("Websocket dropped. Reconnecting in %.1fs (attempt %d).",
+                            delay, self.__reconnectAttempts)
+        return delay
+
     #
     # Data methods
     #
+    def snapshot(self):
+        '''Return the latest immutable Snapshot of the order, position, margin and instrument tables.
+
+        Snapshots are built on demand: applying a message only marks its table changed, and the next
+        snapshot() copies just the tables that changed since the last one. If nothing has, this is
+        free. Compare snapshot.seq, or use changed_since(), to tell whether anything moved since a
+        previous one.'''
+        if self.__dirty:
+            with self.__snapshotLock:
+                self.__build_snapshot()
+        return self.__snapshot
+
+    def pin(self, snapshot):
+        '''Serve get_instrument/funds/open_orders/position from `snapshot` until pinned again.
+
+        Lets a trading loop see one coherent view for a whole iteration. pin(None) goes back
+        to always reading the latest snapshot.'''
+        self.__pinned = snapshot
+
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
-            raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
-        return instrument
+        # Indexed by symbol as instrument rows arrive; tickLog etc. are already computed.
+        return self.__view().get_instrument(symbol)
 
     def get_ticker(self, symbol):
-        '''Return a ticker object. Generated from instrument.'''
+        '''Return a ticker object. Generated from instrument.
+
+        Tickers are cached per symbol and only rebuilt when the prices they come from change. Until the
+        market moves, callers get the same (read-only) dict back; its 'version' goes up each time it does.'''
 
         instrument = self.get_instrument(symbol)
 
         # If this is an index, we have to get the data from the last trade.
         if instrument['symbol'][0] == '.':
-            ticker = {}
-            ticker['mid'] = ticker['buy'] = ticker['sell'] = ticker['last'] = instrument['markPrice']
+            prices = (instrument['markPrice'],) * 4
         # Normal instrument
         else:
             bid = instrument['bidPrice'] or instrument['lastPrice']
             ask = instrument['askPrice'] or instrument['lastPrice']
-            ticker = {
-                "last": instrument['lastPrice'],
-                "buy": bid,
-                "sell": ask,
-                "mid": (bid + ask) / 2
-            }
+
+            # The local book is updated on every L2 message, while bidPrice/askPrice on the
+            # instrument are throttled. Prefer the book when we have one.
+            book = self.books.get(symbol)
+            if book is not None:
+                bestBid, bestAsk = book.best_bid(), book.best_ask()
+                if bestBid and bestAsk:
+                    bid, ask = bestBid[0], bestAsk[0]
+            prices = (instrument['lastPrice'], bid, ask, (bid + ask) / 2)
+
+        inputs = prices + (instrument['tickSize'],)
+        cached = self.__tickers.get(symbol)
+        if cached is not None and cached[0] == inputs:
+            return cached[1]
 
         # The instrument has a tickSize. Use it to round values.
-        return {k: toNearest(float(v or 0), instrument['tickSize']) for k, v in iteritems(ticker)}
+        ticker = dict(zip(("last", "buy", "sell", "mid"),
+                          (toNearest(float(v or 0), instrument['tickSize']) for v in prices)))
+        previous = cached[1] if cached is not None else None
+        if previous is not None and all(previous[k] == v for k, v in iteritems(ticker)):
+            ticker = previous  # Moved by less than a tick
+        else:
+            ticker['version'] = previous['version'] + 1 if previous is not None else 1
+        self.__tickers[symbol] = (inputs, ticker)
+        return ticker
 
     def funds(self):
-        return self.data['margin'][0]
+        return self.__view().funds()
 
-    def market_depth(self, symbol):
-        raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
-        # return self.data['orderBook25'][0]
+    def position_pnl(self, symbol):
+        '''Our position in `symbol` as accounted locally from execution fills, marked against the current
+        ticker (see PositionLedger.mark()). None if we aren't keeping a ledger for the symbol.'''
+        ledger = self.ledgers.get(symbol)
+        if ledger is None:
+            return None
+        ticker = self.get_ticker(symbol)
+        return ledger.mark(ticker['buy'], ticker['sell'], self.position(symbol).get('leverage'))
 
-    def open_orders(self, clOrdIDPrefix):
-        orders = self.data.get('order', [])
-        if not orders:
-            return []
+    def market_depth(self, symbol, depth=25):
+        '''Return the top levels of the local L2 book: {'symbol', 'bids': [[price, size]...], 'asks': [...]}.'''
+        return self.get_orderbook(symbol).depth(depth)
 
-        # Filter orders with safe key access
-        return [o for o in orders 
-                if o.get('clOrdID') and 
-                str(o.get('clOrdID')).startswith(clOrdIDPrefix) and 
-                o.get('leavesQty', 0) > 0]
+    def get_orderbook(self, symbol):
+        '''Return the live OrderBook for a symbol. Requires connecting with an orderBookTable.'''
+        if not self.orderBookTable:
+            raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
+        if symbol not in self.books:
+            raise Exception("Unable to find orderbook with symbol: " + symbol)
+        return self.books[symbol]
+
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        return self.__view().open_orders(clOrdIDPrefix, symbol)
 
     def position(self, symbol):
-        positions = self.data['position']
-        pos = [p for p in positions if p['symbol'] == symbol]
-        if len(pos) == 0:
-            # No position found; stub it
-            return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
-        return pos[0]
+        return self.__view().position(symbol)
+
+    def recent_trades(self, n=None, symbol=None):
+        '''Return trade history, oldest first. With n, only the newest n trades; with symbol, only that symbol's.'''
+        trades = self.data['trade']
+        if symbol is not None:
+            trades = [t for t in trades if t['symbol'] == symbol]
+            return trades if n is None else trades[-n:] if n > 0 else []
+        if n is None:
+            return trades
+        return trades.last(n)
 
-    def recent_trades(self):
-        return self.data['trade']
+    def get_columns(self, table):
+        '''Return the array-backed history for a table. Requires settings.COLUMNAR_HISTORY.
+
+        e.g. get_columns('trade').column('price', 100) is an array of the last 100 trade prices.'''
+        if table not in self.columns:
+            raise Exception("No columnar history for table: " + table)
+        return self.columns[table]
 
     #
     # Lifecycle methods
@@ -143,8 +295,104 @@ class BitMEXWebsocket():
 
     def exit(self):
         self.exited = True
+        self.__opened.set()
+        self.__notify()
+        if self.__queue is not None:
+            try:
+                self.__queue.put_nowait(None)  # Wake the applier so it can stop
+            except queue.Full:
+                pass  # It'll see `exited` after its current batch
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self.ws.close()
+
+    def reconnect(self):
+        '''Drop the current socket so it reconnects in place, e.g. when the feed has gone stale.
+        If reconnecting is disabled this exits instead, as any other close would.
+
+        Restarts the data_age() clock, so the new connection gets as long to deliver a frame as the
+        old one had before it's judged stale too.'''
+        self.logger.warning("Forcing websocket reconnect.")
+        self.lastMessage = self.clock()
         self.ws.close()
 
+    #
+    # Feed health
+    #
+    def data_age(self, table=None):
+        '''Seconds since the last message on `table` (on any table if None) arrived. None if nothing has.'''
+        received = self.lastUpdate.get(table) if table is not None else self.lastMessage
+        return None if received is None else self.clock() - received
+
+    def resync_age(self):
+        '''Seconds since the websocket dropped, while it's reconnecting and resyncing. None while it's synced.'''
+        dropTime = self.__dropTime
+        if not self.resyncing or dropTime is None:
+            return None
+        return time() - dropTime
+
+    def feed_lag(self, table='quote', last=None, relative=False):
+        '''Distribution of exchange-timestamp-to-local-receive lag, in seconds, on a LAG_TABLES table:
+        {'n', 'p50', 'p90', 'p99', 'max'} over the recent window, or only the newest `last` messages.
+
+        The raw lag includes any skew between our clock and the exchange's. With relative, it's measured
+        from lagBaseline instead: the smallest lag seen since (re)connecting, i.e. the skew plus our
+        fastest path to the exchange, so only lag building up since then shows.'''
+        summary = self.lag[table].summary(last)
+        baseline = self.lagBaseline
+        if relative and summary['n'] and baseline is not None:
+            for k in ('p50', 'p90', 'p99', 'max'):
+                summary[k] -= baseline
+        return summary
+
+    def queue_stats(self):
+        '''How well the table applier is keeping up with the feed.
+
+        depth is the number of frames waiting now and maxDepth the most seen waiting at once;
+        messages and batches count what's been applied, coalesced how many messages were merged
+        into another; applySeconds is the distribution of time spent applying one batch.'''
+        stats = dict(self.queueMetrics)
+        stats['depth'] = self.__queue.qsize() if self.__queue is not None else 0
+        stats['applySeconds'] = self.applyTime.summary()
+        return stats
+
+    def on(self, table, action=None, callback=None):
+        '''Call `callback(table, action, rows)` whenever `table` changes, after the change has been applied.
+
+        `action` is one of 'partial', 'insert', 'update' or 'delete', or None for all of them, so both
+        on('order', 'update', fn) and on('quote', fn) work. `rows` are the rows that changed: complete
+        rows after the update on 'update', the rows removed on 'delete'.
+        Callbacks run on the websocket thread, so they should be quick. After a reconnect, every
+        table's callbacks get a 'partial' with all its rows. Returns the callback, so this can be
+        used as a decorator: @ws.on('quote').'''
+        if callback is None and callable(action):
+            action, callback = None, action
+        if callback is None:
+            return lambda fn: self.on(table, action, fn)
+        self.__callbacks.setdefault((table, action), []).append(callback)
+        return callback
+
+    def off(self, table, action=None, callback=None):
+        '''Unregister a callback added with on().'''
+        if callback is None and callable(action):
+            action, callback = None, action
+        callbacks = self.__callbacks.get((table, action), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def wait_for_update(self, tables=None, timeout=None):
+        '''Block until one of `tables` changes (any table if None), or until timeout seconds pass.
+
+        Returns the set of watched tables that changed since the last call, which is empty on timeout.
+        Changes that land while the caller is busy are remembered, so the next call returns at once.'''
+        watched = (lambda changed: changed & set(tables)) if tables is not None else set
+        with self.__updated:
+            self.__updated.wait_for(lambda: watched(self.__changed) or self.exited, timeout)
+            changed = watched(self.__changed)
+            self.__changed -= changed
+            return changed
+
     #
     # Private methods
     #
@@ -153,34 +401,122 @@ class BitMEXWebsocket():
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        ssl_defaults = ssl.get_default_verify_paths()
-        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth()
-                                         )
+        self.__wsURL = wsURL
+        self.ws = self.__new_app()
 
         setup_custom_logger('websocket', log_level=settings.LOG_LEVEL)
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever(sslopt=sslopt_ca_certs))
+        if self.__queue is not None:
+            self.applier = threading.Thread(target=self.__apply_loop)
+            self.applier.daemon = True
+            self.applier.start()
+        self.wst = threading.Thread(target=self.__run)
         self.wst.daemon = True
         self.wst.start()
         self.logger.info("Started thread")
 
-        # Wait for connect before continuing
+        # Wait for connect before continuing. _on_open (or an error) wakes us.
         conn_timeout = 5
-        while (not self.ws.sock or not self.ws.sock.connected) and conn_timeout and not self._error:
-            sleep(1)
-            conn_timeout -= 1
+        self.__opened.wait(conn_timeout)
 
-        if not conn_timeout or self._error:
+        if not self.ws.sock or not self.ws.sock.connected or self._error:
             self.logger.error("Couldn't connect to WS! Exiting.")
             self.exit()
             sys.exit(1)
 
-    def __get_auth(self):
+    def __new_app(self):
+        '''Build the WebSocketApp. Called again on every reconnect so the auth signature is fresh.'''
+        if self.replayClock is not None:
+            return ReplayApp(settings.WS_REPLAY_PATH, self.replayClock,
+                             on_message=self._on_message,
+                             on_close=self._on_close,
+                             on_open=self._on_open,
+                             on_error=self._on_error)
+        return websocket.WebSocketApp(self.__wsURL,
+                                      on_message=self._on_message,
+                                      on_close=self._on_close,
+                                      on_open=self._on_open,
+                                      on_error=self._on_error,
+                                      header=self._auth_headers()
+                                      )
+
+    def __run(self):
+        '''Websocket thread. Runs the socket and, once we've been fully connected, reconnects in place
+        with exponential backoff if it drops.'''
+        ssl_defaults = ssl.get_default_verify_paths()
+        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
+        while True:
+            # Ping frames keep the connection alive and catch half-open sockets: a missed pong closes it.
+            try:
+                self.ws.run_forever(sslopt=sslopt_ca_certs, ping_interval=settings.WS_PING_INTERVAL or 0,
+                                    ping_timeout=settings.WS_PING_TIMEOUT)
+            except Exception as e:
+                # websocket-client 0.57 fails tearing down its ping thread on Python 3.9+ (no Thread.isAlive),
+                # before it closes the socket or calls on_close. Finish the close ourselves.
+                self.logger.warning("Websocket closed uncleanly: %s", e)
+                self.ws.close()
+                self._on_close()
+            delay = self._reconnect_delay()
+            if delay is None:
+                break
+            sleep(delay)
+            if self.exited:
+                break
+            # Reconnecting re-authenticates and resubscribes: the querystring carries the subscriptions.
+            self.ws = self.__new_app()
+
+    def __can_reconnect(self):
+        # A replay plays once.
+        return settings.WS_RECONNECT and self.__connectedOnce and not self.exited and self.replayClock is None
+
+    def __begin_resync(self):
+        '''Start collecting fresh partials into a new store. Readers keep the old data until it's complete.'''
+        self.resyncing = True
+        self.resynced.clear()
+        self.__store = TableStore()
+        # The clock or the route may have changed: calibrate feed_lag() against the new connection.
+        self.lagBaseline = None
+
+    def __finish_resync(self):
+        '''All partials are in: swap the fresh store in for readers and announce it.'''
+        store = self.__store
+        with self.__snapshotLock:
+            self.__publish(store)
+            self.__dirty.update(self.SNAPSHOT_TABLES)
+        self.resyncing = False
+        self.__reconnectAttempts = 0
+
+        elapsed = time() - self.__dropTime
+        self.metrics['reconnects'] += 1
+        self.metrics['lastReconnectSeconds'] = elapsed
+        self.metrics['totalReconnectSeconds'] += elapsed
+        self.logger.info("Websocket reconnected and resynced in %.2fs.", elapsed)
+
+        self.resynced.set()
+        # Everything may have moved while we were away.
+        tables = list(store.data) + ([self.orderBookTable] if self.orderBookTable else [])
+        for table in tables:
+            self.__run_callbacks(table, 'partial', list(store.data.get(table, ())))
+        self.__notify(*tables)
+
+    def __symbol_tables(self, tables):
+        '''Per-symbol market data tables, plus the L2 book if we're keeping one.'''
+        return (tables + [self.orderBookTable]) if self.orderBookTable else tables
+
+    def __market_images(self):
+        return ({(t, s) for t in self.__symbol_tables(['trade', 'quote']) for s in self.symbols} |
+                {('instrument', None)})
+
+    def __account_images(self):
+        return {('order', s) for s in self.symbols} | {('margin', None), ('position', None)}
+
+    def __has_images(self, store):
+        '''True once the store holds every partial we subscribed to.'''
+        images = self.__market_images()
+        if self.shouldAuth:
+            images |= self.__account_images()
+        return images <= store.partials
+
+    def _auth_headers(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
 
         if self.shouldAuth is False:
@@ -190,39 +526,136 @@ class BitMEXWebsocket():
         
         # To auth to the WS using an API key, we generate a signature of a nonce and
         # the WS API endpoint.
-        nonce = generate_expires()
-        return [
-            "api-expires: " + str(nonce),
-            "api-signature: " + generate_signature(settings.API_SECRET, 'GET', '/realtime', nonce, ''),
-            "api-key:" + settings.API_KEY
-        ]
+        headers = self.__signer.headers('GET', '/realtime', expires=generate_expires())
+        return [name + ": " + value for name, value in headers.items()]
 
     def __wait_for_account(self):
         '''On subscribe, this data will come down. Wait for it.'''
-        # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order'} <= set(self.data):
-            sleep(0.1)
+        # Wait for the keys to show up from the ws. Every applied message wakes us to re-check.
+        images = self.__account_images()
+        with self.__updated:
+            self.__updated.wait_for(lambda: images <= self.__store.partials or self.exited)
 
-    def __wait_for_symbol(self, symbol):
+    def __wait_for_symbol(self):
         '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
-            sleep(0.1)
+        images = self.__market_images()
+        with self.__updated:
+            self.__updated.wait_for(lambda: images <= self.__store.partials or self.exited)
 
     def __send_command(self, command, args):
         '''Send a raw command.'''
         self.ws.send(json.dumps({"op": command, "args": args or []}))
 
-    def __on_message(self, message):
-        '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+    def _on_message(self, message):
+        '''Reader thread: timestamp a raw frame and hand it to the applier.'''
+        received = self.clock()
+        self.lastMessage = received
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(received, message)
+        self.__submit((received, message))
 
-        table = message['table'] if 'table' in message else None
-        action = message['action'] if 'action' in message else None
+    def __submit(self, item):
+        '''Queue a (received, frame) pair, or a function to be run in order with them, for the applier.'''
+        if self.__queue is None:
+            self.__apply_batch([item])
+        else:
+            self.__queue.put(item)
+
+    def __apply_loop(self):
+        '''Applier thread: drain queued frames in batches and apply them to the tables.'''
+        q = self.__queue
+        while not self.exited:
+            item = q.get()
+            depth = q.qsize() + 1
+            if depth > self.queueMetrics['maxDepth']:
+                self.queueMetrics['maxDepth'] = depth
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= settings.WS_APPLY_BATCH:
+                    break
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.__apply_batch(batch)
+
+    def __apply_batch(self, batch):
+        start = time()
+        messages = []
+        for item in batch:
+            if callable(item):
+                # Control functions (e.g. starting a resync) run in order with the frames around them.
+                messages.append((None, item))
+                continue
+            received, raw = item
+            try:
+                messages.append((received, fastjson.loads(raw)))
+            except Exception:
+                self.logger.error("Unable to decode websocket frame: %s", traceback.format_exc())
+        applied, coalesced = coalesceMessages(messages, self.COALESCE)
+        for received, message in applied:
+            if received is None:
+                message()
+            else:
+                self.__apply_message(received, message)
+
+        self.applyTime.add(time() - start)
+        self.queueMetrics['messages'] += len(messages)
+        self.queueMetrics['batches'] += 1
+        self.queueMetrics['coalesced'] += coalesced
+
+    def __apply_message(self, received, message):
+        '''Apply one decoded WS message to the tables.'''
+        # Only pay for re-serializing the frame if someone will see it.
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(json.dumps(message))
+
+        table = message.get('table')
+        action = message.get('action')
+        # Handlers write into the current store. While resyncing after a reconnect, that is a fresh
+        # one that readers won't see until it's complete.
+        store = self.__store
         try:
-            if 'subscribe' in message:
+            if action:
+                # Table-specific handlers (e.g. the L2 book) take precedence over the generic ones.
+                handler = self.__tableHandlers.get(table) or self.__actionHandlers.get(action)
+                if handler is None:
+                    raise Exception("Unknown action: %s" % action)
+                if table not in store.data and table not in self.__tableHandlers:
+                    store.data[table] = self.__new_history(store, table) if table in self.HISTORY_COLUMNS else []
+                    store.keys[table] = []
+                if debug:
+                    self.logger.debug('%s: %s %s', table, action, message['data'])
+                if table in self.SNAPSHOT_TABLES and not self.resyncing:
+                    # Held only while the table changes, so snapshot() never copies it half-updated.
+                    with self.__snapshotLock:
+                        rows = handler(store, table, action, message)
+                        self.__dirty.add(table)
+                else:
+                    rows = handler(store, table, action, message)
+                self.lastUpdate[table] = received
+                if table in self.lag and action == 'insert' and message['data']:
+                    lag = received - toEpoch(message['data'][-1]['timestamp'])
+                    if self.lagBaseline is None or lag < self.lagBaseline:
+                        self.lagBaseline = lag
+                    self.lag[table].add(lag)
+                if action == 'partial':
+                    store.partials.add((table, message.get('filter', {}).get('symbol')))
+                if self.resyncing:
+                    if action == 'partial' and self.__has_images(store):
+                        self.__finish_resync()
+                else:
+                    # While resyncing, nothing is visible to readers yet; callbacks hear about it in
+                    # __finish_resync.
+                    self.__run_callbacks(table, action, rows)
+                self.__notify(table)
+            elif 'subscribe' in message:
                 if message['success']:
-                    self.logger.debug("Subscribed to %s." % message['subscribe'])
+                    self.logger.debug("Subscribed to %s.", message['subscribe'])
                 else:
                     self.error("Unable to subscribe to %s. Error: \"%s\" Please check and restart." %
                                (message['request']['args'][0], message['error']))
@@ -231,89 +664,369 @@ class BitMEXWebsocket():
                     self.error(message['error'])
                 if message['status'] == 401:
                     self.error("API Key incorrect, please check and restart.")
-            elif action:
+        except:
+            self.logger.error(traceback.format_exc())
 
-                if table not in self.data:
-                    self.data[table] = []
+    # There are four possible actions from the WS:
+    # 'partial' - full table image
+    # 'insert'  - new row
+    # 'update'  - update row
+    # 'delete'  - delete row
+    # Each has a handler below, dispatched from _on_message through __actionHandlers.
+    # Handlers return the rows that changed, which are passed on to callbacks registered with on().
 
-                if table not in self.keys:
-                    self.keys[table] = []
+    def __on_partial(self, store, table, action, message):
+        # Keys are communicated on partials to let you know how to uniquely identify
+        # an item. Keyed tables are indexed on them so updates and deletes are O(1).
+        store.keys[table] = message['keys']
+        # With several symbols on one connection, each symbol's subscription sends its own partial.
+        # It only replaces that symbol's rows.
+        filterSymbol = message.get('filter', {}).get('symbol')
+        existing = store.data.get(table)
+        if table in self.HISTORY_COLUMNS:
+            self.__insert_history(store, table, message['data'])
+        elif store.keys[table] and isinstance(existing, KeyedTable) and filterSymbol is not None:
+            for row in existing:
+                if row.get('symbol') == filterSymbol:
+                    existing.remove(row)
+            existing.insert(message['data'])
+        elif store.keys[table]:
+            store.data[table] = KeyedTable(store.keys[table], message['data'])
+        else:
+            store.data[table] += message['data']
 
-                # There are four possible actions from the WS:
-                # 'partial' - full table image
-                # 'insert'  - new row
-                # 'update'  - update row
-                # 'delete'  - delete row
-                if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
-                    # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
-                    self.keys[table] = message['keys']
-                elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+        if table == 'instrument':
+            store.instruments.clear()
+            self.__index_instruments(store, message['data'])
+        return message['data']
 
-                elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
-                    # Locate the item in the collection and update it.
-                    for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
-                        if not item:
-                            continue  # No item found to update. Could happen before push
-
-                        # Log executions
-                        if table == 'order':
-                            is_canceled = 'ordStatus' in updateData and updateData['ordStatus'] == 'Canceled'
-                            if 'cumQty' in updateData and not is_canceled:
-                                contExecuted = updateData['cumQty'] - item['cumQty']
-                                if contExecuted > 0:
-                                    instrument = self.get_instrument(item['symbol'])
-                                    self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
-                                             (item['side'], contExecuted, item['symbol'],
-                                              instrument['tickLog'], item['price']))
-
-                        # Update this item.
-                        item.update(updateData)
-
-                        # Remove canceled / filled orders
-                        if table == 'order' and item['leavesQty'] <= 0:
-                            self.data[table].remove(item)
+    def __on_insert(self, store, table, action, message):
+        if table == 'instrument':
+            self.__index_instruments(store, message['data'])
+
+        if table in self.HISTORY_COLUMNS:
+            self.__insert_history(store, table, message['data'])
+        elif isinstance(store.data[table], KeyedTable):
+            store.data[table].insert(message['data'])
+        else:
+            store.data[table] += message['data']
+
+            # Limit the max length of the table to avoid excessive memory usage.
+            # Don't trim orders because we'll lose valuable state if we do.
+            if table not in ['order', 'orderBookL2'] and len(store.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
+                store.data[table] = store.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+        return message['data']
+
+    def __on_update(self, store, table, action, message):
+        # Locate the item in the collection and update it.
+        updated = []
+        for updateData in message['data']:
+            item = self.__find_item(store, table, updateData)
+            if not item:
+                continue  # No item found to update. Could happen before push
+
+            # Update this item. Keyed rows are copied rather than changed in place, so rows already
+            # published in a Snapshot never change under a reader.
+            if isinstance(store.data[table], KeyedTable):
+                item = dict(item)
+                item.update(updateData)
+                store.data[table].insert([item])
+            else:
+                item.update(updateData)
+
+            if table == 'instrument':
+                if not INSTRUMENT_STATIC_FIELDS.isdisjoint(updateData):
+                    deriveInstrumentFields(item)
+                store.instruments[item['symbol']] = item
+            updated.append(item)
+
+            # Remove canceled / filled orders
+            if table == 'order' and item['leavesQty'] <= 0:
+                self.__remove_item(store, table, item)
+        return updated
+
+    def __on_delete(self, store, table, action, message):
+        # Locate the item in the collection and remove it.
+        for deleteData in message['data']:
+            self.__remove_item(store, table, deleteData)
+            if table == 'instrument':
+                store.instruments.pop(deleteData['symbol'], None)
+        return message['data']
 
+    def __index_instruments(self, store, rows):
+        for instrument in rows:
+            deriveInstrumentFields(instrument)
+            store.instruments[instrument['symbol']] = instrument
+
+    def __apply_orderbook(self, store, table, action, message):
+        '''Apply an L2 book message to the per-symbol OrderBooks.'''
+        rowsBySymbol = {}
+        # An empty book still sends a partial; the filter tells us which symbol it was for.
+        if action == 'partial' and 'symbol' in message.get('filter', {}):
+            rowsBySymbol[message['filter']['symbol']] = []
+        for row in message['data']:
+            rowsBySymbol.setdefault(row['symbol'], []).append(row)
+
+        for symbol, rows in iteritems(rowsBySymbol):
+            if action == 'partial':
+                book = store.books.get(symbol) or OrderBook(symbol)
+                book.partial(rows)
+                store.books[symbol] = book
+            elif symbol in store.books:
+                if action == 'insert':
+                    store.books[symbol].insert(rows)
+                elif action == 'update':
+                    store.books[symbol].update(rows)
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
-                    # Locate the item in the collection and remove it.
-                    for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                    store.books[symbol].delete(rows)
                 else:
                     raise Exception("Unknown action: %s" % action)
-        except:
-            self.logger.error(traceback.format_exc())
+        return message['data']
+
+    def __build_snapshot(self):
+        '''Build a new Snapshot with fresh copies of the tables changed since the last one, sharing the
+        rest, and swap it in for readers. Call with __snapshotLock held.'''
+        previous = self.__snapshot
+        tables = [t for t in self.__dirty if t in self.data]
+        self.__dirty.clear()
+        if not tables:
+            return
+        versions = dict(previous.versions)
+        tableRows = dict(previous.tables)
+        for table in tables:
+            versions[table] = versions.get(table, 0) + 1
+            if table != 'instrument':
+                tableRows[table] = tuple(self.data[table])
+        instruments = dict(self.instruments) if 'instrument' in tables else previous.instruments
+        # A single attribute assignment: readers see either the old snapshot or the new one.
+        self.__snapshot = Snapshot(previous.seq + 1, versions, tableRows, instruments)
+
+    def __view(self):
+        return self.__pinned or self.snapshot()
+
+    def __new_history(self, store, table):
+        '''Create the ring buffer(s) backing a history table.'''
+        capacity = (settings.HISTORY_TABLE_LEN or {}).get(table, BitMEXWebsocket.MAX_TABLE_LEN)
+        if settings.COLUMNAR_HISTORY:
+            store.columns[table] = ColumnarRingBuffer(capacity, self.HISTORY_COLUMNS[table])
+        return RingBuffer(capacity)
+
+    def __insert_history(self, store, table, rows):
+        store.data[table].insert(rows)
+        if table in store.columns:
+            store.columns[table].insert(rows)
+
+    def __find_item(self, store, table, matchData):
+        '''Locate a row by the table's keys. O(1) on keyed tables.'''
+        if isinstance(store.data[table], KeyedTable):
+            return store.data[table].find(matchData)
+        return findItemByKeys(store.keys[table], store.data[table], matchData)
+
+    def __remove_item(self, store, table, matchData):
+        '''Remove a row by the table's keys. O(1) on keyed tables.'''
+        if isinstance(store.data[table], KeyedTable):
+            store.data[table].remove(matchData)
+        else:
+            item = findItemByKeys(store.keys[table], store.data[table], matchData)
+            if item is not None:
+                store.data[table].remove(item)
+
+    def __run_callbacks(self, table, action, rows):
+        '''Hand changed rows to callbacks registered with on(). A failing callback doesn't stop the feed.'''
+        callbacks = self.__callbacks.get((table, action), []) + self.__callbacks.get((table, None), [])
+        for callback in callbacks:
+            try:
+                callback(table, action, rows)
+            except Exception:
+                self.logger.error("Error in %s %s callback: %s", table, action, traceback.format_exc())
+
+    def __log_executions(self, table, action, rows):
+        for execution in rows:
+            if execution.get('execType') != 'Trade':
+                continue
+            instrument = self.get_instrument(execution['symbol'])
+            self.logger.info("Execution: %s %d Contracts of %s at %.*f",
+                             execution['side'], execution['lastQty'], execution['symbol'],
+                             instrument['tickLog'], execution['lastPx'])
+
+    def __seed_ledgers(self, table, action, rows):
+        '''(Re)start the position ledgers from a position image: on connect, and after every resync.'''
+        positions = dict((p['symbol'], p) for p in rows)
+        for symbol in self.symbols:
+            instrument = self.instruments.get(symbol)
+            if instrument is None:
+                continue  # Instrument image not in yet. connect() seeds again once it is
+            if instrument.get('multiplier') is None:
+                continue  # Not tradeable, e.g. an index
+            ledger = self.ledgers.get(symbol)
+            if ledger is None:
+                ledger = self.ledgers[symbol] = PositionLedger(instrument)
+            position = positions.get(symbol, {})
+            ledger.reset(position.get('currentQty', 0), position.get('avgEntryPrice'))
+
+    def __account_executions(self, table, action, rows):
+        for execution in rows:
+            ledger = self.ledgers.get(execution['symbol'])
+            if ledger is None:
+                continue
+            if execution.get('execType') == 'Trade':
+                ledger.fill(execution['side'], execution['lastQty'], execution['lastPx'], execution.get('execComm'))
+            elif execution.get('execComm'):
+                # Funding and other cash-only executions.
+                ledger.charge(execution['execComm'])
 
-    def __on_open(self):
+    def __notify(self, *tables):
+        '''Mark tables as changed and wake anyone blocked in wait_for_update() or waiting for partials.'''
+        with self.__updated:
+            self.__changed.update(tables)
+            self.__updated.notify_all()
+
+    def __publish(self, store):
+        '''Point the public data attributes at a store.'''
+        self.data = store.data
+        self.keys = store.keys
+        self.books = store.books
+        self.columns = store.columns
+        self.instruments = store.instruments
+
+    def _on_open(self):
         self.logger.debug("Websocket Opened.")
+        self.__opened.set()
 
-    def __on_close(self):
+    def _on_close(self):
+        if self.__can_reconnect():
+            self.logger.warning('Websocket Closed')
+            return
         self.logger.info('Websocket Closed')
+        if self.replayClock is not None:
+            # The capture has run out. Exit once everything queued before this has been applied.
+            self.__submit(self.exit)
+            return
         self.exit()
 
-    def __on_error(self, error):
-        if not self.exited:
+    def _on_error(self, error):
+        if self.__can_reconnect():
+            # A transport error on an established connection. __run will reconnect.
+            self.logger.warning("Websocket error: %s", error)
+        elif not self.exited:
             self.error(error)
 
     def __reset(self):
-        self.data = {}
-        self.keys = {}
+        self.__store = TableStore()
+        self.__publish(self.__store)
+        self.__snapshot = Snapshot()
+        self.__pinned = None
+        self.__dirty = set()  # SNAPSHOT_TABLES changed since __snapshot was built
+        self.__snapshotLock = threading.RLock()
+        self.orderBookTable = None
+        self.__signer = None  # RequestSigner, once connect() knows we authenticate
         self.exited = False
+        self.__connectedOnce = False
+        # Reconnect state. `resynced` is set each time a reconnect has swapped in fresh data.
+        self.resyncing = False
+        self.resynced = threading.Event()
+        self.__reconnectAttempts = 0
+        self.__dropTime = None
+        self.metrics = {'reconnects': 0, 'lastReconnectSeconds': None, 'totalReconnectSeconds': 0.0}
+        # Feed health: local receive time of the last message, overall and per table, and feed lag.
+        self.lastMessage = None
+        self.lastUpdate = {}
+        self.__tickers = {}  # symbol -> (prices it was built from, ticker)
+        self.ledgers = {}  # symbol -> PositionLedger, for our own symbols
+        self.recorder = None  # FrameRecorder, if settings.WS_RECORD_DIR is set
+        # Where receive times come from: wall time, or a VirtualClock when replaying a capture.
+        self.replayClock = None
+        self.clock = time
+        self.lag = dict((t, LatencyWindow(settings.FEED_LAG_WINDOW or 1000)) for t in self.LAG_TABLES)
+        self.lagBaseline = None  # Smallest lag seen since (re)connecting; see feed_lag()
+        # Frames waiting for the applier thread, or None to apply them on the reader thread.
+        useQueue = settings.WS_APPLY_QUEUE and self.APPLIER_THREAD
+        self.__queue = queue.Queue(settings.WS_QUEUE_SIZE or 0) if useQueue else None
+        self.queueMetrics = {'maxDepth': 0, 'messages': 0, 'batches': 0, 'coalesced': 0}
+        self.applyTime = LatencyWindow()
+        # Set once the socket is open (or has failed to open).
+        self.__opened = threading.Event()
+        # Notified whenever a message has been applied; __changed holds the tables touched since
+        # the last wait_for_update().
+        self.__updated = threading.Condition()
+        self.__changed = set()
         self._error = None
 
 
+# Instrument fields that rarely change. Derived values are only recomputed when an update touches one.
+INSTRUMENT_STATIC_FIELDS = frozenset(['tickSize', 'multiplier', 'isInverse', 'isQuanto',
+                                      'underlyingToSettleMultiplier', 'quoteToSettleMultiplier'])
+
+
+def deriveInstrumentFields(instrument):
+    '''Compute the per-instrument values we'd otherwise recompute on every read, and store them on the row.'''
+    # Turn the 'tickSize' into 'tickLog' for use in rounding
+    # http://stackoverflow.com/a/6190291/832202
+    if instrument.get('tickSize') is not None:
+        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+
+    if instrument.get('isQuanto'):
+        instrument['futureType'] = "Quanto"
+    elif instrument.get('isInverse'):
+        instrument['futureType'] = "Inverse"
+    else:
+        instrument['futureType'] = "Linear"
+
+    # Contract multiplier in settlement currency units, as used for portfolio delta.
+    settleMultiplier = instrument.get('underlyingToSettleMultiplier')
+    if settleMultiplier is None:
+        settleMultiplier = instrument.get('quoteToSettleMultiplier')
+    if instrument.get('multiplier') is not None and settleMultiplier:
+        instrument['contractMultiplier'] = float(instrument['multiplier']) / float(settleMultiplier)
+    else:
+        instrument['contractMultiplier'] = None
+
+
+def coalesceMessages(messages, coalesce):
+    '''Merge queued messages so each run of (table, action) pairs in `coalesce` is applied once.
+
+    `messages` is a list of (received, message). A message is merged into the previous message for its
+    table if that one has the same coalescible action: inserts are concatenated (so no history row is
+    lost), and updates to the same row by 'symbol' are folded into one, later fields winning. Order
+    within a table is kept; only the relative order of different tables can change. Anything that
+    isn't a table message (received is None, or no 'table') is a barrier nothing merges across.
+    Returns the merged list and the number of messages merged away.'''
+    applied = []
+    pending = {}  # table -> index in applied of its last message, while that one can absorb more
+    coalesced = 0
+    for received, message in messages:
+        table = message.get('table') if received is not None else None
+        if table is None:
+            pending.clear()
+            applied.append((received, message))
+            continue
+
+        action = message.get('action')
+        index = pending.get(table)
+        if index is not None and applied[index][1]['action'] == action:
+            into = applied[index][1]
+            if action == 'update':
+                rows = dict((row['symbol'], row) for row in into['data'])
+                for row in message['data']:
+                    if row['symbol'] in rows:
+                        rows[row['symbol']].update(row)
+                    else:
+                        into['data'].append(row)
+                        rows[row['symbol']] = row
+            else:
+                into['data'].extend(message['data'])
+            applied[index] = (received, into)
+            coalesced += 1
+            continue
+
+        if (table, action) in coalesce:
+            pending[table] = len(applied)
+        else:
+            pending.pop(table, None)
+        applied.append((received, message))
+    return applied, coalesced
+
+
 def findItemByKeys(keys, table, matchData):
     for item in table:
         matched = True
@@ -0,0 +1,90 @@
+import atexit
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+# Settings are read from ./settings.py, which needs these, and from settings-<argv[1]>.py.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENVIRONMENT = {
+    'BITMEX_API_KEY': 'key',
+    'BITMEX_API_SECRET': 'secret',
+    'BITMEX_TRADING_LEVERAGE': '10',
+    'BITMEX_TARGET_TO_PROFIT': '0.5',
+    'BITMEX_STOP_LOSS': '100000',
+    'BITMEX_ORDER_PAIRS': '4',
+    'BITMEX_ORDER_START_SIZE': '100',
+    'BITMEX_ORDER_STEP_SIZE': '100',
+    'BITMEX_ORDERS_INTERVAL': '0.002',
+    'BITMEX_MIN_SPREAD': '0.0015',
+    'BITMEX_MY_NAME_PREFIX': 'mm_test_',
+}
+os.chdir(ROOT)
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+argv, sys.argv = sys.argv, sys.argv[:1]
+try:
+    from market_maker.settings import settings
+finally:
+    sys.argv = argv
+
+from market_maker.bitmex import BitMEX
+from market_maker.sim.exchange import Exchange, makeInstrument
+from market_maker.sim.server import StandInServer
+
+API_KEY = 'key'
+API_SECRET = 'secret'
+
+
+def eventually(predicate, timeout=3.0):
+    """Poll until predicate() is true, for the websocket to catch up with a REST call."""
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for %s' % predicate)
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def exchange():
+    exchange = Exchange([makeInstrument('XBTUSD', 10000.0)])
+    exchange.add_account(API_KEY, API_SECRET)
+    return exchange
+
+
+@pytest.fixture
+def server(exchange):
+    server = StandInServer(exchange).start()
+    server.faults.rateLimit = 10000
+    yield server
+    server.stop()
+
+
+def connect(server, **kwargs):
+    """A BitMEX client for our account on the stand-in server. Call exit() on it when done."""
+    return BitMEX(base_url=server.url, base_ws_url=server.url, symbol='XBTUSD', apiKey=API_KEY,
+                  apiSecret=API_SECRET, orderIDPrefix=settings.ORDERID_PREFIX, **kwargs)
+
+
+@pytest.fixture
+def bitmex(server):
+    client = connect(server)
+    yield client
+    client.exit()
+
+
+@pytest.fixture
+def manager(server, monkeypatch):
+    """An OrderManager quoting against the stand-in server, once reset() has placed its first ladder."""
+    from market_maker.market_maker import OrderManager
+    monkeypatch.setattr(sys, 'argv', sys.argv[:1])
+    monkeypatch.setattr(atexit, 'register', lambda *args: None)
+    monkeypatch.setattr(signal, 'signal', lambda *args: None)
+    for name, value in (('BASE_URL', server.url), ('BASE_WS_URL', server.url), ('API_KEY', API_KEY),
+                        ('API_SECRET', API_SECRET), ('DRY_RUN', False), ('CANCEL_ALL_AFTER', None)):
+        monkeypatch.setitem(settings, name, value)
+    manager = OrderManager()
+    yield manager
+    manager.exchange.bitmex.exit()
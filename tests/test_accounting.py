@@ -0,0 +1,86 @@
+import pytest
+
+from market_maker.ws.accounting import PositionLedger
+
+# XBT-settled contracts, money in XBt. XBTUSD is inverse: each contract is worth 1 USD, its multiplier negative
+# like BitMEX's. ETHUSD is quanto: each contract is worth 100 XBt per USD of the ETH price.
+INVERSE = {'symbol': 'XBTUSD', 'multiplier': -100000000, 'isInverse': True}
+QUANTO = {'symbol': 'ETHUSD', 'multiplier': 100, 'isInverse': False, 'isQuanto': True}
+LINEAR = {'symbol': 'XBTUSDT', 'multiplier': 1, 'isInverse': False}
+
+
+def test_inverse_open_partial_close_and_flip():
+    ledger = PositionLedger(INVERSE)
+
+    ledger.fill('Buy', 100, 10000.0)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (100, 10000.0)
+
+    # 40 USD closed: 40 * (1/10000 - 1/12500) XBT.
+    ledger.fill('Sell', 40, 12500.0)
+    assert ledger.realisedPnl == pytest.approx(80000)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (60, pytest.approx(10000.0))
+
+    # Closes the 60 at a loss and opens 40 short at 8000.
+    ledger.fill('Sell', 100, 8000.0)
+    assert ledger.realisedPnl == pytest.approx(80000 - 150000)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (-40, pytest.approx(8000.0))
+
+    marked = ledger.mark(9990.0, 10000.0, leverage=10)
+    assert marked['markPrice'] == 10000.0  # A short is marked against the ask
+    assert marked['unrealisedPnl'] == pytest.approx(-100000)
+    assert marked['unrealisedPnlPcnt'] == pytest.approx(-0.2)
+    assert marked['unrealisedRoePcnt'] == pytest.approx(-2.0)
+
+
+def test_quanto_open_partial_close_and_flip():
+    ledger = PositionLedger(QUANTO)
+
+    ledger.fill('Sell', 10, 2000.0)
+    assert ledger.mark(1900.0, 1950.0)['unrealisedPnl'] == pytest.approx(10 * 100 * 50)
+
+    ledger.fill('Buy', 4, 1900.0)
+    assert ledger.realisedPnl == pytest.approx(4 * 100 * 100)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (-6, pytest.approx(2000.0))
+
+    ledger.fill('Buy', 10, 2100.0)
+    assert ledger.realisedPnl == pytest.approx(40000 - 6 * 100 * 100)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (4, pytest.approx(2100.0))
+    assert ledger.mark(2150.0, 2151.0)['unrealisedPnl'] == pytest.approx(4 * 100 * 50)
+
+
+def test_linear_open_partial_close_and_flip():
+    ledger = PositionLedger(LINEAR)
+
+    ledger.fill('Buy', 10, 100.0)
+    ledger.fill('Buy', 10, 110.0)
+    assert ledger.avg_entry_price() == pytest.approx(105.0)
+
+    ledger.fill('Sell', 5, 115.0)
+    assert ledger.realisedPnl == pytest.approx(50)
+
+    ledger.fill('Sell', 25, 95.0)
+    assert ledger.realisedPnl == pytest.approx(50 - 150)
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (-10, pytest.approx(95.0))
+    assert ledger.mark(89.0, 90.0)['unrealisedPnl'] == pytest.approx(50)
+
+
+def test_closing_exactly_goes_flat():
+    ledger = PositionLedger(INVERSE)
+    ledger.fill('Buy', 100, 10000.0)
+
+    ledger.fill('Sell', 100, 10000.0, commission=25)
+
+    assert (ledger.currentQty, ledger.cost, ledger.avg_entry_price()) == (0, 0, None)
+    marked = ledger.mark(9999.0, 10000.0)
+    assert (marked['unrealisedPnl'], marked['fees']) == (0, 25)
+
+
+def test_reset_starts_from_a_known_position_and_keeps_realised_pnl():
+    ledger = PositionLedger(INVERSE)
+    ledger.fill('Buy', 100, 10000.0)
+    ledger.fill('Sell', 50, 12500.0)
+
+    ledger.reset(-20, 11000.0)
+
+    assert (ledger.currentQty, ledger.avg_entry_price()) == (-20, pytest.approx(11000.0))
+    assert ledger.realisedPnl == pytest.approx(100000)
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from conftest import connect, eventually, settings
+from market_maker.market_maker import orderErrorMessage
+from market_maker.utils.retry import RetryPolicy
+
+
+def ladder(*prices):
+    return [{'side': 'Buy' if price < 10000 else 'Sell', 'orderQty': 100, 'price': price} for price in prices]
+
+
+def ids(orders):
+    return set(o['orderID'] for o in orders)
+
+
+def requests_sent(client, verb, path):
+    return client.rest_stats(verb, path).get('%s %s' % (verb, path), {}).get('count', 0)
+
+
+def test_create_orders_reports_each_failure_in_place(bitmex):
+    orders = ladder(9990.0, 9980.0, 10020.0)
+    orders[1]['orderQty'] = None
+
+    results = bitmex.create_orders(orders)
+
+    assert [r['price'] for r in (results[0], results[2])] == [9990.0, 10020.0]
+    assert isinstance(results[1], Exception)
+    assert orderErrorMessage(results[1]) == 'orderQty is required'
+    assert ids(bitmex.open_orders()) == ids([results[0], results[2]])
+
+
+def test_amend_orders_reports_each_failure_in_place(bitmex, exchange):
+    inner, outer = bitmex.create_orders(ladder(9995.0, 9990.0))
+    exchange.set_outside_quote('XBTUSD', 9985.0, 9994.0)  # Fills the inner bid
+
+    results = bitmex.amend_orders([{'orderID': inner['orderID'], 'price': 9993.0},
+                                   {'orderID': outer['orderID'], 'price': 9989.0}])
+
+    assert orderErrorMessage(results[0]) == 'Invalid ordStatus'
+    assert results[1]['price'] == 9989.0
+    assert [o['price'] for o in bitmex.open_orders()] == [9989.0]
+
+
+def test_rate_limit_budget_follows_the_exchange(bitmex, server):
+    bitmex.http_open_orders()
+
+    budget = bitmex.rate_limit_budget()
+
+    assert budget['limit'] == server.faults.rateLimit
+    assert budget['remaining'] < server.faults.rateLimit
+
+
+def test_cancel_takes_a_list_in_one_request(bitmex):
+    created = bitmex.create_orders(ladder(9990.0, 9980.0, 10020.0))
+
+    canceled = bitmex.cancel([o['orderID'] for o in created])
+
+    assert ids(canceled) == ids(created)
+    assert set(o['ordStatus'] for o in canceled) == {'Canceled'}
+    assert requests_sent(bitmex, 'DELETE', 'order') == 1
+    assert bitmex.open_orders() == []
+    assert bitmex.cancel([]) == []
+    assert requests_sent(bitmex, 'DELETE', 'order') == 1
+
+
+def test_open_orders_show_acks_before_the_websocket_does(bitmex, server):
+    server.faults.wsLatency = 0.5
+    order, = bitmex.create_orders(ladder(9990.0))
+    assert bitmex.ws.open_orders(settings.ORDERID_PREFIX) == []
+    assert ids(bitmex.open_orders()) == {order['orderID']}
+
+    bitmex.amend_orders([{'orderID': order['orderID'], 'price': 9985.0, 'orderQty': 200}])
+    assert [(o['price'], o['leavesQty']) for o in bitmex.open_orders()] == [(9985.0, 200)]
+
+    bitmex.cancel([order['orderID']])
+    assert bitmex.open_orders() == []
+
+
+def test_open_orders_survive_a_reconnect(bitmex, server):
+    created = bitmex.create_orders(ladder(9990.0, 9980.0, 10020.0))
+    eventually(lambda: not bitmex.orderState.pending)
+    reconnects = bitmex.ws.metrics['reconnects']
+
+    server.disconnect()
+    eventually(lambda: bitmex.ws.metrics['reconnects'] > reconnects and not bitmex.ws.resyncing)
+
+    assert ids(bitmex.ws.open_orders(settings.ORDERID_PREFIX)) == ids(created)
+    assert [o['price'] for o in bitmex.open_orders()] == [9980.0, 9990.0, 10020.0]
+
+def test_idempotent_requests_retry_until_they_succeed(bitmex, server):
+    server.faults.fail_next(503, 2)
+
+    assert bitmex.http_open_orders() == []
+
+    metrics = bitmex.retry_metrics()['GET order']
+    assert (metrics['retries'], metrics['giveUps']) == (2, 0)
+
+
+def test_retries_give_up_at_the_deadline(server):
+    client = connect(server, retryPolicy=RetryPolicy(maxRetries=100, base=0.05, cap=0.05, deadline=0.3))
+    server.faults.fail_next(503, 100)
+    try:
+        start = time.time()
+        with pytest.raises(Exception, match='Max retries'):
+            client.http_open_orders()
+        assert time.time() - start < 1
+        assert client.retry_metrics()['GET order']['giveUps'] == 1
+    finally:
+        client.exit()
+
+
+def test_creates_are_not_retried(bitmex, server):
+    server.faults.fail_next(503, 1)
+
+    result, = bitmex.create_orders(ladder(9990.0))
+
+    assert isinstance(result, Exception)
+    assert bitmex.retry_metrics()['POST order']['retries'] == 0
+    assert bitmex.http_open_orders() == []
+
+
+def test_a_request_that_fails_before_sending_gives_back_its_rate_limit_slot(bitmex):
+    with pytest.raises(TypeError):
+        bitmex._curl_bitmex(path='order', postdict={'price': object()}, verb='POST', rethrow_errors=True)
+
+    assert bitmex.rateLimiter.inflight == 0
+
+
+def test_a_burst_of_429s_cancels_our_orders_once(bitmex, server, monkeypatch):
+    resting, = bitmex.create_orders(ladder(9990.0))
+    cancels = []
+    cancel = bitmex.cancel
+    monkeypatch.setattr(bitmex, 'cancel', lambda orderIDs: cancels.append(orderIDs) or cancel(orderIDs))
+    server.faults.fail_next(429, 4)
+
+    bitmex.create_orders(ladder(9980.0, 9970.0, 10020.0, 10030.0))
+
+    assert cancels == [[resting['orderID']]]
+    assert resting['orderID'] not in ids(bitmex.open_orders())
@@ -0,0 +1,210 @@
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import API_KEY, eventually, settings
+
+
+def record(monkeypatch, exchange, method):
+    """Record every batch passed to exchange.<method>, still sending it."""
+    calls = []
+    original = getattr(exchange, method)
+
+    def recorded(orders, *args):
+        calls.append(list(orders))
+        return original(orders, *args)
+    monkeypatch.setattr(exchange, method, recorded)
+    return calls
+
+
+def test_fresh_ladder_converges_without_amends(manager, monkeypatch):
+    exchange = manager.exchange
+    eventually(lambda: len(exchange.bitmex.ws.open_orders(settings.ORDERID_PREFIX)) == 2 * settings.ORDER_PAIRS)
+    amends = record(monkeypatch, exchange, 'amend_orders')
+    creates = record(monkeypatch, exchange, 'create_orders')
+
+    manager.place_orders()
+
+    assert amends == []
+    assert creates == []
+
+
+def test_requote_before_the_websocket_confirms_needs_no_amends(manager, server, monkeypatch):
+    exchange = manager.exchange
+    exchange.cancel_all_orders()
+    eventually(lambda: exchange.bitmex.ws.open_orders(settings.ORDERID_PREFIX) == [])
+    server.faults.wsLatency = 0.5
+    manager.place_orders()
+    assert exchange.bitmex.ws.open_orders(settings.ORDERID_PREFIX) == []
+    amends = record(monkeypatch, exchange, 'amend_orders')
+    creates = record(monkeypatch, exchange, 'create_orders')
+
+    manager.place_orders()
+
+    assert amends == []
+    assert creates == []
+
+
+def test_a_failed_create_is_replaced_next_loop(manager, server, monkeypatch):
+    exchange = manager.exchange
+    exchange.cancel_all_orders()
+    eventually(lambda: exchange.bitmex.ws.open_orders(settings.ORDERID_PREFIX) == [])
+    monkeypatch.setattr(exchange, 'isolate_margin', lambda *args: None)  # So the failure lands on a create
+    server.faults.fail_next(503, 1)  # Creates aren't retried
+
+    manager.place_orders()
+    assert len(exchange.get_orders()) == 2 * settings.ORDER_PAIRS - 1
+    creates = record(monkeypatch, exchange, 'create_orders')
+    manager.place_orders()
+
+    assert [len(batch) for batch in creates] == [1]
+    assert len(exchange.get_orders()) == 2 * settings.ORDER_PAIRS
+
+
+def place_manual_order(exchange):
+    """An order on our account that this bot didn't place."""
+    account = exchange.accounts[API_KEY]
+    return exchange.place_order(account, {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100, 'price': 9000.0,
+                                          'clOrdID': 'manual_1'})
+
+
+def open_clOrdIDs(exchange):
+    account = exchange.accounts[API_KEY]
+    return set(o['clOrdID'] for o in exchange.get_orders(account, filter={'ordStatus.isTerminated': False}))
+
+
+def test_cancel_all_orders_leaves_other_orders_alone(manager, exchange, monkeypatch):
+    place_manual_order(exchange)
+    cancels = record(monkeypatch, manager.exchange.bitmex, 'cancel')
+
+    manager.exchange.cancel_all_orders()
+
+    assert open_clOrdIDs(exchange) == {'manual_1'}
+    assert len(cancels) == 1 and len(cancels[0]) == 2 * settings.ORDER_PAIRS
+
+
+def test_cancel_all_orders_asks_over_http_while_the_websocket_resyncs(manager, exchange, monkeypatch):
+    monkeypatch.setattr(manager.exchange, 'is_synced', lambda: False)
+    monkeypatch.setattr(manager.exchange.bitmex, 'open_orders', lambda: [])
+
+    manager.exchange.cancel_all_orders()
+
+    assert open_clOrdIDs(exchange) == set()
+
+
+def test_cancel_all_orders_symbol_wide_is_opt_in(manager, exchange, monkeypatch):
+    place_manual_order(exchange)
+    monkeypatch.setitem(settings, 'CANCEL_ALL_SYMBOL_WIDE', True)
+
+    manager.exchange.cancel_all_orders()
+
+    assert open_clOrdIDs(exchange) == set()
+
+
+class StopLoop(Exception):
+    pass
+
+
+def test_rest_stats_signal_is_serviced_by_the_loop(manager, monkeypatch, tmp_path):
+    monkeypatch.setitem(settings, 'REST_STATS_FILE', str(tmp_path / 'rest.json'))
+    monkeypatch.setitem(settings, 'LOOP_INTERVAL', 0.01)
+    # The signal can land while the main thread is recording a request's timings.
+    with manager.exchange.bitmex.restStats._lock:
+        handler = threading.Thread(target=manager.request_rest_stats, args=(None, None))
+        handler.start()
+        handler.join(1)
+        assert not handler.is_alive()
+
+    def stop():
+        raise StopLoop()
+    monkeypatch.setattr(manager, 'check_connection', stop)
+    with pytest.raises(StopLoop):
+        manager.run_loop()
+
+    assert 'POST order' in json.loads((tmp_path / 'rest.json').read_text())
+    assert not manager.rest_stats_requested
+
+
+def test_position_pnl_keeps_the_exchanges_quantity_and_entry(manager):
+    exchange = manager.exchange
+    position = exchange.get_position()
+    exchange.bitmex.ws.ledgers['XBTUSD'].reset(500, 9000.0)  # Drifted from the exchange
+
+    pnl = exchange.get_position_pnl()
+
+    assert (pnl['currentQty'], pnl['avgEntryPrice']) == (position['currentQty'], position.get('avgEntryPrice'))
+    assert pnl['unrealisedPnl'] != position.get('unrealisedPnl')
+
+
+def test_quotes_are_pulled_during_a_long_resync_and_replaced_after(manager, exchange, monkeypatch):
+    monkeypatch.setattr(manager.exchange, 'is_synced', lambda: False)
+    monkeypatch.setattr(manager.exchange, 'resync_age', lambda: 1.0)
+    manager.check_resync()
+    assert len(open_clOrdIDs(exchange)) == 2 * settings.ORDER_PAIRS  # Not for long enough yet
+
+    monkeypatch.setattr(manager.exchange, 'resync_age', lambda: settings.WS_RESYNC_CANCEL_SECONDS)
+    manager.check_resync()
+    manager.pulling.result(3)  # Pulled in the background
+    assert open_clOrdIDs(exchange) == set()
+
+    monkeypatch.setattr(manager.exchange, 'is_synced', lambda: True)
+    monkeypatch.setattr(manager.exchange, 'resync_age', lambda: None)
+    assert manager.check_feed()
+    manager.place_orders()
+    assert len(open_clOrdIDs(exchange)) == 2 * settings.ORDER_PAIRS
+
+
+
+def test_quotes_arent_replaced_until_the_resync_cancel_is_done(manager, monkeypatch):
+    release = threading.Event()
+    cancel_all_orders = manager.exchange.cancel_all_orders
+    monkeypatch.setattr(manager.exchange, 'cancel_all_orders', lambda: release.wait(3) and cancel_all_orders())
+    monkeypatch.setattr(manager.exchange, 'is_synced', lambda: False)
+    monkeypatch.setattr(manager.exchange, 'resync_age', lambda: settings.WS_RESYNC_CANCEL_SECONDS)
+    manager.check_resync()  # Returns while the cancel is still waiting
+    monkeypatch.setattr(manager.exchange, 'is_synced', lambda: True)
+    monkeypatch.setattr(manager.exchange, 'resync_age', lambda: None)
+
+    assert not manager.check_feed()
+    release.set()
+    manager.pulling.result(3)
+    assert manager.check_feed()
+
+
+def test_a_finished_replay_exits_cleanly(manager, monkeypatch):
+    monkeypatch.setitem(settings, 'WS_REPLAY_PATH', 'replay.jsonl')
+    monkeypatch.setitem(settings, 'LOOP_INTERVAL', 0.01)
+    monkeypatch.setattr(manager, 'check_connection', lambda: False)  # The recording ran out
+
+    with pytest.raises(SystemExit) as exit:
+        manager.run_loop()
+
+    assert exit.value.code == 0
+
+
+def quote(exchange, ws, count, start):
+    """Move the outside market `count` times, waiting for the websocket to see each quote."""
+    for bid in range(count):
+        samples = ws.lag['quote'].count
+        exchange.set_outside_quote('XBTUSD', start + bid, 11000.0)
+        eventually(lambda: ws.lag['quote'].count > samples)
+
+
+def test_feed_lag_is_measured_from_the_clock_offset_seen_on_connecting(manager, exchange, server, monkeypatch):
+    manager.exchange.cancel_all_orders()  # So the outside market is the top of the book
+    ws = manager.exchange.bitmex.ws
+    skew = [30.0]  # Our clock runs 30s ahead of the exchange's
+    monkeypatch.setattr(ws, 'clock', lambda: time.time() + skew[0])
+    reconnects = ws.metrics['reconnects']
+    server.disconnect()
+    eventually(lambda: ws.metrics['reconnects'] > reconnects and not ws.resyncing)
+
+    quote(exchange, ws, 20, 9000.0)
+    assert ws.feed_lag('quote', last=20)['p50'] > 29
+    assert manager.exchange.feed_problem() is None
+
+    skew[0] += settings.MAX_FEED_LAG_SECONDS + 1  # Quotes start arriving late
+    quote(exchange, ws, 20, 9100.0)
+    assert 'behind the exchange' in manager.exchange.feed_problem()
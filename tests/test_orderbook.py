@@ -0,0 +1,86 @@
+from market_maker.ws.orderbook import OrderBook
+
+
+def level(levelID, side, price, size):
+    return {'symbol': 'XBTUSD', 'id': levelID, 'side': side, 'price': price, 'size': size}
+
+
+def book():
+    book = OrderBook('XBTUSD')
+    book.partial([level(1, 'Sell', 10002.0, 30), level(2, 'Sell', 10001.0, 20),
+                  level(3, 'Buy', 9999.0, 10), level(4, 'Buy', 9998.0, 40)])
+    return book
+
+
+def test_partial_builds_both_sides():
+    b = book()
+
+    assert (b.best_bid(), b.best_ask()) == ((9999.0, 10), (10001.0, 20))
+    assert b.depth(5) == {'symbol': 'XBTUSD', 'bids': [[9999.0, 10], [9998.0, 40]],
+                          'asks': [[10001.0, 20], [10002.0, 30]]}
+    assert len(b) == 4
+
+
+def test_partial_replaces_the_book():
+    b = book()
+
+    b.partial([level(5, 'Buy', 9000.0, 1)])
+
+    assert (b.best_bid(), b.best_ask(), len(b)) == ((9000.0, 1), None, 1)
+
+
+def test_insert_keeps_prices_sorted():
+    b = book()
+
+    b.insert([level(5, 'Buy', 10000.0, 5), level(6, 'Sell', 10003.0, 7), level(7, 'Buy', 9997.0, 1)])
+
+    assert b.best_bid() == (10000.0, 5)
+    assert [p for p, _ in b.depth(5)['bids']] == [10000.0, 9999.0, 9998.0, 9997.0]
+    assert [p for p, _ in b.depth(5)['asks']] == [10001.0, 10002.0, 10003.0]
+
+
+def test_update_changes_size_in_place():
+    b = book()
+    version = b.version
+
+    b.update([{'id': 3, 'side': 'Buy', 'size': 15}])
+
+    assert b.best_bid() == (9999.0, 15)
+    assert b.version > version
+
+
+def test_update_can_move_a_level_without_resending_its_size():
+    b = book()
+
+    b.update([{'id': 2, 'side': 'Sell', 'price': 10000.5}])
+    assert b.best_ask() == (10000.5, 20)
+
+    b.update([{'id': 2, 'side': 'Sell', 'price': 10003.0, 'size': 25}])
+    assert b.depth(5)['asks'] == [[10002.0, 30], [10003.0, 25]]
+
+
+def test_updates_for_unknown_levels_are_ignored():
+    b = book()
+
+    b.update([{'id': 99, 'side': 'Buy', 'size': 1}])
+
+    assert b.best_bid() == (9999.0, 10)
+
+
+def test_delete_removes_levels_and_empties_sides():
+    b = book()
+
+    b.delete([{'id': 3, 'side': 'Buy'}])
+    assert b.best_bid() == (9998.0, 40)
+
+    b.delete([{'id': 4, 'side': 'Buy'}, {'id': 99, 'side': 'Buy'}])
+    assert b.best_bid() is None
+    assert b.depth()['bids'] == []
+
+
+def test_cumulative_size():
+    b = book()
+
+    assert b.cumulative_size('Sell', 1) == 20
+    assert b.cumulative_size('Sell') == 50
+    assert b.cumulative_size('Buy', 5) == 50
@@ -0,0 +1,90 @@
+from market_maker.ws.orderstate import OrderState
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def order(orderID, side, price, timestamp, leavesQty=100, clOrdID='mm_test_1'):
+    return {'orderID': orderID, 'side': side, 'price': price, 'leavesQty': leavesQty, 'clOrdID': clOrdID,
+            'symbol': 'XBTUSD', 'timestamp': timestamp}
+
+
+def test_open_orders_are_outermost_first_whatever_order_acks_land_in():
+    state = OrderState()
+    confirmed = [order('b2', 'Buy', 9990.0, 't1'), order('s1', 'Sell', 10010.0, 't1')]
+    # Acked innermost first, as concurrent creates tend to finish.
+    state.acked([order('s2', 'Sell', 10020.0, 't2'), order('b1', 'Buy', 9995.0, 't2'),
+                 order('b3', 'Buy', 9985.0, 't2')])
+
+    orders = state.open_orders(confirmed, 'mm_test_')
+
+    assert [o['orderID'] for o in orders] == ['b3', 'b2', 'b1', 's2', 's1']
+
+
+def test_confirmed_orders_are_sorted_too():
+    confirmed = [order('s1', 'Sell', 10010.0, 't1'), order('b1', 'Buy', 9995.0, 't1'),
+                 order('s2', 'Sell', 10020.0, 't1'), order('b2', 'Buy', 9990.0, 't1')]
+
+    orders = OrderState().open_orders(confirmed, 'mm_test_')
+
+    assert [o['orderID'] for o in orders] == ['b2', 'b1', 's2', 's1']
+
+
+def test_acks_override_older_websocket_rows():
+    state = OrderState()
+    confirmed = [order('b1', 'Buy', 9990.0, 't1'), order('b2', 'Buy', 9980.0, 't1')]
+    state.acked([order('b1', 'Buy', 9985.0, 't2'), order('b2', 'Buy', 9980.0, 't2', leavesQty=0)])
+
+    assert [(o['orderID'], o['price']) for o in state.open_orders(confirmed, 'mm_test_')] == [('b1', 9985.0)]
+
+
+def test_websocket_rows_newer_than_an_ack_win():
+    state = OrderState()
+    state.acked([order('b1', 'Buy', 9985.0, 't2')])
+    confirmed = [order('b1', 'Buy', 9980.0, 't3')]
+
+    assert [o['price'] for o in state.open_orders(confirmed, 'mm_test_')] == [9980.0]
+
+
+def test_acks_the_websocket_already_passed_are_ignored():
+    state = OrderState()
+    state.on_ws('order', 'update', [order('b1', 'Buy', 9980.0, 't3')])
+    state.acked([order('b1', 'Buy', 9985.0, 't2')])
+
+    assert state.pending == {}
+    assert state.metrics['stale'] == 1
+
+
+def test_the_websocket_confirming_an_ack_drops_it():
+    state = OrderState()
+    state.acked([order('b1', 'Buy', 9985.0, 't2')])
+
+    state.on_ws('order', 'insert', [order('b1', 'Buy', 9985.0, 't2')])
+
+    assert state.pending == {}
+    assert state.metrics['confirmed'] == 1
+
+
+def test_other_bots_and_symbols_acks_are_not_ours():
+    state = OrderState()
+    state.acked([order('b1', 'Buy', 9985.0, 't2', clOrdID='manual'), dict(order('b2', 'Buy', 9980.0, 't2'),
+                                                                            symbol='ETHUSD')])
+
+    assert state.open_orders([], 'mm_test_', 'XBTUSD') == []
+
+
+def test_unconfirmed_acks_expire():
+    clock = Clock()
+    state = OrderState(ttl=10, clock=clock)
+    state.acked([order('b1', 'Buy', 9985.0, 't2')])
+    assert len(state.open_orders([], 'mm_test_')) == 1
+
+    clock.now += 11
+
+    assert state.open_orders([], 'mm_test_') == []
+    assert state.metrics['expired'] == 1
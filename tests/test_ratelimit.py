@@ -0,0 +1,53 @@
+import threading
+import time
+
+from market_maker.utils.ratelimit import AMEND, CANCEL, CREATE, OTHER, RateLimiter, requestPriority
+
+
+def test_requests_are_laned_by_urgency():
+    assert requestPriority('DELETE', 'order') == CANCEL
+    assert requestPriority('POST', '/order/cancelAllAfter') == CANCEL
+    assert requestPriority('PUT', 'order') == AMEND
+    assert requestPriority('POST', 'order') == CREATE
+    assert requestPriority('POST', 'position/leverage') == OTHER
+    assert requestPriority('GET', 'order') == OTHER
+
+
+def test_a_waiting_cancel_goes_ahead_of_a_waiting_create():
+    limiter = RateLimiter(limit=10, period=1, reserves=(0, 0, 0, 0))
+    limiter.exhausted()
+    order = []
+
+    def acquire(priority):
+        limiter.acquire(priority)
+        order.append(priority)
+    creator = threading.Thread(target=acquire, args=(CREATE,))
+    creator.start()
+    time.sleep(0.02)
+    canceler = threading.Thread(target=acquire, args=(CANCEL,))
+    canceler.start()
+    creator.join(2)
+    canceler.join(2)
+
+    assert order == [CANCEL, CREATE]
+
+
+def test_the_last_tokens_are_kept_for_cancels():
+    limiter = RateLimiter(limit=100, period=60, reserves=(0, 5, 10, 20))
+    assert limiter.acquire(OTHER)
+    limiter.complete({'X-RateLimit-Remaining': '8', 'X-RateLimit-Limit': '100'})
+
+    assert limiter.acquire(CREATE, maxWait=0) is False
+    assert limiter.acquire(AMEND, maxWait=0) is True
+    assert limiter.acquire(CANCEL, maxWait=0) is True
+    assert limiter.metrics['dropped'][CREATE] == 1
+
+
+def test_low_priority_requests_are_dropped_rather_than_queued():
+    limiter = RateLimiter(limit=60, period=60)
+    limiter.exhausted(retryAfter=10)
+
+    start = time.time()
+    assert limiter.acquire(AMEND, maxWait=0.1) is False
+    assert time.time() - start < 0.1
+    assert limiter.budget()['remaining'] == 0
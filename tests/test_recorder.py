@@ -0,0 +1,45 @@
+import gzip
+import json
+import os
+
+from market_maker.ws.recorder import FrameRecorder, readFrames
+
+FRAMES = [(1700000000.25, json.dumps({'table': 'quote', 'action': 'insert', 'data': [{'symbol': 'XBTUSD'}]})),
+          (1700000000.5, '{"info": "a\\ttab and unicode €"}'),
+          (1700000001.0, b'{"success": true}')]
+
+
+def record(directory, frames, **kwargs):
+    recorder = FrameRecorder(str(directory), **kwargs)
+    for received, frame in frames:
+        recorder.record(received, frame)
+    recorder.close()
+    return recorder
+
+
+def test_frames_read_back_as_recorded(tmp_path):
+    recorder = record(tmp_path, FRAMES)
+
+    assert list(readFrames(str(tmp_path))) == [(1700000000.25, FRAMES[0][1]), (1700000000.5, FRAMES[1][1]),
+                                               (1700000001.0, '{"success": true}')]
+    assert (recorder.written, recorder.dropped) == (3, 0)
+
+
+def test_files_rotate_and_read_back_in_order(tmp_path):
+    frames = [(1700000000.0 + i, '{"seq": %d}' % i) for i in range(10)]
+
+    record(tmp_path, frames, maxBytes=40, prefix='capture')
+
+    files = sorted(os.listdir(str(tmp_path)))
+    assert len(files) > 1 and all(f.startswith('capture-') for f in files)
+    assert list(readFrames(str(tmp_path), prefix='capture')) == frames
+    first = list(readFrames(str(tmp_path / files[0])))
+    assert 0 < len(first) < len(frames) and first == frames[:len(first)]
+
+
+def test_a_partly_written_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'frames-1.log.gz')
+    with gzip.open(path, 'wb') as f:
+        f.write(b'1.0\t{"a": 1}\n2.0\t{"b"')
+
+    assert list(readFrames(path)) == [(1.0, '{"a": 1}')]
@@ -0,0 +1,29 @@
+import socket
+
+from conftest import API_KEY, API_SECRET, settings
+from market_maker.bitmex import BitMEX
+from market_maker.utils.reststats import RestStats
+
+
+def test_new_connections_fall_back_across_addresses(server, monkeypatch):
+    port = server.server_address[1]
+    getaddrinfo = socket.getaddrinfo
+
+    def resolve(host, *args, **kwargs):
+        if host == 'exchange.test':
+            # Nothing listens on the first address.
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.2', port)),
+                    (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+        return getaddrinfo(host, *args, **kwargs)
+    monkeypatch.setattr(socket, 'getaddrinfo', resolve)
+    stats = RestStats()
+    client = BitMEX(base_url='http://exchange.test:%d/api/v1/' % port, base_ws_url=server.url, symbol='XBTUSD',
+                    apiKey=API_KEY, apiSecret=API_SECRET, orderIDPrefix=settings.ORDERID_PREFIX, restStats=stats)
+    try:
+        assert client.http_open_orders() == []
+    finally:
+        client.exit()
+
+    phases = stats.summary('GET', 'order')['GET order']['phases']
+    assert phases['dns']['n'] == 1
+    assert phases['connect']['max'] > 0
@@ -0,0 +1,38 @@
+from market_maker.utils.retry import RetryPolicy, isIdempotent
+
+
+def test_only_idempotent_requests_are_retried_by_default():
+    policy = RetryPolicy(maxRetries=3)
+
+    assert policy.start('GET', 'order').maxRetries == 3
+    assert policy.start('DELETE', 'order').maxRetries == 3
+    assert policy.start('POST', '/order/cancelAllAfter').maxRetries == 3
+    assert policy.start('POST', 'order').maxRetries == 0
+    assert policy.start('PUT', 'order').maxRetries == 0
+    assert policy.start('POST', 'order', maxRetries=2).maxRetries == 2
+    assert not isIdempotent('POST', 'user/requestWithdrawal')
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base=1, cap=2)
+
+    assert all(0 <= policy.backoff(attempt) <= 2 for attempt in range(20))
+
+
+def test_a_request_gives_up_rather_than_retry_past_its_deadline():
+    policy = RetryPolicy(maxRetries=10, base=0.01, cap=0.01, deadline=5)
+    state = policy.start('GET', 'order')
+
+    assert state.next_delay() is not None
+    assert state.next_delay(minDelay=10) is None
+
+    assert policy.metrics()['GET order'] == {'requests': 1, 'retries': 1, 'giveUps': 1,
+                                             'backoffSeconds': state.backedOff}
+
+
+def test_a_request_gives_up_when_out_of_retries():
+    policy = RetryPolicy(maxRetries=2, base=0, cap=0, deadline=None)
+    state = policy.start('GET', 'order')
+
+    assert [state.next_delay() for _ in range(3)] == [0, 0, None]
+    assert state.retries == 2
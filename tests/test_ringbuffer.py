@@ -0,0 +1,77 @@
+import math
+
+from conftest import connect, eventually, settings
+from market_maker.ws.ringbuffer import ColumnarRingBuffer, RingBuffer
+
+
+def rows(*ids):
+    return [{'id': i, 'price': float(i)} for i in ids]
+
+
+def test_ring_buffer_drops_the_oldest_rows_when_full():
+    buffer = RingBuffer(3, rows(1, 2))
+
+    buffer.insert(rows(3, 4, 5))
+
+    assert list(buffer) == rows(3, 4, 5)
+    assert len(buffer) == buffer.capacity == 3
+    assert (buffer[0], buffer[-1], buffer[1:]) == (rows(3)[0], rows(5)[0], rows(4, 5))
+
+
+def test_ring_buffer_last():
+    buffer = RingBuffer(5, rows(1, 2, 3))
+
+    assert buffer.last(2) == rows(2, 3)
+    assert buffer.last(10) == rows(1, 2, 3)
+    assert buffer.last(0) == []
+
+
+def test_ring_buffer_remove_and_clear():
+    buffer = RingBuffer(5, rows(1, 2, 3))
+
+    buffer.remove(rows(2)[0])
+    buffer.remove(rows(9)[0])
+    assert list(buffer) == rows(1, 3)
+
+    buffer.clear()
+    assert list(buffer) == [] and len(buffer) == 0
+
+
+def test_columns_wrap_around_oldest_first():
+    columns = ColumnarRingBuffer(4, ['price', 'size'])
+
+    columns.insert([{'price': float(i), 'size': i * 10} for i in range(1, 7)])
+
+    assert len(columns) == 4
+    assert list(columns.column('price')) == [3.0, 4.0, 5.0, 6.0]  # Stored across the end of the arrays
+    assert list(columns.column('size', 2)) == [50.0, 60.0]
+    assert list(columns.column('price', 10)) == [3.0, 4.0, 5.0, 6.0]
+    assert list(columns.column('price', 0)) == []
+
+
+def test_columns_store_timestamps_as_epoch_seconds_and_missing_values_as_nan():
+    columns = ColumnarRingBuffer(2, ['timestamp', 'price'])
+
+    columns.insert([{'timestamp': '2026-01-01T00:00:01.500Z'}])
+
+    assert columns.column('timestamp')[0] == 1767225601.5
+    assert math.isnan(columns.column('price')[0])
+    columns.clear()
+    assert len(columns) == 0 and list(columns.column('price')) == []
+
+
+def test_recent_trades_keeps_the_newest(server, exchange, monkeypatch):
+    monkeypatch.setitem(settings, 'HISTORY_TABLE_LEN', {'trade': 3})
+    taker = exchange.add_account('taker', 'secret')
+    bitmex = connect(server)
+    try:
+        for qty in range(1, 6):
+            exchange.place_order(taker, {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': qty})
+        eventually(lambda: bitmex.ws.recent_trades(1) and bitmex.ws.recent_trades(1)[0]['size'] == 5)
+
+        assert [t['size'] for t in bitmex.ws.recent_trades()] == [3, 4, 5]
+        assert [t['size'] for t in bitmex.ws.recent_trades(2)] == [4, 5]
+        assert [t['size'] for t in bitmex.ws.recent_trades(2, symbol='XBTUSD')] == [4, 5]
+        assert bitmex.ws.recent_trades(0) == []
+    finally:
+        bitmex.exit()
@@ -0,0 +1,59 @@
+import json
+
+import requests
+
+from conftest import API_KEY, API_SECRET, eventually
+from market_maker.auth import RequestSigner
+
+
+def send(server, verb, path, data=None, secret=API_SECRET):
+    body = json.dumps(data) if data is not None else ''
+    headers = RequestSigner(API_KEY, secret).headers(verb, '/api/v1/' + path, body)
+    headers['Content-Type'] = 'application/json'
+    return requests.request(verb, server.url + path, data=body or None, headers=headers)
+
+
+def test_requests_must_be_signed_with_the_accounts_secret(server):
+    assert send(server, 'GET', 'order').status_code == 200
+    response = send(server, 'GET', 'order', secret='wrong')
+    assert response.status_code == 401
+    assert response.json()['error']['message'] == 'Signature not valid.'
+
+
+def test_orders_rest_and_fill_against_the_outside_market(server, exchange):
+    order = send(server, 'POST', 'order', {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100,
+                                           'price': 9990.0}).json()
+    assert (order['ordStatus'], order['leavesQty']) == ('New', 100)
+
+    exchange.set_outside_quote('XBTUSD', 9980.0, 9990.0)
+
+    order, = send(server, 'GET', 'order').json()
+    assert (order['ordStatus'], order['cumQty'], order['avgPx']) == ('Filled', 100, 9990.0)
+
+
+def test_injected_failures_come_before_the_request_is_handled(server):
+    server.faults.fail_next(503)
+    server.faults.fail_next(429)
+
+    assert send(server, 'POST', 'order', {'symbol': 'XBTUSD', 'orderQty': 100, 'price': 9990.0}).status_code == 503
+    response = send(server, 'GET', 'order')
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+    assert send(server, 'GET', 'order').json() == []
+
+
+def test_the_realtime_feed_follows_the_book(bitmex, exchange):
+    exchange.set_outside_quote('XBTUSD', 9900.0, 9901.0)
+
+    eventually(lambda: bitmex.ws.get_ticker('XBTUSD')['buy'] == 9900.0)
+    assert bitmex.ws.get_ticker('XBTUSD')['sell'] == 9901.0
+
+
+def test_a_disconnected_feed_resyncs(bitmex, server, exchange):
+    reconnects = bitmex.ws.metrics['reconnects']
+
+    server.disconnect()
+    exchange.set_outside_quote('XBTUSD', 9800.0, 9801.0)
+
+    eventually(lambda: bitmex.ws.metrics['reconnects'] > reconnects and not bitmex.ws.resyncing)
+    eventually(lambda: bitmex.ws.get_ticker('XBTUSD')['buy'] == 9800.0)
@@ -0,0 +1,52 @@
+from conftest import API_KEY, eventually, settings
+from market_maker.ws.snapshot import Snapshot
+
+
+def place(exchange, price, clOrdID):
+    return exchange.place_order(exchange.accounts[API_KEY], {'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 100,
+                                                             'price': price, 'clOrdID': clOrdID})
+
+
+def next_snapshot(ws, previous):
+    eventually(lambda: ws.snapshot().seq > previous.seq)
+    return ws.snapshot()
+
+
+def test_a_snapshot_is_rebuilt_only_when_a_table_changes(bitmex):
+    ws = bitmex.ws
+
+    assert ws.snapshot() is ws.snapshot()
+    assert Snapshot().changed_since(None) == set()
+
+
+def test_a_snapshot_never_sees_later_writes(bitmex, exchange):
+    ws = bitmex.ws
+    before = ws.snapshot()
+
+    order = place(exchange, 9000.0, settings.ORDERID_PREFIX + '1')
+    after = next_snapshot(ws, before)
+
+    assert before.open_orders(settings.ORDERID_PREFIX) == []
+    assert [o['orderID'] for o in after.open_orders(settings.ORDERID_PREFIX)] == [order['orderID']]
+    assert 'order' in after.changed_since(before)
+    for table in set(before.tables) - after.changed_since(before):
+        assert after.tables[table] is before.tables[table]  # Unchanged tables are shared, not copied
+
+    exchange.amend_order(exchange.accounts[API_KEY], {'orderID': order['orderID'], 'price': 9100.0})
+    amended = next_snapshot(ws, after)
+
+    assert after.open_orders(settings.ORDERID_PREFIX)[0]['price'] == 9000.0  # The row was replaced, not changed
+    assert amended.open_orders(settings.ORDERID_PREFIX)[0]['price'] == 9100.0
+
+
+def test_a_pinned_snapshot_serves_reads_until_unpinned(bitmex, exchange):
+    ws = bitmex.ws
+    pinned = ws.snapshot()
+    ws.pin(pinned)
+
+    place(exchange, 9000.0, settings.ORDERID_PREFIX + '1')
+    next_snapshot(ws, pinned)
+
+    assert ws.open_orders(settings.ORDERID_PREFIX) == []
+    ws.pin(None)
+    assert len(ws.open_orders(settings.ORDERID_PREFIX)) == 1
@@ -0,0 +1,53 @@
+from market_maker.ws.table import KeyedTable
+
+
+def order(orderID, **fields):
+    return dict({'orderID': orderID, 'symbol': 'XBTUSD'}, **fields)
+
+
+def test_rows_are_found_and_removed_by_key():
+    table = KeyedTable(['orderID'], [order('a', price=1.0), order('b', price=2.0)])
+
+    assert table.find({'orderID': 'b', 'price': 5.0}) == order('b', price=2.0)
+    assert table.find({'orderID': 'c'}) is None
+    assert table.remove({'orderID': 'a'}) == order('a', price=1.0)
+    assert table.remove({'orderID': 'a'}) is None
+    assert list(table) == [order('b', price=2.0)]
+
+
+def test_compound_keys():
+    table = KeyedTable(['symbol', 'id'], [{'symbol': 'XBTUSD', 'id': 1}, {'symbol': 'ETHUSD', 'id': 1}])
+
+    assert table.key_for({'symbol': 'ETHUSD', 'id': 1, 'size': 3}) == ('ETHUSD', 1)
+    assert table.find({'symbol': 'ETHUSD', 'id': 1}) is not None
+    assert table.find({'symbol': 'ETHUSD', 'id': 2}) is None
+
+
+def test_reinserting_a_key_replaces_the_row_in_place():
+    table = KeyedTable(['orderID'], [order('a'), order('b')])
+
+    table.insert([order('a', price=3.0)])
+
+    assert len(table) == 2
+    assert [row['orderID'] for row in table] == ['a', 'b']
+    assert table[0] == order('a', price=3.0)
+
+
+def test_reads_like_a_list():
+    table = KeyedTable(['orderID'], [order('a'), order('b'), order('c')])
+
+    assert len(table) == 3
+    assert table[-1] == order('c')
+    assert [row['orderID'] for row in table[1:]] == ['b', 'c']
+    table.clear()
+    assert list(table) == [] and len(table) == 0
+
+
+def test_iterating_survives_writes():
+    table = KeyedTable(['orderID'], [order('a'), order('b')])
+
+    for row in table:
+        table.remove(row)
+        table.insert([order(row['orderID'] + '2')])
+
+    assert [row['orderID'] for row in table] == ['a2', 'b2']
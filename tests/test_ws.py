@@ -0,0 +1,95 @@
+from conftest import eventually
+from market_maker.auth import RequestSigner
+from market_maker.ws.ws_thread import BitMEXWebsocket, coalesceMessages
+
+
+def test_reconnect_reuses_the_websocket_signer(bitmex, server, monkeypatch):
+    built = []
+    original = RequestSigner.__init__
+
+    def counted(self, *args):
+        built.append(args)
+        original(self, *args)
+    monkeypatch.setattr(RequestSigner, '__init__', counted)
+    ws = bitmex.ws
+    reconnects = ws.metrics['reconnects']
+
+    server.disconnect()
+    eventually(lambda: ws.metrics['reconnects'] > reconnects and not ws.resyncing)
+
+    assert built == []
+
+
+def test_resync_age_is_reported_while_reconnecting(bitmex, server):
+    ws = bitmex.ws
+    assert ws.resync_age() is None
+
+    server.disconnect()
+    eventually(lambda: ws.resyncing)
+    assert ws.resync_age() >= 0
+    eventually(lambda: not ws.resyncing)
+    assert ws.resync_age() is None
+
+
+def message(table, action, *data):
+    return {'table': table, 'action': action, 'data': list(data)}
+
+
+def quote(bid):
+    return {'symbol': 'XBTUSD', 'bidPrice': bid, 'askPrice': bid + 1}
+
+
+def coalesce(*messages):
+    applied, coalesced = coalesceMessages([(float(i), m) for i, m in enumerate(messages)], BitMEXWebsocket.COALESCE)
+    return [m for _, m in applied], coalesced
+
+
+def test_quote_inserts_merge_ahead_of_other_tables():
+    trade = message('trade', 'insert', {'symbol': 'XBTUSD', 'price': 10.0})
+
+    applied, coalesced = coalesce(message('quote', 'insert', quote(1)), trade,
+                                  message('quote', 'insert', quote(2)), message('quote', 'insert', quote(3)))
+
+    # Every quote is kept, in order, and applied before the trade that arrived between them.
+    assert applied == [message('quote', 'insert', quote(1), quote(2), quote(3)), trade]
+    assert coalesced == 2
+
+
+def test_instrument_updates_fold_by_symbol():
+    applied, coalesced = coalesce(
+        message('instrument', 'update', {'symbol': 'XBTUSD', 'markPrice': 1.0, 'fairPrice': 1.0}),
+        message('instrument', 'update', {'symbol': 'ETHUSD', 'markPrice': 5.0}),
+        message('instrument', 'update', {'symbol': 'XBTUSD', 'markPrice': 2.0}))
+
+    assert applied == [message('instrument', 'update', {'symbol': 'XBTUSD', 'markPrice': 2.0, 'fairPrice': 1.0},
+                               {'symbol': 'ETHUSD', 'markPrice': 5.0})]
+    assert coalesced == 2
+
+
+def test_other_tables_and_actions_are_left_alone():
+    messages = (message('order', 'update', {'orderID': 'a'}), message('order', 'update', {'orderID': 'b'}),
+                message('quote', 'partial', quote(1)), message('quote', 'insert', quote(2)))
+
+    applied, coalesced = coalesce(*messages)
+
+    assert applied == list(messages)
+    assert coalesced == 0
+
+
+def test_a_different_action_on_the_same_table_ends_the_run():
+    applied, coalesced = coalesce(message('quote', 'insert', quote(1)), message('quote', 'delete', quote(1)),
+                                  message('quote', 'insert', quote(2)))
+
+    assert [m['action'] for m in applied] == ['insert', 'delete', 'insert']
+    assert coalesced == 0
+
+
+def test_nothing_merges_across_a_barrier():
+    barrier = {'info': 'Welcome'}
+
+    applied, coalesced = coalesceMessages([(0.0, message('quote', 'insert', quote(1))), (None, barrier),
+                                           (2.0, message('quote', 'insert', quote(2)))], BitMEXWebsocket.COALESCE)
+
+    assert [m for _, m in applied] == [message('quote', 'insert', quote(1)), barrier,
+                                       message('quote', 'insert', quote(2))]
+    assert coalesced == 0